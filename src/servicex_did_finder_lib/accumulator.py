@@ -25,19 +25,66 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-from typing import List, Dict, Any, Union
+import heapq
+import itertools
+import logging
+from typing import Callable, Iterable, Iterator, List, Dict, Any, Optional, Union
 
 from servicex_did_finder_lib.did_summary import DIDSummary
-from servicex_did_finder_lib.servicex_adaptor import ServiceXAdapter
+from servicex_did_finder_lib.memory import (MemoryLimitExceeded, MemoryLimits, SpillFile,
+                                            record_bytes)
+from servicex_did_finder_lib.path_prefixes import PrefixTable
+from servicex_did_finder_lib.transport import FileTransport
+from servicex_did_finder_lib.tracing import get_tracer
+
+# A stage that is run on each batch of files just before it is sent to ServiceX
+BatchTransform = Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]
+
+
+def _within_events(files: Iterable[Dict[str, Any]], max_events: int) -> Iterator[Dict[str, Any]]:
+    "The leading files, up to and including the one that brings the total to max_events"
+    events = 0
+    for f in files:
+        if events >= max_events:
+            return
+        yield f
+        events += f.get("file_events") or 0
 
 
 class Accumulator:
     """Track or cache files depending on the mode we are operating in"""
 
-    def __init__(self, sx: ServiceXAdapter, sum: DIDSummary):
+    def __init__(self, sx: FileTransport, sum: DIDSummary,
+                 transforms: Optional[List[BatchTransform]] = None,
+                 memory: Optional[MemoryLimits] = None, max_files: Optional[int] = None,
+                 max_events: Optional[int] = None, intern_paths: bool = False):
+        """
+        :param sx: Where to send the files
+        :param sum: Summary of the files sent
+        :param transforms: Stages each batch goes through before it is sent
+        :param memory: Limits on the memory the cached files may use
+        :param max_files: If only the first N files (in path order) will be sent, N.
+                          Files that can't be among them are dropped early.
+        :param max_events: Only send the first files (in path order) until they hold this
+                           many events
+        :param intern_paths: Keep the cached files with the common prefixes of their
+                             paths shared (see `path_prefixes.PrefixTable`). Worth it
+                             when many files are held, e.g. for `max_files`.
+        """
         self.servicex = sx
         self.summary = sum
+        self.transforms = transforms or []
+        self.memory = memory
+        self.max_files = max_files
+        self.max_events = max_events
         self.file_cache: List[Dict[str, Any]] = []
+        self.cache_bytes = 0
+        self.peak_bytes = 0
+        self._spills: List[SpillFile] = []
+        self._paths = PrefixTable() if intern_paths else None
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
 
     def add(self, file_info: Union[Dict[str, Any], List[Dict[str, Any]]]):
         """
@@ -45,36 +92,119 @@ class Accumulator:
         :param file_info: The file information to track can be a single record or a list
         """
         if isinstance(file_info, dict):
-            self.file_cache.append(file_info)
-        elif isinstance(file_info, list):
-            self.file_cache.extend(file_info)
-        else:
+            file_info = [file_info]
+        elif not isinstance(file_info, list):
             raise ValueError("Invalid input: expected a dictionary or a list of dictionaries")
 
+        if self._paths is not None:
+            file_info = [self._paths.compact(f) for f in file_info]
+        self.file_cache.extend(file_info)
+        self.cache_bytes += sum(record_bytes(f) for f in file_info)
+
+        if self.memory is not None:
+            self._check_memory(self.memory)
+
     @property
     def cache_len(self) -> int:
-        return len(self.file_cache)
+        return len(self.file_cache) + sum(s.count for s in self._spills)
+
+    @property
+    def memory_used(self) -> int:
+        "Bytes the lookup is using, as measured against the hard limit"
+        allocated = self.memory.allocated() if self.memory is not None else 0
+        return max(self.cache_bytes, allocated)
+
+    def _check_memory(self, memory: MemoryLimits):
+        if memory.soft_limit is not None and self.cache_bytes > memory.soft_limit:
+            self._relieve(memory)
+        used = self.memory_used
+        self.peak_bytes = max(self.peak_bytes, used)
+        if memory.hard_limit is not None and used > memory.hard_limit:
+            self.close()
+            raise MemoryLimitExceeded(f"Lookup of {self.summary.did} used {used} bytes, "
+                                      f"over its limit of {memory.hard_limit}")
+
+    def _relieve(self, memory: MemoryLimits):
+        "Get the cached files under the soft limit"
+        self.file_cache.sort(key=self._path_key)
+        limited = self.max_files is not None or self.max_events is not None
+        if limited:
+            kept = list(self._first_files(self.file_cache))
+            if len(kept) < len(self.file_cache):
+                self.file_cache = kept
+                self.cache_bytes = sum(record_bytes(f) for f in self.file_cache)
+                if self.cache_bytes <= memory.soft_limit:  # type: ignore
+                    return
+
+        if limited and self._spills:
+            # Only the first files of all the runs can be sent, so merge the runs into one
+            # that holds just those, rather than keep every file on disk
+            merged = heapq.merge(self.file_cache, *self._spills, key=self._path_key)
+            spill = SpillFile(self._first_files(merged), memory.spill_dir)
+            for old in self._spills:
+                old.close()
+            self._spills = [spill]
+        else:
+            self._spills.append(SpillFile(self.file_cache, memory.spill_dir))
+        self.logger.info(f"Lookup of {self.summary.did} holds {self.cache_bytes} bytes of "
+                         f"files - moved {len(self.file_cache)} files to disk")
+        self.file_cache = []
+        self.cache_bytes = 0
+
+    def _first_files(self, files: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        "The leading files of a sorted run that are within `max_files` and `max_events`"
+        first: Iterator[Dict[str, Any]] = itertools.islice(files, self.max_files)
+        if self.max_events is not None:
+            first = _within_events(first, self.max_events)
+        return first
 
     def send_on(self, count):
         """
         Send the accumulated files
-        :param count: The number of files to send. Set to -1 to send all
+        :param count: The number of files to send. Set to -1 to send all (up to
+                      `max_events`, if it was given)
         """
 
         # Sort the list to insure reproducibility
-        files = sorted(self.file_cache, key=lambda x: x["paths"])
-        if count == -1:
-            self.send_bulk(files)
-        else:
-            self.send_bulk(files[:count])
+        files: Iterable[Dict[str, Any]] = sorted(self.file_cache, key=self._path_key)
+        if self._spills:
+            # Each spilled run is already sorted
+            files = heapq.merge(files, *self._spills, key=self._path_key)
+        if count != -1:
+            files = itertools.islice(files, count)
+        if self.max_events is not None:
+            files = _within_events(files, self.max_events)
+        self.send_bulk(list(files))
+
+        self.close()
+
+    def _path_key(self, file_info: Dict[str, Any]):
+        if self._paths is not None:
+            # Join the paths (once per record, not per comparison) so interned records sort
+            # in the same order as the full paths - `files=N` must pick the same files
+            return self._paths.full_paths(file_info)
+        return file_info["paths"]
 
+    def close(self):
+        "Drop the cached files, and any moved to disk"
         self.file_cache.clear()
+        self.cache_bytes = 0
+        for spill in self._spills:
+            spill.close()
+        self._spills = []
 
     def send_bulk(self, file_list: List[Dict[str, Any]]):
         """
         does a bulk put of files
         :param file_list: The list of files to send
         """
-        for ifl in file_list:
-            self.summary.add_file(ifl)
-        self.servicex.put_file_add_bulk(file_list)
+        if self._paths is not None:
+            file_list = [self._paths.expand(f) for f in file_list]
+        with get_tracer().span("accumulator.flush", {"files": len(file_list)}) as span:
+            # Summarize the files as found: the digest and replica counts must not depend
+            # on how the transforms rewrite the paths (e.g. a cache prefix)
+            self.summary.add_files(file_list)
+            for transform in self.transforms:
+                file_list = transform(file_list)
+            span.set_attribute("files_sent", len(file_list))
+            self.servicex.put_file_add_bulk(file_list)
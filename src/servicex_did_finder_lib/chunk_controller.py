@@ -0,0 +1,133 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import threading
+from typing import Dict
+
+
+class ChunkController:
+    """
+    Decide how many files, and how many bytes, go into each `put_file_add_bulk` request.
+
+    Uses additive-increase/multiplicative-decrease, like TCP congestion control. Every time
+    a full chunk is accepted quickly by the ServiceX App, the record limit grows by
+    `increase` records and the byte budget grows back towards `max_bytes`. A slow response
+    (more than `slow_response` seconds), a 413 (payload too large), or a 429/503 (App
+    overloaded) cuts the record limit by `decrease`; a 413 cuts the byte budget as well.
+
+    One controller is shared by all lookups that talk to the same App in a process, see
+    `get_chunk_controller`.
+    """
+
+    def __init__(self, initial_records: int = 300,
+                 min_records: int = 10,
+                 max_records: int = 5000,
+                 max_bytes: int = 4 * 1024 * 1024,
+                 min_bytes: int = 16 * 1024,
+                 increase: int = 50,
+                 decrease: float = 0.5,
+                 slow_response: float = 5.0):
+        self.min_records = min_records
+        self.max_records_limit = max_records
+        self.max_bytes_limit = max_bytes
+        self.min_bytes = min_bytes
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_response = slow_response
+
+        self._records = float(initial_records)
+        self._bytes = float(max_bytes)
+        self._lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    @property
+    def max_records(self) -> int:
+        "The most files to put in the next chunk"
+        return int(self._records)
+
+    @property
+    def max_bytes(self) -> int:
+        "The largest payload, in bytes, for the next chunk"
+        return int(self._bytes)
+
+    def _shrink(self, shrink_bytes: bool):
+        self._records = max(self.min_records, self._records * self.decrease)
+        if shrink_bytes:
+            self._bytes = max(self.min_bytes, self._bytes * self.decrease)
+
+    def on_success(self, elapsed: float, full: bool):
+        """
+        Record a chunk the App accepted
+        :param elapsed: Seconds the request took
+        :param full: True if the chunk was cut off by the record or byte limit. The limits
+                     only grow when they were actually what held the chunk back.
+        """
+        with self._lock:
+            if elapsed > self.slow_response:
+                self._shrink(shrink_bytes=False)
+                self.logger.info(f"Slow response from ServiceX App ({elapsed:.1f} s). "
+                                 f"Chunks now at most {self.max_records} files")
+            elif full:
+                self._records = min(self.max_records_limit, self._records + self.increase)
+                self._bytes = min(self.max_bytes_limit,
+                                  self._bytes + self.max_bytes_limit * 0.1)
+
+    def on_too_large(self):
+        "Record a chunk the App rejected as too large (413)"
+        with self._lock:
+            self._shrink(shrink_bytes=True)
+            self.logger.info(f"ServiceX App rejected a chunk as too large. Chunks now at most "
+                             f"{self.max_records} files and {self.max_bytes} bytes")
+
+    def on_overload(self):
+        "Record a chunk the App turned away because it is busy (429 or 503)"
+        with self._lock:
+            self._shrink(shrink_bytes=False)
+            self.logger.info(f"ServiceX App is overloaded. Chunks now at most "
+                             f"{self.max_records} files")
+
+
+_controllers: Dict[str, ChunkController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_chunk_controller(endpoint: str) -> ChunkController:
+    """
+    Get the controller for a ServiceX App endpoint, creating it the first time. The state
+    lives for the life of the worker process, so what is learned in one lookup is used by
+    the next.
+    :param endpoint: The ServiceX App endpoint
+    """
+    with _controllers_lock:
+        controller = _controllers.get(endpoint)
+        if controller is None:
+            controller = ChunkController()
+            _controllers[endpoint] = controller
+        return controller
@@ -0,0 +1,147 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Stop every lookup in a process from hammering a ServiceX App that is down.
+
+    After `failure_threshold` requests in a row fail, the circuit opens and requests are
+    parked (`allow` blocks) rather than sent. Once it has been open for `reset_timeout`
+    seconds it is half-open: a single request is let through as a probe. If the probe
+    succeeds the circuit closes and the parked requests go ahead; if it fails the circuit
+    opens again, for twice as long (up to `max_reset_timeout`).
+
+    One breaker is shared by all lookups that talk to the same App in a process, see
+    `get_circuit_breaker`.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0,
+                 max_reset_timeout: float = 300.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._open_for = reset_timeout
+        self._probing = False
+        self._cond = threading.Condition()
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def allow(self, max_wait: Optional[float] = None) -> bool:
+        """
+        Wait until a request may be sent
+        :param max_wait: Most seconds to wait, or None to wait as long as it takes
+        :return: False if the circuit did not let the request through in time
+        """
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        with self._cond:
+            while True:
+                if self.state == CLOSED:
+                    return True
+                now = time.monotonic()
+                if self.state == OPEN and now - self._opened_at >= self._open_for:
+                    self.state = HALF_OPEN
+                    self.logger.info("ServiceX App circuit is half-open - sending a probe")
+                if self.state == HALF_OPEN and not self._probing:
+                    self._probing = True
+                    return True
+
+                wait = self._opened_at + self._open_for - now if self.state == OPEN \
+                    else self.reset_timeout
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = min(wait, deadline - now)
+                self._cond.wait(max(wait, 0.001))
+
+    def record_success(self):
+        "Record a request the App answered"
+        with self._cond:
+            self._failures = 0
+            self._probing = False
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self._open_for = self.reset_timeout
+                self.logger.info("ServiceX App circuit is closed - sending again")
+                self._cond.notify_all()
+
+    def record_failure(self):
+        "Record a request that failed, or that the App turned away"
+        with self._cond:
+            self._failures += 1
+            if self.state == HALF_OPEN:
+                self._probing = False
+                self._open_for = min(2 * self._open_for, self.max_reset_timeout)
+                self._open("the probe failed")
+            elif self.state == CLOSED and self._failures >= self.failure_threshold:
+                self._open(f"{self._failures} requests in a row failed")
+
+    def _open(self, reason: str):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self.logger.warning(f"ServiceX App circuit is open ({reason}) - holding requests "
+                            f"for {self._open_for:.0f} seconds")
+        self._cond.notify_all()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint: str) -> CircuitBreaker:
+    """
+    Get the circuit breaker for a ServiceX App endpoint, creating it the first time
+    :param endpoint: The ServiceX App endpoint
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            _breakers[endpoint] = breaker
+        return breaker
+
+
+def circuit_states() -> Dict[str, str]:
+    """
+    The state of the circuit to each App endpoint this process has talked to
+    """
+    with _breakers_lock:
+        return {endpoint: b.state for endpoint, b in _breakers.items()}
@@ -1,9 +1,13 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import functools
 import json
 import logging
+import signal
+import threading
 import time
-from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Set
 import sys
 
 import pika
@@ -76,23 +80,31 @@ async def run_file_fetch_loop(
     start_time = datetime.now()
 
     summary = DIDSummary(did)
-    did_info = parse_did_uri(did)
-    hold_till_end = did_info.file_count != -1
-    acc = _accumulator(servicex, summary, hold_till_end)
-
     try:
-        async for file_info in user_callback(did_info.did, info):
-            if type(file_info) is dict:
-                acc.add(file_info)
-            else:
-                acc.send_bulk(file_info)
+        did_info = parse_did_uri(did)
+    except ValueError as e:
+        # Tell ServiceX the (empty) fileset is complete, rather than leave it waiting
+        __logging.error(f"Invalid DID request {did}: {e}",
+                        extra={"dataset_id": info.get("dataset-id")})
+        did_info = None
 
-    except Exception:
-        if did_info.get_mode == "all":
-            raise
+    if did_info is not None:
+        hold_till_end = did_info.file_count != -1
+        acc = _accumulator(servicex, summary, hold_till_end)
+
+        try:
+            async for file_info in user_callback(did_info.did, info):
+                if type(file_info) is dict:
+                    acc.add(file_info)
+                else:
+                    acc.send_bulk(file_info)
+
+        except Exception:
+            if did_info.get_mode == "all":
+                raise
 
-    # If we've been holding onto any files, we need to send them now.
-    acc.send_on(did_info.file_count)
+        # If we've been holding onto any files, we need to send them now.
+        acc.send_on(did_info.file_count)
 
     elapsed_time = int((datetime.now() - start_time).total_seconds())
     servicex.put_fileset_complete(
@@ -106,20 +118,11 @@ async def run_file_fetch_loop(
     )
 
 
-def rabbit_mq_callback(
-    user_callback: UserDIDHandler, channel, method, properties, body
-):
-    """rabbit_mq_callback Respond to RabbitMQ Message
-
-    When a request to resolve a DID comes into the DID finder, we
-    respond with this callback. This callback will remain active
-    until the request has been completed satisfied (so for some
-    DID finders, this could be a fairly long time.)
+def _process_did_request(user_callback: UserDIDHandler, body):
+    """Resolve a single DID request message, logging (rather than raising) any failure
 
     Args:
-        channel ([type]): RabbitMQ channel
-        method ([type]): Delivery method
-        properties ([type]): Properties of the message
+        user_callback (UserDIDHandler): Callback to handle the DID rendering requests
         body ([type]): The body (json for us) of the message
     """
     dataset_id = None  # set this in case we get an exception while loading request
@@ -154,39 +157,172 @@ def rabbit_mq_callback(
             f"DID request failed {str(e)}", extra={"dataset_id": dataset_id}
         )
 
+
+def rabbit_mq_callback(
+    user_callback: UserDIDHandler, channel, method, properties, body
+):
+    """rabbit_mq_callback Respond to RabbitMQ Message
+
+    When a request to resolve a DID comes into the DID finder, we
+    respond with this callback. This callback will remain active
+    until the request has been completed satisfied (so for some
+    DID finders, this could be a fairly long time.)
+
+    Args:
+        channel ([type]): RabbitMQ channel
+        method ([type]): Delivery method
+        properties ([type]): Properties of the message
+        body ([type]): The body (json for us) of the message
+    """
+    try:
+        _process_did_request(user_callback, body)
     finally:
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
 
+class _ConcurrentConsumer:
+    """Run DID requests on a pool of worker threads
+
+    The pika connection is not thread safe, so everything that touches it - the
+    acknowledgements in particular - is handed back to the connection thread with
+    `add_callback_threadsafe`. That thread stays in `start_consuming` (or `drain`),
+    which also keeps the connection heartbeat going while long lookups run.
+    """
+
+    def __init__(self, connection, channel, user_callback: UserDIDHandler, max_workers: int):
+        self._connection = connection
+        self._channel = channel
+        self._user_callback = user_callback
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="did_lookup")
+        self._in_flight: Set[int] = set()
+        self._lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    @property
+    def in_flight(self) -> int:
+        "Number of requests that have been received but not yet acknowledged"
+        with self._lock:
+            return len(self._in_flight)
+
+    def on_message(self, channel, method, properties, body):
+        "Called on the connection thread for each new message"
+        with self._lock:
+            self._in_flight.add(method.delivery_tag)
+        self._executor.submit(self._run, method.delivery_tag, body)
+
+    def _run(self, delivery_tag, body):
+        "Called on a worker thread"
+        try:
+            _process_did_request(self._user_callback, body)
+        finally:
+            try:
+                self._connection.add_callback_threadsafe(
+                    functools.partial(self._ack, delivery_tag)
+                )
+            except pika.exceptions.AMQPError:
+                # The connection was lost - RabbitMQ will deliver the request again
+                self.logger.warning(f"Could not acknowledge DID request {delivery_tag}: "
+                                    f"the connection to RabbitMQ is closed")
+
+    def _ack(self, delivery_tag):
+        "Called on the connection thread once a request is done"
+        try:
+            self._channel.basic_ack(delivery_tag=delivery_tag)
+        finally:
+            with self._lock:
+                self._in_flight.discard(delivery_tag)
+
+    def stop(self):
+        "Ask the consumer to stop taking new messages. Safe to call from any thread."
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def drain(self, poll_interval: float = 1.0):
+        """Wait for every in-flight request to finish and be acknowledged. Must be called
+        on the connection thread, after consuming has stopped."""
+        if self.in_flight > 0:
+            self.logger.info(f"Waiting for {self.in_flight} DID requests to finish")
+        while self.in_flight > 0:
+            self._connection.process_data_events(time_limit=poll_interval)
+        self._executor.shutdown(wait=True)
+
+    def abandon(self):
+        """Give up on a connection that was lost. Requests that are running finish on their
+        threads, without waiting for them here. They can't be acknowledged, so RabbitMQ
+        delivers them again."""
+        self._executor.shutdown(wait=False)
+
+
 def init_rabbit_mq(
     user_callback: UserDIDHandler,
     rabbitmq_url: str,
     queue_name: str,
     retries: int,
     retry_interval: float,
+    concurrency: int = 1,
+    prefetch_count: Optional[int] = None,
 ):  # type: ignore
+    """Connect to RabbitMQ and process DID requests until told to stop
+
+    Requests are run on a pool of `concurrency` worker threads. At most `prefetch_count`
+    (default is `concurrency`, 0 for no limit) unacknowledged requests are delivered to this
+    process at once. If the connection is lost, the requests still running are left to
+    finish and a new connection (with a new pool) is made.
+    On SIGTERM (or Ctrl-C) no new requests are taken, and the ones already running are
+    allowed to finish and are acknowledged before returning.
+    """
     rabbitmq = None
+    consumer = None
     retry_count = 0
+    stopping = False
 
-    while not rabbitmq:
+    while not rabbitmq and not stopping:
         try:
             rabbitmq = pika.BlockingConnection(pika.URLParameters(rabbitmq_url))
             _channel = rabbitmq.channel()
             _channel.queue_declare(queue=queue_name)
+            _channel.basic_qos(
+                prefetch_count=concurrency if prefetch_count is None else prefetch_count
+            )
+
+            consumer = _ConcurrentConsumer(rabbitmq, _channel, user_callback, concurrency)
 
-            __logging.info("Connected to RabbitMQ. Ready to start consuming requests")
+            def request_stop(signum, frame):
+                nonlocal stopping
+                stopping = True
+                __logging.info(f"Received signal {signum}, finishing in-flight DID requests")
+                consumer.stop()
+
+            previous_handler = signal.signal(signal.SIGTERM, request_stop) \
+                if threading.current_thread() is threading.main_thread() else None
+
+            __logging.info("Connected to RabbitMQ. Ready to start consuming requests "
+                           f"({concurrency} at a time)")
 
             _channel.basic_consume(
                 queue=queue_name,
                 auto_ack=False,
-                on_message_callback=lambda c, m, p, b: rabbit_mq_callback(
-                    user_callback, c, m, p, b
-                ),
+                on_message_callback=consumer.on_message,
             )
-            _channel.start_consuming()
+            try:
+                _channel.start_consuming()
+            except KeyboardInterrupt:
+                stopping = True
+                _channel.stop_consuming()
+            finally:
+                if previous_handler is not None:
+                    signal.signal(signal.SIGTERM, previous_handler)
+
+            consumer.drain()
+            rabbitmq.close()
 
         except pika.exceptions.AMQPConnectionError:  # type: ignore
             rabbitmq = None
+            if consumer is not None:
+                consumer.abandon()
+                consumer = None
             retry_count += 1
             if retry_count <= retries:
                 __logging.exception(
@@ -227,6 +363,25 @@ def add_did_finder_cnd_arguments(parser: argparse.ArgumentParser):
         default="",
         help="Prefix to add to use a caching proxy for URIs",
     )
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of DID requests to process at the same time",
+    )
+    parser.add_argument(
+        "--prefetch-count",
+        dest="prefetch_count",
+        action="store",
+        type=int,
+        required=False,
+        default=None,
+        help="Most unacknowledged DID requests to take from RabbitMQ at once "
+             "(default is the concurrency, 0 for no limit)",
+    )
 
 
 def start_did_finder(
@@ -272,4 +427,6 @@ def start_did_finder(
         f"{did_finder_name}{QUEUE_NAME_POSTFIX}",
         retries=12,
         retry_interval=10,
+        concurrency=getattr(parsed_args, "concurrency", 1),
+        prefetch_count=getattr(parsed_args, "prefetch_count", None),
     )
@@ -26,15 +26,37 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import logging
+import tempfile
+import time
+import weakref
 from datetime import datetime
-from typing import Any, Generator, Callable, Dict, Optional
+from typing import Any, Generator, Callable, Dict, List, Optional
 
-from celery import Celery, Task
+from celery import Celery, Task, chord, group
+from celery.backends.base import DisabledBackend
+from celery.concurrency import get_implementation
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.utils import uuid
+from celery.signals import (worker_init, worker_process_init, worker_process_shutdown,
+                            worker_shutdown)
 
 from servicex_did_finder_lib.accumulator import Accumulator
-from servicex_did_finder_lib.did_logging import initialize_root_logger
+from servicex_did_finder_lib.did_logging import initialize_root_logger, log_scheme
 from servicex_did_finder_lib.did_summary import DIDSummary
+from servicex_did_finder_lib.enrichment import MetadataEnricher
+from servicex_did_finder_lib.file_filter import FileFilter
+from servicex_did_finder_lib.health import HealthServer, SnapshotWriter, get_metrics
+from servicex_did_finder_lib.memory import MemoryLimitExceeded, MemoryLimits
+from servicex_did_finder_lib.path_rewrite import PathRewriter
+from servicex_did_finder_lib.record_validation import RecordNormalizer
+from servicex_did_finder_lib.replica_ranking import ReplicaRanker
+from servicex_did_finder_lib.schemes import SCHEME_BUSY_RETRY, DIDScheme
+from servicex_did_finder_lib.routing import LookupRouter
+from servicex_did_finder_lib.tracing import configure_tracing, get_tracer, tracing_enabled
 from servicex_did_finder_lib.servicex_adaptor import ServiceXAdapter
+from servicex_did_finder_lib.streaming import StreamingServiceXAdapter
+from servicex_did_finder_lib.transport import BrokerTransport, FileTransport
 from servicex_did_finder_lib.util_uri import parse_did_uri
 
 # The type for the callback method to handle DID's, supplied by the user.
@@ -47,10 +69,27 @@ UserDIDHandler = Callable[
     Generator[Dict[str, Any], None, None]
 ]
 
+# The type for an optional callback that splits a DID into parts that can be looked up
+# independently (e.g. the datasets in a container). Arguments are the same as for
+# UserDIDHandler. Returns the DIDs of the parts, or None if the DID can't be split.
+DIDPartitioner = Callable[
+    [str, Dict[str, Any], Dict[str, Any]],
+    Optional[List[str]]
+]
+
 
 __logging = logging.getLogger(__name__)
 __logging.addHandler(logging.NullHandler())
 
+_normalizer = RecordNormalizer()
+
+# Number of files the DID finder yields in each traced span
+FINDER_SPAN_FILES = 1000
+
+# Seconds past the app's `lookup_timeout` before Celery interrupts a finder that has
+# stopped yielding files
+LOOKUP_TIMEOUT_GRACE = 30.0
+
 
 class DIDFinderTask(Task):
     """
@@ -58,50 +97,149 @@ class DIDFinderTask(Task):
     call the user supplied DID finder to get the list of files associated
     with the DID, and then send that list to ServiceX for processing.
     """
+    # The DID scheme whose finder arguments the task uses. None for the app's own.
+    did_scheme: Optional[str] = None
+
     def __init__(self):
         super().__init__()
         self.logger = logging.getLogger(__name__)
         self.logger.addHandler(logging.NullHandler())
 
-    def do_lookup(self, did: str, dataset_id: int, endpoint: str, user_did_finder: UserDIDHandler):
+    def do_lookup(self, did: str, dataset_id: int, endpoint: str, user_did_finder: UserDIDHandler,
+                  partitioner: Optional[DIDPartitioner] = None):
         """
         Perform the DID lookup for the given DID. This will call the user supplied
         DID finder to get the list of files associated with the DID, and then send
         that list to ServiceX for processing.
         After all of the files have been sent, send a message to ServiceX indicating
         that the fileset is complete
+
+        If the lookup has a deadline (the app's `lookup_timeout` or the DID's `timeout`,
+        whichever is shorter) the finder is stopped at the first file it yields after the
+        deadline. With `get=available` the files found so far are sent on; otherwise the
+        lookup fails. Either way ServiceX is told the fileset is complete. The deadline is
+        only checked between files, so a finder that blocks is only stopped by the Celery
+        soft time limit set from the app's `lookup_timeout` (see `did_lookup_task`).
+
+        If a `partitioner` is given and it splits the DID into more than one part, each
+        part is looked up by its own subtask, so the work is spread across the cluster.
+        The subtasks call `user_did_finder` with the part's DID and send their files
+        straight to ServiceX. Once they have all finished, a chord callback merges their
+        summaries and tells ServiceX the fileset is complete. This needs a Celery result
+        backend. Lookups of the first files (`files=N` or `events=N`) are never split.
         Args:
             did: The DID to process
             dataset_id: The dataset ID for the request
             endpoint: The ServiceX endpoint to send the request to
             user_did_finder: The user supplied DID finder to call to get the list of files
+            partitioner: Splits the DID into parts that can be looked up independently
+        Returns:
+            When run as a subtask for one part, the part's summary (see
+            `DIDSummary.to_dict`), otherwise None
         """
+        partition = getattr(self.request, "did_partition", None)
+        if partition is None and partitioner is not None and \
+                self._split_lookup(did, dataset_id, endpoint, partitioner):
+            return None
 
-        self.logger.info(
-            f"Received DID request {did}",
-            extra={"dataset_id": dataset_id}
-        )
+        with get_tracer().span("did_lookup", {
+            "dataset_id": dataset_id,
+            "did": did,
+            "scheme": self.did_scheme or getattr(self.app, "name", None),
+        }) as span:
+            if partition is not None:
+                span.set_attribute("partition", partition)
+            metrics = get_metrics()
+            metrics.lookup_started()
+            try:
+                return self._run_lookup(did, dataset_id, endpoint, user_did_finder, partition)
+            finally:
+                metrics.lookup_finished()
 
-        servicex = ServiceXAdapter(dataset_id=dataset_id, endpoint=endpoint)
+    def _run_lookup(self, did: str, dataset_id: int, endpoint: str,
+                    user_did_finder: UserDIDHandler, partition: Optional[str] = None):
+        if partition is None:
+            self.logger.info(
+                f"Received DID request {did}",
+                extra={"dataset_id": dataset_id}
+            )
+        else:
+            self.logger.info(
+                f"Looking up part {partition} of DID request {did}",
+                extra={"dataset_id": dataset_id}
+            )
 
-        info = {
-            "dataset-id": dataset_id,
-        }
+        servicex = self._file_transport(dataset_id, endpoint, lookup_id=self.request.id)
 
         start_time = datetime.now()
 
         summary = DIDSummary(did)
-        did_info = parse_did_uri(did)
-        acc = Accumulator(servicex, summary)
+        try:
+            did_info = parse_did_uri(did)
+            file_filter = FileFilter.from_did_info(did_info)
+        except ValueError as e:
+            # ServiceX still needs to hear the lookup is over, or it waits for it forever
+            self.logger.error(f"Invalid DID request {did}: {e}", extra={"dataset_id": dataset_id})
+            return self._finish_lookup(servicex, did, summary, start_time, partition,
+                                       finished=False)
+        memory = self._memory_limits()
+        # Picking the first files (`files=N` or `events=N`) needs them all in hand
+        buffered = did_info.file_count > 0 or did_info.event_count is not None
+        acc = Accumulator(servicex, summary, transforms=self._batch_transforms(),
+                          memory=memory,
+                          max_files=did_info.file_count if did_info.file_count > 0 else None,
+                          max_events=did_info.event_count, intern_paths=buffered)
+
+        info = {
+            "dataset-id": dataset_id,
+            "file-filter": file_filter,
+        }
+        if partition is not None:
+            info["partition-of"] = did_info.did
+
+        timeout = self._lookup_timeout(did_info)
+        deadline = None if timeout is None else time.monotonic() + timeout
 
+        finder = None
+        finished = False  # Set once every file the finder had has been seen
+        if memory is not None:
+            memory.start()
         try:
-            for file_info in user_did_finder(did_info.did, info, self.app.did_finder_args):
-                acc.add(file_info)
-                if did_info.file_count == -1:
-                    acc.send_on(-1)  # if looking up full dataset, can send partial results
+            finder = user_did_finder(partition if partition is not None else did_info.did,
+                                     info, self._finder_args())
+            files = self._traced(finder) if tracing_enabled() else finder
+            enricher = getattr(self.app, "metadata_enricher", None)
+            if enricher is not None:
+                files = enricher.batches(self._normalized(files, summary, dataset_id))
+            cut_short = False
+            for file_info in files:
+                file_info = self._prepare_files(file_info, file_filter, summary, dataset_id,
+                                                normalize=enricher is None)
+                if file_info:
+                    acc.add(file_info)
+                    if not buffered:
+                        acc.send_on(-1)  # if looking up full dataset, can send partial results
 
-            if did_info.file_count > 0:  # otherwise wait until all files arrive then limit results
+                if deadline is not None and time.monotonic() > deadline:
+                    if did_info.get_mode != "available":
+                        raise TimeoutError(f"Lookup did not finish within {timeout} seconds")
+                    self.logger.warning(
+                        f"Lookup of {did} did not finish within {timeout} seconds - "
+                        f"sending the {summary.file_count + acc.cache_len} files found so far",
+                        extra={"dataset_id": dataset_id}
+                    )
+                    cut_short = True
+                    break
+
+            if buffered:  # otherwise wait until all files arrive then limit results
                 acc.send_on(did_info.file_count)
+            finished = not cut_short
+        except MemoryLimitExceeded as e:
+            self.logger.error(f"Stopped lookup of {did}: {e}", extra={"dataset_id": dataset_id})
+        except SoftTimeLimitExceeded:
+            self.logger.error(f"Lookup of {did} was interrupted by its time limit - the "
+                              f"finder stopped yielding files",
+                              extra={"dataset_id": dataset_id})
         except Exception:
             # noinspection PyTypeChecker
             self.logger.error(
@@ -110,16 +248,316 @@ class DIDFinderTask(Task):
                 exc_info=1
             )
         finally:
-            elapsed_time = int((datetime.now() - start_time).total_seconds())
-            servicex.put_fileset_complete(
-                {
-                    "files": summary.file_count,
-                    "files-skipped": summary.files_skipped,
-                    "total-events": summary.total_events,
-                    "total-bytes": summary.total_bytes,
-                    "elapsed-time": elapsed_time,
-                }
-            )
+            # Let the finder clean up (e.g. close catalog connections) if it was cut short
+            close = getattr(finder, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    self.logger.exception("Error closing the DID finder",
+                                          extra={"dataset_id": dataset_id})
+
+            acc.close()
+            if memory is not None:
+                memory.stop()
+                self.logger.info(f"Lookup of {did} held at most {acc.peak_bytes} bytes",
+                                 extra={"dataset_id": dataset_id})
+
+            result = self._finish_lookup(servicex, did, summary, start_time, partition,
+                                         finished=finished,
+                                         previous_digest=info.get("previous-fileset-digest"))
+        return result
+
+    def _finish_lookup(self, servicex: FileTransport, did: str, summary: DIDSummary,
+                       start_time: datetime, partition: Optional[str], finished: bool,
+                       previous_digest: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Complete the fileset of a whole lookup, or hand a part's summary to the chord
+        callback that completes it once every part is done
+        """
+        if partition is None:
+            elapsed = (datetime.now() - start_time).total_seconds()
+            self._complete_fileset(servicex, did, summary, elapsed, finished=finished,
+                                   previous_digest=previous_digest)
+            return None
+
+        servicex.close()
+        part_summary = dict(summary.to_dict(), finished=finished)
+        self.request.did_partition_summary = part_summary
+        return part_summary
+
+    def _complete_fileset(self, servicex: FileTransport, did: str, summary: DIDSummary,
+                          elapsed: float, finished: bool = True,
+                          previous_digest: Optional[str] = None):
+        """
+        Tell ServiceX the fileset is complete, and record how long the lookup took.
+        The fileset's digest is only sent if the lookup saw every file (it was not cut
+        short by an error or a timeout), so ServiceX can tell an unchanged dataset from
+        one that was only partly looked up. Likewise only the duration of a lookup that
+        finished says how long the next one will take.
+        """
+        router = getattr(self.app, "lookup_router", None)
+        if router is not None and finished:
+            router.record(did, elapsed)
+
+        complete = {
+            "files": summary.file_count,
+            "files-skipped": summary.files_skipped,
+            "total-events": summary.total_events,
+            "total-bytes": summary.total_bytes,
+            "elapsed-time": int(elapsed),
+            "file-stats": summary.distribution(),
+        }
+        if finished:
+            complete["fileset-digest"] = summary.digest
+        if previous_digest is not None:
+            complete["previous-fileset-digest"] = previous_digest
+        servicex.put_fileset_complete(complete)
+
+    def _split_lookup(self, did: str, dataset_id: int, endpoint: str,
+                      partitioner: DIDPartitioner) -> bool:
+        """
+        Dispatch a subtask for each part of the DID, and a chord callback to complete
+        the fileset once they are done
+        Returns:
+            False if the DID wasn't split and should be looked up here
+        """
+        try:
+            did_info = parse_did_uri(did)
+        except ValueError:
+            return False  # The lookup reports the bad DID to ServiceX
+        if did_info.file_count != -1 or did_info.event_count is not None:
+            return False  # Picking the first files needs the whole dataset in one place
+        if isinstance(self.app.backend, DisabledBackend):
+            self.logger.warning("Can't split lookups without a Celery result backend",
+                                extra={"dataset_id": dataset_id})
+            return False
+
+        try:
+            partitions = partitioner(did_info.did, {"dataset-id": dataset_id},
+                                     self._finder_args())
+        except Exception:
+            self.logger.exception(f"Error splitting DID {did} - looking it up in one piece",
+                                  extra={"dataset_id": dataset_id})
+            return False
+        if not partitions or len(partitions) < 2:
+            return False
+
+        kwargs = {"did": did, "dataset_id": dataset_id, "endpoint": endpoint}
+        # The parts and the chord callbacks go to the queue of this lookup, which the
+        # workers for this scheme consume - not Celery's default queue
+        options = {}
+        queue = getattr(self, "queue", None)
+        lane = getattr(self.request, "did_lane", None)
+        if lane is not None:
+            kwargs["did_lane"] = lane
+            queue = self.app.lane_queue(lane, self.did_scheme)
+        if queue is not None:
+            options["queue"] = queue
+
+        part_ids = [uuid() for _ in partitions]
+        parts = group(self.signature(kwargs=dict(kwargs, did_partition=p), task_id=part_id,
+                                     **options)
+                      for p, part_id in zip(partitions, part_ids))
+        started = time.time()
+        chord(parts)(self.app.finish_partitions.s(started=started, **kwargs)
+                     .set(**options)
+                     .on_error(self.app.fail_partitions.s(part_ids=part_ids,
+                                                          started=started, **kwargs)
+                               .set(**options)))
+        self.logger.info(f"Split DID request {did} into {len(partitions)} parts",
+                         extra={"dataset_id": dataset_id})
+        return True
+
+    def finish_partitions(self, summaries: List[Optional[Dict[str, Any]]], did: str,
+                          dataset_id: int, endpoint: str, started: float):
+        """
+        Merge the summaries of the parts of a split lookup, and tell ServiceX the fileset
+        is complete
+        Args:
+            summaries: What each part's subtask returned
+            did: The DID that was split
+            dataset_id: The dataset ID for the request
+            endpoint: The ServiceX endpoint to send the request to
+            started: When the lookup was split (seconds since the epoch)
+        """
+        summary = DIDSummary(did)
+        finished = True
+        for part in summaries:
+            if part is not None:
+                summary.merge(DIDSummary.from_dict(part))
+            finished = finished and part is not None and part.get("finished", True)
+
+        self.logger.info(f"All {len(summaries)} parts of DID request {did} are done",
+                         extra={"dataset_id": dataset_id})
+        servicex = self._file_transport(dataset_id, endpoint, lookup_id=self.request.id)
+        self._complete_fileset(servicex, did, summary, time.time() - started,
+                               finished=finished)
+
+    def fail_partitions(self, request, exc, traceback, part_ids: List[str], did: str,
+                        dataset_id: int, endpoint: str, started: float):
+        """
+        Complete the fileset of a split lookup whose chord failed, with the summaries of
+        the parts that did finish. The fileset isn't finished, so it gets no digest
+        Args:
+            request: The request of the failed chord callback
+            exc: Why the chord failed
+            traceback: Unused
+            part_ids: The task IDs of the parts
+            did: The DID that was split
+            dataset_id: The dataset ID for the request
+            endpoint: The ServiceX endpoint to send the request to
+            started: When the lookup was split (seconds since the epoch)
+        """
+        self.logger.error(f"Split DID request {did} failed: {exc!r}",
+                          extra={"dataset_id": dataset_id})
+        summaries = []
+        for part_id in part_ids:
+            result = self.app.AsyncResult(part_id)
+            summaries.append(result.result if result.successful() else None)
+        self.finish_partitions(summaries, did=did, dataset_id=dataset_id,
+                               endpoint=endpoint, started=started)
+
+    @staticmethod
+    def _traced(finder):
+        """
+        Pass on what the finder yields, recording a span for every FINDER_SPAN_FILES files
+        with the time spent waiting on the finder
+        """
+        tracer = get_tracer()
+        it = iter(finder)
+        chunk = 0
+        while True:
+            start_ns = time.time_ns()
+            busy_ns = 0
+            files = 0
+            done = False
+            while files < FINDER_SPAN_FILES:
+                t0 = time.time_ns()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    done = True
+                busy_ns += time.time_ns() - t0
+                if done:
+                    break
+                files += len(item) if isinstance(item, list) else 1
+                yield item
+
+            if files > 0 or chunk == 0:
+                tracer.record_span("finder.chunk", start_ns, time.time_ns(), {
+                    "chunk": chunk,
+                    "files": files,
+                    "finder_seconds": busy_ns / 1e9,
+                })
+            chunk += 1
+            if done:
+                return
+
+    def _finder_args(self) -> Optional[Dict[str, Any]]:
+        """
+        The arguments for the finder of this task's DID scheme
+        """
+        schemes = getattr(self.app, "schemes", None)
+        if self.did_scheme is not None and schemes is not None:
+            return schemes[self.did_scheme].did_finder_args
+        return self.app.did_finder_args
+
+    def _memory_limits(self) -> Optional[MemoryLimits]:
+        """
+        The memory limits for a lookup, or None if the app sets none
+        """
+        soft_limit = getattr(self.app, "memory_soft_limit", None)
+        hard_limit = getattr(self.app, "memory_hard_limit", None)
+        trace_allocations = getattr(self.app, "trace_allocations", False)
+        if soft_limit is None and hard_limit is None:
+            return None
+        return MemoryLimits(soft_limit, hard_limit, trace_allocations=trace_allocations)
+
+    def _file_transport(self, dataset_id: int, endpoint: str,
+                        lookup_id: Optional[str] = None) -> FileTransport:
+        """
+        How the files of this lookup get to ServiceX: published to the app's `file_queue`
+        if it has one, otherwise sent to the App's endpoint
+        """
+        file_queue = getattr(self.app, "file_queue", None)
+        if file_queue is not None:
+            return BrokerTransport(self.app, dataset_id, queue=file_queue, lookup_id=lookup_id)
+        if getattr(self.app, "streaming_upload", False):
+            return StreamingServiceXAdapter(dataset_id=dataset_id, endpoint=endpoint,
+                                            lookup_id=lookup_id)
+        if getattr(self.app, "compact_upload", False):
+            return ServiceXAdapter(dataset_id=dataset_id, endpoint=endpoint,
+                                   lookup_id=lookup_id, compact_paths=True)
+        return ServiceXAdapter(dataset_id=dataset_id, endpoint=endpoint, lookup_id=lookup_id)
+
+    def _lookup_timeout(self, did_info) -> Optional[float]:
+        """
+        Seconds this lookup may run, or None if there is no limit
+        """
+        limits = [t for t in (getattr(self.app, "lookup_timeout", None), did_info.timeout)
+                  if t is not None]
+        return min(limits) if limits else None
+
+    def _batch_transforms(self):
+        """
+        The stages, configured on the app, that each batch goes through before upload
+        """
+        transforms = []
+        replica_ranker = getattr(self.app, "replica_ranker", None)
+        if replica_ranker is not None:
+            transforms.append(replica_ranker)
+        path_rewriter = getattr(self.app, "path_rewriter", None)
+        if path_rewriter is not None:
+            transforms.append(path_rewriter)
+        return transforms
+
+    def _normalized(self, files, summary: DIDSummary, dataset_id: int):
+        """
+        Normalize what the finder yields, as a list of records for each thing it yields,
+        dropping the invalid ones
+        """
+        for file_info in files:
+            yield self._prepare_files(file_info if isinstance(file_info, list) else [file_info],
+                                      None, summary, dataset_id)
+
+    def _prepare_files(self, file_info, file_filter: Optional[FileFilter],
+                       summary: DIDSummary, dataset_id: int, normalize: bool = True):
+        """
+        Normalize what the finder yielded and drop the files that are invalid or do not
+        pass the DID's filter, counting them as skipped
+        Args:
+            file_info: A single file record or a list of them, as yielded by the finder
+            file_filter: The compiled filter for this DID, if there is one
+            summary: The summary to record skipped files in
+            dataset_id: The dataset ID for the request, for logging
+            normalize: False if the records have already been normalized
+        Returns:
+            The record (or None if dropped), or the list of records that were kept
+        """
+        single = not isinstance(file_info, list)
+        kept = [file_info] if single else file_info
+        if normalize:
+            kept, rejected = _normalizer(kept)
+            for record, reason in rejected:
+                summary.skip_file(record)
+                self.logger.warning(
+                    f"Skipping invalid file record ({reason}): {record}",
+                    extra={"dataset_id": dataset_id}
+                )
+
+        if file_filter is not None:
+            passed = []
+            for f in kept:
+                if file_filter(f):
+                    passed.append(f)
+                else:
+                    summary.skip_file(f)
+            kept = passed
+
+        if single:
+            return kept[0] if kept else None
+        return kept
 
 
 class DIDFinderApp(Celery):
@@ -129,26 +567,216 @@ class DIDFinderApp(Celery):
     """
     def __init__(self, did_finder_name: str,
                  did_finder_args: Optional[Dict[str, Any]] = None,
-                 *args, **kwargs):
+                 *args,
+                 path_rewriter: Optional[PathRewriter] = None,
+                 replica_ranker: Optional[ReplicaRanker] = None,
+                 lookup_timeout: Optional[float] = None,
+                 lookup_router: Optional[LookupRouter] = None,
+                 log_rate_limits: Optional[Dict[str, float]] = None,
+                 span_exporter=None,
+                 streaming_upload: bool = False,
+                 health_port: Optional[int] = None,
+                 health_dir: Optional[str] = None,
+                 max_concurrent: Optional[int] = None,
+                 memory_soft_limit: Optional[int] = None,
+                 memory_hard_limit: Optional[int] = None,
+                 trace_allocations: bool = False,
+                 file_queue: Optional[str] = None,
+                 metadata_enricher: Optional[MetadataEnricher] = None,
+                 compact_upload: bool = False,
+                 **kwargs):
         """
         Initialize the DID finder application
         Args:
             did_finder_name: The name of the DID finder.
             did_finder_args: The parsed command line arguments and other objects you want
-            to make available to the tasks
+            to make available to the tasks. Entries that are a `resources.ResourceFactory`
+            are built once in each worker process, before it runs its first task, and torn
+            down when the process shuts down.
+            path_rewriter: Rewrites the paths of every file before it is sent to ServiceX,
+            for example to route transformers through a caching proxy
+            replica_ranker: Reorders the replicas of every file so the best site is tried
+            first. Ranking is done before any path rewriting.
+            lookup_timeout: Most seconds a single lookup may run. A DID can ask for a
+            shorter limit with its `timeout` parameter. Both are checked each time the
+            finder yields a file; the app's limit is also enforced with a Celery soft time
+            limit, for finders that block.
+            lookup_router: Sends each lookup on to a fast or a bulk lane queue, based on
+            its estimated cost. See `lane_queue`.
+            log_rate_limits: Most log records per second to write for the named loggers
+            span_exporter: Turns on tracing of each lookup, sending the spans to this
+            exporter (e.g. a `tracing.FileSpanExporter`)
+            streaming_upload: Stream files to ServiceX as the finder yields them, over
+            one long-lived request per lookup. See `streaming.StreamingServiceXAdapter`.
+            health_port: Serve liveness, readiness and load on this port from the worker's
+            main process. See `health.HealthServer`.
+            health_dir: Where worker processes leave their load for the health server.
+            Defaults to a new temporary directory, made when the worker starts.
+            max_concurrent: Most lookups to run at once, across all worker processes.
+            Lookups over the limit are retried later.
+            memory_soft_limit: Bytes of files a lookup may hold in memory (while waiting
+            to pick the first N with `files=N`) before they are moved to disk
+            memory_hard_limit: Most bytes a lookup may use. A lookup that goes over is
+            stopped, and ServiceX is told its fileset is complete.
+            trace_allocations: Count everything a lookup allocates against
+            `memory_hard_limit`, not just the files it holds. See `memory.MemoryLimits`.
+            file_queue: Publish the files found to this queue on the broker (e.g.
+            `transport.FILE_QUEUE`) rather than sending them to the ServiceX App's
+            endpoint. See `transport.BrokerTransport`. Can't be combined with
+            `streaming_upload` or `compact_upload`, which only apply to the endpoint.
+            metadata_enricher: Fills in the sizes and event counts the finder left at
+            zero, before the DID's filter is applied. See `enrichment.MetadataEnricher`.
+            compact_upload: Send each batch of files to the App with a table of the common
+            prefixes of their paths, rather than repeating them for every file. The App
+            must support it. See `servicex_adaptor.ServiceXAdapter`.
         """
+        if file_queue is not None and (streaming_upload or compact_upload):
+            raise ValueError("file_queue publishes files to the broker, so it can't be used "
+                             "with streaming_upload or compact_upload")
 
         self.name = did_finder_name
-        initialize_root_logger(self.name)
+        initialize_root_logger(self.name, rate_limits=log_rate_limits)
+        if span_exporter is not None:
+            configure_tracing(span_exporter)
 
         super().__init__(f"did_finder_{self.name}", *args,
                          broker_connection_retry_on_startup=True,
                          **kwargs)
 
         # Cache the args in the App, so they are accessible to the tasks
-        self.did_finder_args = did_finder_args
+        self.schemes: Dict[str, DIDScheme] = {}
+        self.add_scheme(self.name, did_finder_args, max_concurrent=max_concurrent)
+        _apps.add(self)
 
-    def did_lookup_task(self, name):
+        self.finish_partitions = self.task(
+            base=DIDFinderTask, bind=True, name=f"did_finder_{self.name}.finish_partitions"
+        )(_finish_partitions)
+        self.fail_partitions = self.task(
+            base=DIDFinderTask, bind=True, name=f"did_finder_{self.name}.fail_partitions"
+        )(_fail_partitions)
+        self.path_rewriter = path_rewriter
+        self.replica_ranker = replica_ranker
+        self.lookup_timeout = lookup_timeout
+        self.lookup_router = lookup_router
+        self.streaming_upload = streaming_upload
+        self.memory_soft_limit = memory_soft_limit
+        self.memory_hard_limit = memory_hard_limit
+        self.trace_allocations = trace_allocations
+        self.file_queue = file_queue
+        self.metadata_enricher = metadata_enricher
+        self.compact_upload = compact_upload
+        self.health_port = health_port
+        self.health_dir = health_dir
+        self.health_server: Optional[HealthServer] = None
+        self._snapshot_writer: Optional[SnapshotWriter] = None
+
+    @property
+    def did_finder_args(self) -> Optional[Dict[str, Any]]:
+        """
+        The finder arguments, with resource factories built for the current process
+        """
+        return self.schemes[self.name].did_finder_args
+
+    @did_finder_args.setter
+    def did_finder_args(self, did_finder_args: Optional[Dict[str, Any]]):
+        self.add_scheme(self.name, did_finder_args,
+                        max_concurrent=self.schemes[self.name].max_concurrent)
+
+    def add_scheme(self, did_scheme: str, did_finder_args: Optional[Dict[str, Any]] = None,
+                   max_concurrent: Optional[int] = None) -> DIDScheme:
+        """
+        Serve another DID scheme from this app, sharing its worker processes. Register
+        the scheme's lookup task with `did_lookup_task(name, did_scheme=...)`. Its
+        lookups arrive on their own queue (`DIDScheme.queue`), so start the worker on
+        all of them, e.g. `celery -A my_finder worker -Q did_finder_rucio,did_finder_xrootd`.
+        Args:
+            did_scheme: The scheme, e.g. `xrootd`
+            did_finder_args: The arguments passed to the scheme's finder
+            max_concurrent: Most lookups of the scheme to run at once
+        Returns:
+            The scheme
+        """
+        scheme = DIDScheme(did_scheme, did_finder_args, max_concurrent=max_concurrent)
+        self.schemes[did_scheme] = scheme
+        return scheme
+
+    def warm_resources(self, **kwargs):
+        """
+        Build the finder's resources for this process. Connected to Celery's
+        `worker_process_init` signal, so each prefork worker process is ready before its
+        first task. With the solo or threads pool, they are built on the first lookup.
+        """
+        resources = [s.resources for s in self.schemes.values() if s.resources.has_factories]
+        if resources:
+            metrics = get_metrics()
+            metrics.resources_ready = False
+            for r in resources:
+                r.resolve()
+            metrics.resources_ready = True
+
+    def close_resources(self, **kwargs):
+        """
+        Tear down the finder's resources built in this process
+        """
+        for scheme in self.schemes.values():
+            scheme.resources.close()
+
+    def start_health_server(self, main_runs_tasks: bool = False) -> Optional[HealthServer]:
+        """
+        Start serving health and load on `health_port`, if it was given. Called in the
+        worker's main process when the worker starts, before it forks the worker
+        processes.
+        Args:
+            main_runs_tasks: The worker pool runs lookups in this process (e.g. `solo` or
+            `threads`), so its load counts. With the prefork pool only the worker
+            processes' load does, and the worker is not ready until one has started.
+        """
+        if self.health_port is None:
+            return None
+        if self.health_dir is None:
+            self.health_dir = tempfile.mkdtemp(prefix=f"did_finder_{self.name}_health_")
+        if main_runs_tasks:
+            self.write_load_snapshots()
+        self.health_server = HealthServer(self.health_dir,  # type: ignore
+                                          self.broker_connected, port=self.health_port)
+        self.health_server.start()
+        logging.getLogger(__name__).info(f"Serving health on port {self.health_port}")
+        return self.health_server
+
+    def write_load_snapshots(self):
+        """
+        Start leaving this process's load for the health server. Called in every worker
+        process.
+        """
+        if self.health_dir is not None:
+            self._snapshot_writer = SnapshotWriter(self.health_dir).start()
+
+    def stop_health(self):
+        "Stop the health server and the snapshots of this process"
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.stop()
+            self._snapshot_writer = None
+        if self.health_server is not None:
+            self.health_server.stop()
+            self.health_server = None
+
+    def broker_connected(self) -> bool:
+        "Check the broker can be reached"
+        with self.connection_for_read() as conn:
+            conn.ensure_connection(max_retries=1, timeout=5)
+        return True
+
+    def lane_queue(self, lane: str, did_scheme: Optional[str] = None) -> str:
+        """
+        The name of the Celery queue for a lane. Start a worker (with its own concurrency)
+        on each lane queue, e.g. `celery -A my_finder worker -Q did_finder_rucio_fast -c 4`.
+        Args:
+            lane: The lane, FAST_LANE or BULK_LANE
+            did_scheme: The DID scheme, if not the app's own
+        """
+        return f"did_finder_{did_scheme or self.name}_{lane}"
+
+    def did_lookup_task(self, name, did_scheme: Optional[str] = None):
         """
         Decorator to create a new task to handle a DID lookup request wihout
         needing to know about Celery tasks.
@@ -158,12 +786,106 @@ class DIDFinderApp(Celery):
                 self.do_lookup(did=did, dataset_id=dataset_id,
                                endpoint=endpoint, user_did_finder=find_files)
 
+        If the app has a `lookup_router`, a request that arrives on the task's usual queue
+        is not run. Instead it is re-sent to the queue of the lane the router picks, and
+        is run by the worker consuming that queue.
+
+        If the scheme already has `max_concurrent` lookups running, the request is
+        retried in a few seconds.
+
+        If the app has a `lookup_timeout`, the task gets a Celery soft time limit
+        `LOOKUP_TIMEOUT_GRACE` seconds longer, so a finder that blocks without yielding
+        is interrupted too. Time limits need a worker pool that supports them (e.g.
+        prefork).
+
         Args:
             name: The name of the task
+            did_scheme: The scheme the task looks up, added with `add_scheme`. Defaults
+            to the app's own.
         """
+        if did_scheme is not None and did_scheme not in self.schemes:
+            raise ValueError(f"Unknown DID scheme {did_scheme} - add it with add_scheme")
+        scheme = self.schemes[did_scheme or self.name]
+        options = {"did_scheme": did_scheme, "queue": scheme.queue}
+        if self.lookup_timeout is not None:
+            options["soft_time_limit"] = self.lookup_timeout + LOOKUP_TIMEOUT_GRACE
+
         def decorator(func):
-            @self.task(base=DIDFinderTask, bind=True, name=name)
+            @self.task(base=DIDFinderTask, bind=True, name=name, **options)
             def wrapper(*args, **kwargs):
-                return func(*args, **kwargs)
+                with log_scheme(scheme.name):
+                    return run(*args, **kwargs)
+
+            def run(*args, **kwargs):
+                task = args[0]
+                lane = kwargs.pop("did_lane", None)
+                partition = kwargs.pop("did_partition", None)
+                if lane is None and self.lookup_router is not None:
+                    did = kwargs["did"] if "did" in kwargs else args[1]
+                    lane = self.lookup_router.lane(did)
+                    task.logger.info(f"Routing DID request {did} to the {lane} lane")
+                    task.apply_async(args=args[1:], kwargs=dict(kwargs, did_lane=lane),
+                                     queue=self.lane_queue(lane, did_scheme))
+                    return None
+
+                if not scheme.try_acquire():
+                    task.logger.info(f"{scheme.max_concurrent} {scheme.name} lookups are "
+                                     f"already running - will retry")
+                    raise task.retry(countdown=SCHEME_BUSY_RETRY, max_retries=None)
+                try:
+                    task.request.did_lane = lane
+                    task.request.did_partition = partition
+                    result = func(*args, **kwargs)
+                finally:
+                    scheme.release()
+                if partition is not None:
+                    # The summary is needed by the chord callback, whatever func returns
+                    return getattr(task.request, "did_partition_summary", result)
+                return result
             return wrapper
         return decorator
+
+
+def _finish_partitions(task: DIDFinderTask, *args, **kwargs):
+    task.finish_partitions(*args, **kwargs)
+
+
+def _fail_partitions(task: DIDFinderTask, request, exc, traceback, **kwargs):
+    task.fail_partitions(request, exc, traceback, **kwargs)
+
+
+# Every DIDFinderApp, so each worker process can build and tear down their resources
+_apps: "weakref.WeakSet[DIDFinderApp]" = weakref.WeakSet()
+
+
+def _pool_forks(worker) -> bool:
+    "Whether the Celery worker runs its tasks in forked worker processes"
+    pool_cls = getattr(worker, "pool_cls", None) or "prefork"
+    return issubclass(get_implementation(pool_cls), PreforkPool)
+
+
+@worker_init.connect
+def _start_apps_health(sender=None, **kwargs):
+    main_runs_tasks = not _pool_forks(sender)
+    for app in list(_apps):
+        app.start_health_server(main_runs_tasks=main_runs_tasks)
+
+
+@worker_process_init.connect
+def _warm_apps_resources(**kwargs):
+    for app in list(_apps):
+        # The snapshot writer and health server threads did not survive the fork
+        app._snapshot_writer = None
+        app.health_server = None
+        app.warm_resources()
+        app.write_load_snapshots()
+
+
+@worker_process_shutdown.connect
+def _close_apps_resources(**kwargs):
+    for app in list(_apps):
+        app.stop_health()
+        app.close_resources()
+
+
+worker_shutdown.connect(_close_apps_resources)
@@ -1,5 +1,36 @@
+import atexit
+import contextlib
+import contextvars
+import copy
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Most log records waiting to be written. Past this, new records are dropped rather than
+# blocking the thread that logged them.
+LOG_QUEUE_SIZE = 10000
+
+# The DID scheme of the lookup being run, for apps that serve more than one
+_log_scheme: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "did_log_scheme", default=None)
+
+
+@contextlib.contextmanager
+def log_scheme(did_scheme: str):
+    """
+    Tag the records logged inside the block with this DID scheme, rather than the
+    app's own
+    """
+    token = _log_scheme.set(did_scheme)
+    try:
+        yield
+    finally:
+        _log_scheme.reset(token)
 
 
 class DIDFormatter(logging.Formatter):
@@ -10,6 +41,14 @@ class DIDFormatter(logging.Formatter):
     us pass in the dataset id and have that embedded in the log message
     """
 
+    def __init__(self, fmt: Optional[str] = None, did_scheme: Optional[str] = None):
+        """
+        :param fmt: The format string
+        :param did_scheme: The scheme for records not tagged with one (`didScheme`)
+        """
+        super().__init__(fmt)
+        self.did_scheme = did_scheme
+
     def format(self, record: logging.LogRecord) -> str:
         """
         Format record with request id if present, otherwise assume None
@@ -18,28 +57,197 @@ class DIDFormatter(logging.Formatter):
         :return: formatted log message
         """
 
-        if hasattr(record, "datasetId"):
-            return super().format(record)
-        else:
-            setattr(record, "datasetId", None)
-            return super().format(record)
+        if not hasattr(record, "datasetId"):
+            setattr(record, "datasetId", getattr(record, "dataset_id", None))
+        if getattr(record, "didScheme", None) is None:
+            setattr(record, "didScheme", self.did_scheme)
+        return super().format(record)
+
+
+class DIDJsonFormatter(logging.Formatter):
+    """
+    Format each record as a single line of JSON, for log collectors that parse it
+    """
+
+    def __init__(self, instance: str, did_scheme: str):
+        super().__init__()
+        self.instance = instance
+        self.did_scheme = did_scheme
+
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        :param record: LogRecord
+        :return: the record as a JSON object
+        """
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "instance": self.instance,
+            "component": f"{getattr(record, 'didScheme', None) or self.did_scheme}_did_finder",
+            "logger": record.name,
+            "datasetId": getattr(record, "datasetId", getattr(record, "dataset_id", None)),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LogRateLimiter(logging.Filter):
+    """
+    Limit how many records per second hot-path loggers can emit. `limits` maps a logger
+    name to the most records per second it (and its child loggers) may log; bursts of up
+    to one second's worth are let through. Warnings and errors are never limited. The
+    next record let through from a limited logger notes how many were dropped.
+    """
+
+    def __init__(self, limits: Dict[str, float]):
+        super().__init__()
+        self.limits = dict(limits)
+        self._buckets: Dict[str, Tuple[float, float, int]] = {}
+        self._lock = threading.Lock()
+
+    def _limit_for(self, name: str) -> Optional[Tuple[str, float]]:
+        while True:
+            if name in self.limits:
+                return name, self.limits[name]
+            if '.' not in name:
+                return None
+            name = name.rsplit('.', 1)[0]
 
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        limit = self._limit_for(record.name)
+        if limit is None:
+            return True
+        key, rate = limit
 
-def initialize_root_logger(did_scheme: str):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, dropped = self._buckets.get(key, (rate, now, 0))
+            tokens = min(rate, tokens + (now - last) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, dropped + 1)
+                return False
+            self._buckets[key] = (tokens - 1, now, 0)
+
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} similar messages dropped)"
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    "Queue the record for the writer thread, or drop it if the queue is full"
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the writer thread, which can't see the lookup's scheme
+        if getattr(record, "didScheme", None) is None:
+            record.didScheme = _log_scheme.get()
+        # QueueHandler.prepare formats the exception into the message and drops
+        # exc_info. Keep it instead, so the writer's formatter shows it its own way (the
+        # JSON formatter gives it its own field). The queue never leaves the process.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+_handler: Optional[_DroppingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_output: Optional[logging.Handler] = None
+# What the logging was set up with - the scheme, JSON format and rate limits
+_settings: Optional[Tuple[str, bool, Optional[Dict[str, float]]]] = None
+
+
+def _start_listener():
+    "(Re)start the background thread that writes queued records"
+    global _listener
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    _handler.queue = log_queue  # type: ignore
+    _listener = logging.handlers.QueueListener(log_queue, _output,  # type: ignore
+                                               respect_handler_level=True)
+    _listener.start()
+
+
+def _after_fork_in_child():
+    "The writer thread does not survive a fork (e.g. into a Celery prefork worker)"
+    if _handler is not None:
+        _start_listener()
+
+
+def shutdown_logging():
+    """
+    Write any queued records and stop the writer thread
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+atexit.register(shutdown_logging)
+
+
+def initialize_root_logger(did_scheme: str,
+                           json_format: Optional[bool] = None,
+                           rate_limits: Optional[Dict[str, float]] = None):
     """
     Get a logger and initialize it so that it outputs the correct format
+    Records are put on a queue and written to the console by a background thread, so
+    logging never blocks on a slow console. Calling this more than once does not add
+    more handlers, and logs a warning if the settings differ from the first call's.
     :param did_scheme: The scheme name to identify his did finder in log messages.
+    :param json_format: Write each record as a line of JSON. Defaults to True if the
+                        LOG_FORMAT environment variable is `json`.
+    :param rate_limits: Most records per second to let through for the named loggers,
+                        see `LogRateLimiter`
     :return: logger with correct formatting that outputs to console
     """
+    global _handler, _output, _settings
+
+    if json_format is None:
+        json_format = os.environ.get('LOG_FORMAT', '').lower() == 'json'
+    settings = (did_scheme, json_format, dict(rate_limits) if rate_limits else None)
 
     log = logging.getLogger()
+    if _handler is not None and _handler in log.handlers:
+        if settings != _settings:
+            logging.getLogger(__name__).warning(
+                f"Logging is already set up with (scheme, json_format, rate_limits) = "
+                f"{_settings} - ignoring {settings}")
+        return log
+
     instance = os.environ.get('INSTANCE_NAME', 'Unknown')
-    formatter = DIDFormatter('%(levelname)s ' +
-                             f"{instance} {did_scheme}_did_finder " +
-                             '%(datasetId)s %(message)s')
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
-    handler.setLevel(logging.INFO)
-    log.addHandler(handler)
+    if json_format:
+        formatter: logging.Formatter = DIDJsonFormatter(instance, did_scheme)
+    else:
+        formatter = DIDFormatter('%(levelname)s ' + f"{instance} " +
+                                 '%(didScheme)s_did_finder %(datasetId)s %(message)s',
+                                 did_scheme=did_scheme)
+
+    _output = logging.StreamHandler()
+    _output.setFormatter(formatter)
+    _output.setLevel(logging.INFO)
+
+    shutdown_logging()
+    _handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _handler.setLevel(logging.INFO)
+    if rate_limits:
+        _handler.addFilter(LogRateLimiter(rate_limits))
+    _start_listener()
+
+    log.addHandler(_handler)
     log.setLevel(logging.INFO)
+    _settings = settings
     return log
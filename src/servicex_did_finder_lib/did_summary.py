@@ -25,9 +25,174 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from collections import Counter
+import hashlib
+import math
+from typing import Any, Dict, Iterable, List, Optional
 
+# Quantiles reported for the file size and event distributions
+REPORTED_QUANTILES = (0.1, 0.5, 0.9, 0.99)
 
-from typing import Any, Dict
+# The fileset digest is the sum of the file digests, modulo this
+DIGEST_MODULUS = 2 ** 256
+
+
+def _file_paths(file_record: Dict[str, Any]) -> List[str]:
+    '''_file_paths The paths of a file, as a list even if a finder gave a single string'''
+    paths = file_record.get('paths') or []
+    if isinstance(paths, str):
+        return [paths]
+    return list(paths)
+
+
+def file_digest(file_record: Dict[str, Any]) -> int:
+    '''file_digest The SHA-256 of a file's paths (in sort order) and checksum, as a number'''
+    text = "\n".join(sorted(_file_paths(file_record))) + f"\n{file_record.get('adler32', 0)}"
+    return int.from_bytes(hashlib.sha256(text.encode()).digest(), "big")
+
+
+class QuantileSketch:
+    def __init__(self, relative_accuracy: float = 0.01):
+        '''__init__ Streaming, mergeable, estimate of a distribution
+
+        A log-bucketed histogram (as in DDSketch): every quantile it reports is within
+        `relative_accuracy` of the true value. Memory grows only with the log of the range
+        of the values, and two sketches with the same accuracy merge exactly, so merging
+        is associative and commutative.
+
+        Zero values (e.g. a size that is not known) are counted, but kept out of the
+        quantiles.
+
+        Args:
+            relative_accuracy (float): Relative accuracy of the reported quantiles
+        '''
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets: Counter = Counter()
+        self._zeros = 0
+        self._count = 0
+        self._sum = 0
+        self._min: Optional[float] = None
+        self._max: Optional[float] = None
+
+    @property
+    def count(self) -> int:
+        '''Number of non-zero values in the sketch'''
+        return self._count
+
+    @property
+    def zeros(self) -> int:
+        '''Number of zero values seen'''
+        return self._zeros
+
+    def add_many(self, values: Iterable[float]):
+        '''add_many Add a batch of values
+
+        Args:
+            values (Iterable[float]): Non-negative values to add
+        '''
+        log = math.log
+        ceil = math.ceil
+        log_gamma = self._log_gamma
+        values = list(values)
+        non_zero = [v for v in values if v > 0]
+        self._zeros += len(values) - len(non_zero)
+        if not non_zero:
+            return
+        self._buckets.update(ceil(log(v) / log_gamma) for v in non_zero)
+        self._count += len(non_zero)
+        self._sum += sum(non_zero)
+        low, high = min(non_zero), max(non_zero)
+        self._min = low if self._min is None else min(self._min, low)
+        self._max = high if self._max is None else max(self._max, high)
+
+    def add(self, value: float):
+        '''add Add a single value'''
+        self.add_many([value])
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        '''merge Fold another sketch into this one
+
+        Args:
+            other (QuantileSketch): Sketch with the same relative accuracy
+
+        Returns:
+            QuantileSketch: This sketch
+        '''
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Can only merge sketches with the same relative accuracy '
+                             f'({self.relative_accuracy} != {other.relative_accuracy})')
+        self._buckets.update(other._buckets)
+        self._zeros += other._zeros
+        self._count += other._count
+        self._sum += other._sum
+        if other._min is not None:
+            self._min = other._min if self._min is None else min(self._min, other._min)
+            self._max = other._max if self._max is None else max(self._max, other._max)
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        '''quantile Estimate a quantile of the non-zero values
+
+        Args:
+            q (float): The quantile, between 0 and 1
+
+        Returns:
+            Optional[float]: The estimate, or None if the sketch is empty
+        '''
+        if self._count == 0:
+            return None
+        if q <= 0:
+            return self._min
+        if q >= 1:
+            return self._max
+        rank = q * (self._count - 1)
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen > rank:
+                estimate = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(estimate, self._min), self._max)  # type: ignore
+        return self._max
+
+    def stats(self) -> Dict[str, Any]:
+        '''stats Summary of the distribution, suitable for sending as json'''
+        result: Dict[str, Any] = {
+            "count": self._count,
+            "unknown": self._zeros,
+            "min": self._min,
+            "max": self._max,
+            "mean": self._sum / self._count if self._count else None,
+        }
+        for q in REPORTED_QUANTILES:
+            value = self.quantile(q)
+            result[f"p{round(q * 100)}"] = None if value is None else round(value)
+        return result
+
+    def to_dict(self) -> Dict[str, Any]:
+        '''to_dict The full state of the sketch, suitable for sending as json'''
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "buckets": {str(k): v for k, v in self._buckets.items()},
+            "zeros": self._zeros,
+            "count": self._count,
+            "sum": self._sum,
+            "min": self._min,
+            "max": self._max,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'QuantileSketch':
+        '''from_dict Rebuild a sketch saved with `to_dict`'''
+        sketch = cls(data["relative_accuracy"])
+        sketch._buckets = Counter({int(k): v for k, v in data["buckets"].items()})
+        sketch._zeros = data["zeros"]
+        sketch._count = data["count"]
+        sketch._sum = data["sum"]
+        sketch._min = data["min"]
+        sketch._max = data["max"]
+        return sketch
 
 
 class DIDSummary:
@@ -35,7 +200,13 @@ class DIDSummary:
         '''__init__ Track files we are reporting back to the system
 
         Object that tracks statistics about the files we are injecting for processing
-        into Servicex.
+        into Servicex. As well as the totals it keeps sketches of the file size and
+        event count distributions, and the spread of the number of replicas per file.
+        Summaries can be merged, so lookups split over several workers can be combined.
+
+        It also keeps a digest of the files (their paths and checksums) that does not
+        depend on the order they were added in, so two lookups that found the same files
+        have the same digest.
 
         Args:
             did (string): The DID of the dataset we are tracking
@@ -45,6 +216,12 @@ class DIDSummary:
         self._total_events = 0
         self._files = 0
         self._files_skipped = 0
+        self._size_sketch = QuantileSketch()
+        self._events_sketch = QuantileSketch()
+        self._replicas_total = 0
+        self._replicas_min: Optional[int] = None
+        self._replicas_max: Optional[int] = None
+        self._digest = 0
 
     def __str__(self):
         return ("DID {} - {:.0f} Mb {} Events in {} files ({} skipped)".format(
@@ -54,6 +231,10 @@ class DIDSummary:
             self._files,
             self._files_skipped))
 
+    @property
+    def did(self) -> str:
+        return self._did
+
     @property
     def file_count(self) -> int:
         return self._files
@@ -70,20 +251,18 @@ class DIDSummary:
     def total_events(self) -> int:
         return self._total_events
 
-    def _accumulate(self, file_record: Dict[str, Any]):
-        '''accumulate Update statistics counters
-
-        Track total file size and events
+    @property
+    def digest(self) -> str:
+        '''Digest of the files added, as 64 hex digits'''
+        return f"{self._digest:064x}"
 
-        Args:
-            file_record (Dict[str, Any]): Statistics reported back from loading
-                                          a particular for.
-        '''
-        file_size_key = 'file_size' if 'file_size' in file_record else 'bytes'
-        file_events_key = 'file_events' if 'file_events' in file_record else 'events'
+    @property
+    def size_sketch(self) -> QuantileSketch:
+        return self._size_sketch
 
-        self._total_bytes += int(file_record[file_size_key] or 0)
-        self._total_events += int(file_record[file_events_key] or 0)
+    @property
+    def events_sketch(self) -> QuantileSketch:
+        return self._events_sketch
 
     def add_file(self, file_record: Dict[str, Any]):
         '''add_file Update all stats with new file
@@ -93,5 +272,120 @@ class DIDSummary:
         Args:
             file_record (Dict[str, Any]): Statistics for a particular file
         '''
-        self._files += 1
-        self._accumulate(file_record)
+        self.add_files([file_record])
+
+    def add_files(self, file_records: List[Dict[str, Any]]):
+        '''add_files Update all stats with a batch of files
+
+        Each column is pulled out of the batch once and the sketches are updated in
+        bulk, which is much cheaper than adding the files one at a time.
+
+        Args:
+            file_records (List[Dict[str, Any]]): Statistics for each file
+        '''
+        if not file_records:
+            return
+
+        sizes = [int((f['file_size'] if 'file_size' in f else f['bytes']) or 0)
+                 for f in file_records]
+        events = [int((f['file_events'] if 'file_events' in f else f['events']) or 0)
+                  for f in file_records]
+        replicas = [len(_file_paths(f)) for f in file_records]
+
+        self._files += len(file_records)
+        self._total_bytes += sum(sizes)
+        self._total_events += sum(events)
+        self._size_sketch.add_many(sizes)
+        self._events_sketch.add_many(events)
+        self._add_replicas(sum(replicas), min(replicas), max(replicas))
+        self._digest = (self._digest + sum(file_digest(f) for f in file_records)) \
+            % DIGEST_MODULUS
+
+    def _add_replicas(self, total: int, low: Optional[int], high: Optional[int]):
+        self._replicas_total += total
+        if low is not None:
+            self._replicas_min = low if self._replicas_min is None \
+                else min(self._replicas_min, low)
+            self._replicas_max = high if self._replicas_max is None \
+                else max(self._replicas_max, high)  # type: ignore
+
+    def merge(self, other: 'DIDSummary') -> 'DIDSummary':
+        '''merge Fold the stats of another summary into this one
+
+        Merging is associative and commutative, so partial summaries can be combined
+        in any order.
+
+        Args:
+            other (DIDSummary): Summary of another part of the same dataset
+
+        Returns:
+            DIDSummary: This summary
+        '''
+        self._files += other._files
+        self._files_skipped += other._files_skipped
+        self._total_bytes += other._total_bytes
+        self._total_events += other._total_events
+        self._size_sketch.merge(other._size_sketch)
+        self._events_sketch.merge(other._events_sketch)
+        self._add_replicas(other._replicas_total, other._replicas_min, other._replicas_max)
+        self._digest = (self._digest + other._digest) % DIGEST_MODULUS
+        return self
+
+    def distribution(self) -> Dict[str, Any]:
+        '''distribution Shape of the dataset, suitable for sending as json
+
+        Returns:
+            Dict[str, Any]: Quantiles of the file sizes and event counts, and the spread
+                            of the number of replicas per file
+        '''
+        return {
+            "file-size": self._size_sketch.stats(),
+            "file-events": self._events_sketch.stats(),
+            "replicas": {
+                "min": self._replicas_min,
+                "max": self._replicas_max,
+                "mean": self._replicas_total / self._files if self._files else None,
+            },
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        '''to_dict The full state of the summary, suitable for sending as json'''
+        return {
+            "did": self._did,
+            "files": self._files,
+            "files_skipped": self._files_skipped,
+            "total_bytes": self._total_bytes,
+            "total_events": self._total_events,
+            "size_sketch": self._size_sketch.to_dict(),
+            "events_sketch": self._events_sketch.to_dict(),
+            "replicas_total": self._replicas_total,
+            "replicas_min": self._replicas_min,
+            "replicas_max": self._replicas_max,
+            "digest": self.digest,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'DIDSummary':
+        '''from_dict Rebuild a summary saved with `to_dict`'''
+        summary = cls(data["did"])
+        summary._files = data["files"]
+        summary._files_skipped = data["files_skipped"]
+        summary._total_bytes = data["total_bytes"]
+        summary._total_events = data["total_events"]
+        summary._size_sketch = QuantileSketch.from_dict(data["size_sketch"])
+        summary._events_sketch = QuantileSketch.from_dict(data["events_sketch"])
+        summary._replicas_total = data["replicas_total"]
+        summary._replicas_min = data["replicas_min"]
+        summary._replicas_max = data["replicas_max"]
+        summary._digest = int(data["digest"], 16)
+        return summary
+
+    def skip_file(self, file_record: Dict[str, Any]):
+        '''skip_file Count a file that was found but not sent on
+
+        Skipped files are not included in the byte or event totals.
+
+        Args:
+            file_record (Dict[str, Any]): Statistics for the skipped file
+        '''
+        self._files_skipped += 1
@@ -0,0 +1,186 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import contextvars
+import inspect
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from servicex_did_finder_lib.record_validation import InvalidRecord, _to_count
+
+# Looks up the metadata of a file. Given the file's record, returns the fields it could
+# find (e.g. `{"file_size": 1200, "file_events": 5000}`). May be a coroutine function.
+MetadataResolver = Callable[[Dict[str, Any]], Any]
+
+# Fields that are filled in when they are missing (zero)
+ENRICHED_FIELDS = ('file_size', 'file_events')
+
+# Most files whose metadata is looked up at the same time
+MAX_WORKERS = 8
+
+# Most paths whose metadata is remembered, across lookups
+CACHE_SIZE = 100000
+
+
+class MetadataEnricher:
+    """
+    Fills in the `file_size` and `file_events` that a DID finder left at zero, by calling
+    a resolver (e.g. one that opens the file, or asks a slower catalog service). Up to
+    `max_workers` files are looked up at the same time. Each file is passed on as soon as
+    its lookup finishes, so the results come out in the order they finish, not the order
+    the finder yielded them. Files that need nothing are passed on straight away.
+
+    The fields found are cached by each of the file's paths, keeping the most recently
+    used `cache_size` paths, so a file that shows up in more than one lookup, even with
+    other replicas, is only resolved once. If the resolver fails the file is passed on as it was.
+    """
+
+    def __init__(self, resolver: MetadataResolver, max_workers: int = MAX_WORKERS,
+                 cache_size: int = CACHE_SIZE,
+                 fields: Tuple[str, ...] = ENRICHED_FIELDS):
+        """
+        :param resolver: Looks up the metadata of a single file
+        :param max_workers: Most files to look up at the same time
+        :param cache_size: Most paths whose metadata is remembered
+        :param fields: The fields to fill in when they are zero
+        """
+        self.resolver = resolver
+        self.max_workers = max(1, max_workers)
+        self.cache_size = cache_size
+        self.fields = fields
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def needs(self, record: Dict[str, Any]) -> bool:
+        "True if the record is missing any of the fields"
+        return any(not record.get(f) for f in self.fields)
+
+    def __call__(self, records: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Enrich a stream of normalized file records
+        :param records: The records, e.g. as yielded by a DID finder
+        :return: The records with what could be found filled in, as they are ready
+        """
+        for batch in self.batches([r] for r in records):
+            yield from batch
+
+    def batches(self, batches: Iterable[List[Dict[str, Any]]]) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Enrich a stream of batches of normalized file records, keeping them in batches so
+        they can be sent on together. After each batch comes in, the records that needed
+        nothing, those found in the cache and those whose lookup has finished are passed
+        on as one batch.
+        :param batches: Lists of records, e.g. as yielded by a DID finder
+        :return: Lists of records with what could be found filled in, as they are ready
+        """
+        executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="did-enrich")
+        pending: Set[Future] = set()
+        try:
+            for batch in batches:
+                ready = []
+                for record in batch:
+                    if not self.needs(record):
+                        ready.append(record)
+                        continue
+                    cached = self._cached(record)
+                    if cached is not None:
+                        ready.append(dict(record, **cached))
+                        continue
+
+                    # Hold at most a couple of files per worker waiting to be looked up
+                    if len(pending) >= 2 * self.max_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        ready.extend(f.result() for f in done)
+                    pending.add(executor.submit(contextvars.copy_context().run,
+                                                self._resolve, record))
+
+                done = {f for f in pending if f.done()}
+                pending -= done
+                ready.extend(f.result() for f in done)
+                if ready:
+                    yield ready
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield [f.result() for f in done]
+        finally:
+            # Don't wait for lookups that are no longer wanted (e.g. the lookup timed out)
+            for f in pending:
+                f.cancel()
+            executor.shutdown(wait=False)
+
+    def _resolve(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            found = self.resolver(record)
+            if inspect.isawaitable(found):
+                found = asyncio.run(found)
+        except Exception:
+            self.logger.warning(f"Could not look up the metadata of {record['paths']}",
+                                exc_info=True)
+            return record
+
+        if not isinstance(found, dict):
+            found = {}
+        filled = {}
+        for field in self.fields:
+            value = found.get(field)
+            if value and not record.get(field):
+                # The record has already been normalized, so check what was found the same way
+                try:
+                    filled[field] = _to_count(value)
+                except InvalidRecord:
+                    self.logger.warning(f"Ignoring bad {field} ({value!r}) found for "
+                                        f"{record['paths']}")
+        self._store(record, filled)
+        return dict(record, **filled)
+
+    def _cached(self, record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # Any replica will do, so a file that gained or lost a replica is still found
+        with self._lock:
+            for path in record['paths']:
+                filled = self._cache.get(path)
+                if filled is not None:
+                    self._cache.move_to_end(path)
+                    return filled
+            return None
+
+    def _store(self, record: Dict[str, Any], filled: Dict[str, Any]):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            for path in record['paths']:
+                self._cache[path] = filled
+                self._cache.move_to_end(path)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
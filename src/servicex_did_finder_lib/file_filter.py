@@ -0,0 +1,143 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import fnmatch
+import hashlib
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from servicex_did_finder_lib.util_uri import ParsedDIDInfo
+
+
+class FileFilter:
+    """
+    Predicate built from the filter parameters of a DID (`path`, `path_regex`, `min_size`,
+    `max_size`, `min_events` and `sample`). The checks are compiled once, when the filter is
+    created, so testing a record is cheap.
+
+    The filter is handed to the user DID finder in the `info` dictionary as `file-filter`.
+    Finders that can apply the criteria upstream (e.g. in a catalog query) can read the
+    public attributes and avoid yielding files that will be dropped. The library applies the
+    filter again regardless, so finders that ignore it still produce correct results.
+
+    A file whose size (or event count) is unknown, and so reported as zero, will never pass
+    a `min_size` (or `min_events`) bound.
+
+    Whether a file is in a `sample` depends only on its path (the first in sort order, so
+    the order of the replicas doesn't matter): the same files are picked on every run, and
+    each one is decided as it arrives.
+    """
+
+    def __init__(self, path_glob: Optional[str] = None,
+                 path_regex: Optional[str] = None,
+                 min_size: Optional[int] = None,
+                 max_size: Optional[int] = None,
+                 min_events: Optional[int] = None,
+                 sample: Optional[float] = None):
+        self.path_glob = path_glob
+        self.path_regex = path_regex
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_events = min_events
+        self.sample = sample
+
+        self._checks: List[Callable[[Dict[str, Any]], bool]] = []
+        if path_glob is not None:
+            self._checks.append(self._path_check(re.compile(fnmatch.translate(path_glob)).match))
+        if path_regex is not None:
+            self._checks.append(self._path_check(re.compile(path_regex).search))
+        if min_size is not None:
+            self._checks.append(lambda f: _file_size(f) >= min_size)
+        if max_size is not None:
+            self._checks.append(lambda f: _file_size(f) <= max_size)
+        if min_events is not None:
+            self._checks.append(lambda f: _file_events(f) >= min_events)
+        if sample is not None and sample < 1:
+            self._checks.append(lambda f: _sample_point(f) < sample)
+
+    @classmethod
+    def from_did_info(cls, did_info: ParsedDIDInfo) -> Optional["FileFilter"]:
+        """
+        Build the filter for a parsed DID
+        :param did_info: The parsed DID
+        :return: The filter, or None if the DID does not ask for any filtering
+        """
+        f = cls(path_glob=did_info.path_glob,
+                path_regex=did_info.path_regex,
+                min_size=did_info.min_size,
+                max_size=did_info.max_size,
+                min_events=did_info.min_events,
+                sample=did_info.sample)
+        return f if f._checks else None
+
+    @staticmethod
+    def _path_check(matcher: Callable[[str], Any]) -> Callable[[Dict[str, Any]], bool]:
+        return lambda f: any(matcher(p) for p in _file_paths(f))
+
+    def __call__(self, file_info: Dict[str, Any]) -> bool:
+        """
+        Test a single file record
+        :param file_info: The file record as yielded by the DID finder
+        :return: True if the file should be kept
+        """
+        return all(check(file_info) for check in self._checks)
+
+    def filter_batch(self, file_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Select the records of a batch that pass the filter
+        :param file_list: The file records to test
+        :return: The records that should be kept, in their original order
+        """
+        return [f for f in file_list if self(f)]
+
+
+def _file_paths(file_info: Dict[str, Any]) -> List[str]:
+    paths = file_info.get('paths') or []
+    return [paths] if isinstance(paths, str) else paths
+
+
+def _file_size(file_info: Dict[str, Any]) -> int:
+    return int(file_info.get('file_size', file_info.get('bytes')) or 0)
+
+
+def _file_events(file_info: Dict[str, Any]) -> int:
+    return int(file_info.get('file_events', file_info.get('events')) or 0)
+
+
+def file_name(file_info: Dict[str, Any]) -> str:
+    """
+    The name of a file - the last part of its paths - which stays the same when replicas
+    of the file are added or removed
+    """
+    names = [p.rstrip('/').rsplit('/', 1)[-1] for p in _file_paths(file_info)]
+    return min(names) if names else ""
+
+
+def _sample_point(file_info: Dict[str, Any]) -> float:
+    "Where the file falls in [0, 1), the same for every run and whatever its replicas"
+    digest = hashlib.sha1(file_name(file_info).encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64
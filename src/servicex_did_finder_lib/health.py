@@ -0,0 +1,359 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from servicex_did_finder_lib.circuit_breaker import CLOSED, circuit_states
+
+# Seconds of history behind the rates
+RATE_WINDOW = 60
+
+
+class LoadMetrics:
+    """
+    Counters describing the load on this process: lookups running, files sent, bytes
+    waiting to be uploaded, and requests to the ServiceX App that failed. Rates are over
+    the last RATE_WINDOW seconds. Snapshots also count the circuits to an App that are
+    not closed (see `circuit_breaker`).
+    """
+
+    def __init__(self, window: int = RATE_WINDOW, clock: Callable[[], float] = time.monotonic):
+        """
+        :param window: Seconds of history behind the rates
+        :param clock: Source of the current time, in seconds
+        """
+        self.window = window
+        self.clock = clock
+        self.resources_ready = True
+
+        self._lock = threading.Lock()
+        self._active_lookups = 0
+        self._queued_bytes = 0
+        # Per second: [files sent, requests to the App, failed requests]
+        self._seconds: Dict[int, List[int]] = {}
+
+    def _bucket(self) -> List[int]:
+        "The counts for the current second. Call with the lock held."
+        now = int(self.clock())
+        bucket = self._seconds.get(now)
+        if bucket is None:
+            bucket = self._seconds[now] = [0, 0, 0]
+            for second in [s for s in self._seconds if s <= now - self.window]:
+                del self._seconds[second]
+        return bucket
+
+    def lookup_started(self):
+        with self._lock:
+            self._active_lookups += 1
+
+    def lookup_finished(self):
+        with self._lock:
+            self._active_lookups -= 1
+
+    def upload_queued(self, n_bytes: int):
+        with self._lock:
+            self._queued_bytes += n_bytes
+
+    def upload_finished(self, n_bytes: int, files_sent: int):
+        """
+        :param n_bytes: The size of the upload, as given to `upload_queued`
+        :param files_sent: Files the App accepted
+        """
+        with self._lock:
+            self._queued_bytes -= n_bytes
+            self._bucket()[0] += files_sent
+
+    def app_request(self, ok: bool):
+        """
+        Count a request to the ServiceX App
+        :param ok: False if it failed or the App turned it away
+        """
+        with self._lock:
+            bucket = self._bucket()
+            bucket[1] += 1
+            if not ok:
+                bucket[2] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        :return: The current state, suitable for sending as json
+        """
+        with self._lock:
+            self._bucket()
+            files, requests, errors = (sum(c[i] for c in self._seconds.values())
+                                       for i in range(3))
+            return {
+                "pid": os.getpid(),
+                "time": time.time(),
+                "resources_ready": self.resources_ready,
+                "active_lookups": self._active_lookups,
+                "queued_upload_bytes": self._queued_bytes,
+                "files_per_second": files / self.window,
+                "app_requests": requests,
+                "app_errors": errors,
+                "open_circuits": sum(1 for state in circuit_states().values()
+                                     if state != CLOSED),
+            }
+
+
+metrics = LoadMetrics()
+
+
+def _reset_metrics_in_child():
+    "A forked worker process starts with nothing running"
+    global metrics
+    metrics = LoadMetrics()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_metrics_in_child)
+
+
+def get_metrics() -> LoadMetrics:
+    """
+    The metrics of this process
+    """
+    return metrics
+
+
+class SnapshotWriter:
+    """
+    Write this process's metrics to `<directory>/<pid>.json` every `interval` seconds, so
+    the health server, which runs in another process, can add them up. Celery's prefork
+    worker processes each run one.
+    """
+
+    def __init__(self, directory: str, interval: float = 5.0):
+        """
+        :param directory: Where the snapshots of all processes are kept
+        :param interval: Seconds between snapshots
+        """
+        self.directory = directory
+        self.interval = interval
+        self.path = os.path.join(directory, f"{os.getpid()}.json")
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def write(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(get_metrics().snapshot(), f)
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.write()
+            except OSError:
+                logging.getLogger(__name__).exception("Could not write metrics snapshot")
+            self._stop.wait(self.interval)
+
+    def start(self) -> "SnapshotWriter":
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="metrics_snapshot",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def read_snapshots(directory: str, max_age: float) -> List[Dict[str, Any]]:
+    """
+    The snapshots of the processes that have written one in the last `max_age` seconds
+    """
+    snapshots = []
+    now = time.time()
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if now - snapshot.get("time", 0) <= max_age:
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def summarize(snapshots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Add up the snapshots of all the worker processes
+    """
+    requests = sum(s["app_requests"] for s in snapshots)
+    errors = sum(s["app_errors"] for s in snapshots)
+    return {
+        "processes": len(snapshots),
+        "resources_ready": all(s["resources_ready"] for s in snapshots),
+        "active_lookups": sum(s["active_lookups"] for s in snapshots),
+        "queued_upload_bytes": sum(s["queued_upload_bytes"] for s in snapshots),
+        "files_per_second": sum(s["files_per_second"] for s in snapshots),
+        "app_requests": requests,
+        "app_errors": errors,
+        "app_error_rate": errors / requests if requests else 0.0,
+        "open_circuits": sum(s.get("open_circuits", 0) for s in snapshots),
+    }
+
+
+class HealthServer:
+    """
+    A small HTTP server reporting on a DID finder, for probes and autoscalers:
+
+    * `GET /healthz` - liveness. Always 200 while the process is serving.
+    * `GET /readyz` - readiness. 200 if the broker can be reached and every worker
+      process has built its resources, otherwise 503.
+    * `GET /metrics` - the load, in Prometheus text format
+    * `GET /status` - readiness and load as JSON
+
+    The load is added up from the snapshots worker processes write to `snapshot_dir`
+    (see `SnapshotWriter`). Answering a scrape only reads those files, and the broker is
+    checked at most every `broker_check_interval` seconds.
+    """
+
+    def __init__(self, snapshot_dir: str, broker_check: Callable[[], bool],
+                 host: str = "0.0.0.0", port: int = 8080,
+                 broker_check_interval: float = 10.0, snapshot_max_age: float = 15.0):
+        """
+        :param snapshot_dir: Where the worker processes write their snapshots
+        :param broker_check: Returns True if the broker can be reached
+        :param host: Interface to listen on
+        :param port: Port to listen on. Zero picks a free port.
+        :param broker_check_interval: Seconds to reuse the result of a broker check
+        :param snapshot_max_age: Snapshots older than this are from processes that are gone
+        """
+        self.snapshot_dir = snapshot_dir
+        self.broker_check = broker_check
+        self.broker_check_interval = broker_check_interval
+        self.snapshot_max_age = snapshot_max_age
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+        self._broker_ok = False
+        self._broker_checked: Optional[float] = None
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "HealthServer":
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={"poll_interval": 0.05},
+                                        name="health_server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "HealthServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def broker_ok(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self._broker_checked is None or \
+                    now - self._broker_checked >= self.broker_check_interval:
+                try:
+                    self._broker_ok = bool(self.broker_check())
+                except Exception:
+                    self.logger.exception("Broker check failed")
+                    self._broker_ok = False
+                self._broker_checked = now
+            return self._broker_ok
+
+    def status(self) -> Dict[str, Any]:
+        load = summarize(read_snapshots(self.snapshot_dir, self.snapshot_max_age))
+        broker_ok = self.broker_ok()
+        return dict(load, broker_connected=broker_ok,
+                    ready=broker_ok and load["processes"] > 0 and load["resources_ready"])
+
+    @staticmethod
+    def prometheus(status: Dict[str, Any]) -> str:
+        lines = []
+        for name in ("ready", "broker_connected", "processes", "active_lookups",
+                     "queued_upload_bytes", "files_per_second", "app_requests",
+                     "app_errors", "app_error_rate", "open_circuits"):
+            lines.append(f"did_finder_{name} {float(status[name])}")
+        return "\n".join(lines) + "\n"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status: int, body: str, content_type: str):
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                path = self.path.split("?")[0].rstrip("/")
+                if path == "/healthz":
+                    self._send(200, "ok\n", "text/plain")
+                elif path == "/readyz":
+                    status = server.status()
+                    self._send(200 if status["ready"] else 503,
+                               json.dumps(status), "application/json")
+                elif path == "/metrics":
+                    self._send(200, server.prometheus(server.status()),
+                               "text/plain; version=0.0.4")
+                elif path == "/status":
+                    self._send(200, json.dumps(server.status()), "application/json")
+                else:
+                    self._send(404, "", "text/plain")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,208 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+
+def _decode_files(headers: Dict[str, str], body: bytes) -> List[Dict[str, Any]]:
+    "The files of a `PUT /<dataset_id>/files` request, with full paths"
+    files = json.loads(body)
+    if headers.get("X-Path-Encoding") != "prefix-table":
+        return files
+    prefixes = files["prefixes"]
+    return [dict(f, paths=[prefixes[index] + rest for index, rest in f["paths"]])
+            for f in files["files"]]
+
+
+class LocalServiceX:
+    """
+    A stand-in for the ServiceX App's DID endpoints, for tests and offline benchmarks.
+    It runs an HTTP server on a background thread and keeps everything it is sent:
+
+    * `PUT /<dataset_id>/files` - a JSON list of files, added to `files[dataset_id]`. With
+      an `X-Path-Encoding: prefix-table` header the body is `{"prefixes", "files"}`
+      instead, and the paths are joined back to their prefixes.
+    * `PUT /<dataset_id>/complete` - the fileset summary, stored in `complete[dataset_id]`
+    * `PUT /<dataset_id>/files/stream` - newline-delimited JSON files, usually sent with
+      chunked transfer encoding. Files whose `seq` has already been seen for the request's
+      `X-Lookup-Id` are dropped. The answer is `{"acknowledged": <highest seq seen>}`.
+
+    Use it as a context manager, and point the `ServiceXAdapter` at `endpoint`.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, response_delay: float = 0.0,
+                 fail_stream_after: Optional[int] = None):
+        """
+        :param host: Interface to listen on
+        :param port: Port to listen on. Zero picks a free port.
+        :param response_delay: Seconds to wait before answering each request, to mimic a
+                               loaded App
+        :param fail_stream_after: Drop the connection of the first file stream after
+                                  this many files, to test recovery
+        """
+        self.response_delay = response_delay
+        self.fail_stream_after = fail_stream_after
+        self._stream_seen: Dict[Tuple[str, str], Set[int]] = {}
+        self.files: Dict[str, List[Dict[str, Any]]] = {}
+        self.complete: Dict[str, Dict[str, Any]] = {}
+        self.requests: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        "The URL to give the ServiceXAdapter"
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def file_count(self, dataset_id) -> int:
+        with self._lock:
+            return len(self.files.get(str(dataset_id), []))
+
+    def start(self) -> "LocalServiceX":
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={"poll_interval": 0.05},
+                                        name="local_servicex", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "LocalServiceX":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def _record(self, dataset_id: str, action: str, headers: Dict[str, str], body: bytes):
+        "Store a request. Returns the HTTP status to answer with."
+        with self._lock:
+            self.requests.append({"dataset_id": dataset_id, "action": action,
+                                  "headers": headers, "bytes": len(body),
+                                  "time": time.monotonic()})
+            if action == "files":
+                self.files.setdefault(dataset_id, []).extend(_decode_files(headers, body))
+            elif action == "complete":
+                self.complete[dataset_id] = json.loads(body)
+            else:
+                return 404
+        return 200
+
+    def _stream_record(self, dataset_id: str, lookup_id: str, record: Dict[str, Any]) -> int:
+        "Store a streamed file unless it is a duplicate. Returns its sequence number."
+        seq = int(record.get("seq", -1))
+        with self._lock:
+            seen = self._stream_seen.setdefault((dataset_id, lookup_id), set())
+            if seq < 0 or seq not in seen:
+                seen.add(seq)
+                self.files.setdefault(dataset_id, []).append(record)
+        return seq
+
+    def _take_stream_failure(self) -> Optional[int]:
+        with self._lock:
+            fail_after, self.fail_stream_after = self.fail_stream_after, None
+            return fail_after
+
+    def _handler_class(self):
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _chunks(self) -> Iterator[bytes]:
+                if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+                    yield self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    return
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return
+                    yield self.rfile.read(size)
+                    self.rfile.read(2)
+
+            def _stream(self, dataset_id: str):
+                lookup_id = self.headers.get("X-Lookup-Id", "")
+                fail_after = sink._take_stream_failure()
+                received = 0
+                acknowledged = -1
+                pending = b""
+                with sink._lock:
+                    sink.requests.append({"dataset_id": dataset_id, "action": "stream",
+                                          "headers": dict(self.headers), "bytes": 0,
+                                          "time": time.monotonic()})
+                for chunk in self._chunks():
+                    pending += chunk
+                    *lines, pending = pending.split(b"\n")
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        if fail_after is not None and received >= fail_after:
+                            self.close_connection = True
+                            return
+                        acknowledged = max(acknowledged, sink._stream_record(
+                            dataset_id, lookup_id, json.loads(line)))
+                        received += 1
+
+                body = json.dumps({"acknowledged": acknowledged}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_PUT(self):
+                parts = self.path.strip("/").split("/")
+                if len(parts) == 3 and parts[1:] == ["files", "stream"]:
+                    self._stream(parts[0])
+                    return
+
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if sink.response_delay:
+                    time.sleep(sink.response_delay)
+                status = sink._record(parts[0], parts[-1] if len(parts) == 2 else "",
+                                      dict(self.headers), body)
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,146 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import tempfile
+import threading
+import tracemalloc
+from typing import Any, Dict, Iterator, Optional
+
+# Rough bytes Python needs for a file record, on top of the length of its paths
+RECORD_OVERHEAD = 600
+
+
+def record_bytes(file_info: Dict[str, Any]) -> int:
+    """
+    Estimate the memory held by a file record
+    :param file_info: The record
+    """
+    paths = file_info.get("paths") or []
+    if isinstance(paths, str):
+        return RECORD_OVERHEAD + len(paths)
+    # A path split by a `path_prefixes.PrefixTable` is a (prefix index, rest) pair
+    return RECORD_OVERHEAD + sum(len(p) + 50 if isinstance(p, str) else len(p[1]) + 110
+                                 for p in paths)
+
+
+class MemoryLimitExceeded(RuntimeError):
+    "A lookup needed more memory than its hard limit allows"
+
+
+# Lookups in this process that are tracing allocations, and whether tracing was started
+# for them (rather than already being on)
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_started = False
+
+
+class MemoryLimits:
+    """
+    Memory limits for a single lookup. Above the soft limit, the `Accumulator` moves the
+    files it is holding to disk. Above the hard limit, the lookup fails (and ServiceX is
+    told the fileset is complete) rather than the worker being killed.
+
+    The memory a lookup uses is the size of the files the accumulator holds. With
+    `trace_allocations`, it is also checked against everything allocated in the process
+    since the lookup started (via `tracemalloc`, which slows Python down somewhat). That
+    is only a good measure when each worker process runs one lookup at a time, as with
+    the prefork pool.
+    """
+
+    def __init__(self, soft_limit: Optional[int] = None, hard_limit: Optional[int] = None,
+                 trace_allocations: bool = False, spill_dir: Optional[str] = None):
+        """
+        :param soft_limit: Bytes of files to hold in memory before moving them to disk
+        :param hard_limit: Most bytes the lookup may use
+        :param trace_allocations: Also count all allocations made since `start`
+        :param spill_dir: Where to write files moved to disk. Defaults to the system's
+                          temporary directory.
+        """
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.trace_allocations = trace_allocations
+        self.spill_dir = spill_dir
+        self._baseline: Optional[int] = None
+
+    def start(self):
+        "Start measuring the lookup's allocations, if tracing is on"
+        global _tracing_users, _tracing_started
+        if not self.trace_allocations or self._baseline is not None:
+            return
+        with _tracing_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing_started = True
+            _tracing_users += 1
+            self._baseline = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        "Stop measuring. Tracing is turned off when no lookup needs it."
+        global _tracing_users, _tracing_started
+        if self._baseline is None:
+            return
+        with _tracing_lock:
+            self._baseline = None
+            _tracing_users -= 1
+            if _tracing_users == 0 and _tracing_started:
+                tracemalloc.stop()
+                _tracing_started = False
+
+    def allocated(self) -> int:
+        "Bytes allocated in the process since `start` and still held, or 0 if not tracing"
+        if self._baseline is None or not tracemalloc.is_tracing():
+            return 0
+        return max(0, tracemalloc.get_traced_memory()[0] - self._baseline)
+
+
+class SpillFile:
+    """
+    A sorted run of file records, kept on disk until they are sent. Values JSON can't hold
+    (e.g. a datetime a metadata enricher added) come back as strings.
+    """
+
+    def __init__(self, records, directory: Optional[str] = None):
+        """
+        :param records: The records, already in the order they should be read back
+        :param directory: Where to make the file
+        """
+        self._file = tempfile.TemporaryFile("w+", dir=directory, prefix="did_spill_")
+        self.count = 0
+        for r in records:
+            self._file.write(json.dumps(r, default=str))
+            self._file.write("\n")
+            self.count += 1
+        self._file.flush()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        self._file.seek(0)
+        for line in self._file:
+            yield json.loads(line)
+
+    def close(self):
+        self._file.close()
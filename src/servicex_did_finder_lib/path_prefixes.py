@@ -0,0 +1,95 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from typing import Any, Dict, List, Sequence, Tuple, Union
+
+# A path split into the index of its prefix in a `PrefixTable` and the rest of it
+SplitPath = Tuple[int, str]
+
+# Shortest prefix worth sharing in memory. Below this the split path takes more room than
+# the whole one.
+MIN_SHARED_PREFIX = 64
+
+
+class PrefixTable:
+    """
+    The replicas of the files in a dataset share long prefixes (e.g.
+    `root://site.domain:1094//pnfs/site.domain/atlas/rucio/scope/`). A table stores each
+    distinct prefix (everything up to and including the last `/` of a path) once, so a
+    path can be kept, or sent, as the index of its prefix and the rest of the path.
+    """
+
+    def __init__(self):
+        self.prefixes: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.prefixes)
+
+    def split(self, path: str) -> SplitPath:
+        """
+        :param path: A full path
+        :return: The index of its prefix in the table (added if it is new), and the rest
+        """
+        cut = path.rfind('/') + 1
+        prefix = path[:cut]
+        index = self._index.get(prefix)
+        if index is None:
+            index = self._index[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+        return index, path[cut:]
+
+    def join(self, path: Union[str, Sequence]) -> str:
+        """
+        :param path: A path from `split` (or a list, after a trip through JSON), or a
+                     full path
+        :return: The full path
+        """
+        if isinstance(path, str):
+            return path
+        index, rest = path
+        return self.prefixes[index] + rest
+
+    def compact(self, file_info: Dict[str, Any],
+                min_prefix: int = MIN_SHARED_PREFIX) -> Dict[str, Any]:
+        """
+        A copy of a file record that shares the prefixes of its paths with every other
+        record compacted by this table. Paths with shorter prefixes are kept whole.
+        :param file_info: The record, with `paths` a list of full paths
+        :param min_prefix: The shortest prefix to share
+        """
+        paths = tuple(self.split(p) if p.rfind('/') + 1 >= min_prefix else p
+                      for p in file_info['paths'])
+        return dict(file_info, paths=paths)
+
+    def expand(self, file_info: Dict[str, Any]) -> Dict[str, Any]:
+        "The record, with full paths, that was given to `compact`"
+        return dict(file_info, paths=self.full_paths(file_info))
+
+    def full_paths(self, file_info: Dict[str, Any]) -> List[str]:
+        "The full paths of a compacted record"
+        return [self.join(p) for p in file_info['paths']]
@@ -0,0 +1,104 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from typing import Any, Dict, List, Optional
+import urllib.parse
+
+
+class PathRewriter:
+    """
+    Rewrite the `paths` of each file so transformers read through a caching proxy (e.g. an
+    XCache). A rewritten URI is the cache prefix followed by the original URI, e.g.
+    `root://xcache.local:1094//root://origin.site:1094//pnfs/file.root`.
+
+    Prefix rules are chosen per site first, then per scheme:
+
+    * `site_prefixes` maps a host (`origin.site`) or host and port (`origin.site:1094`) to
+      the prefix used for replicas at that site.
+    * `scheme_prefixes` maps a URI scheme (`root`, `https`, ...) to a prefix. The scheme
+      `*` matches any scheme not otherwise listed.
+
+    Paths that match no rule are left untouched. If `keep_originals` is set, the rewritten
+    URIs are put first and all of the original URIs follow, in order, as fallbacks.
+    """
+
+    def __init__(self, scheme_prefixes: Optional[Dict[str, str]] = None,
+                 site_prefixes: Optional[Dict[str, str]] = None,
+                 keep_originals: bool = False):
+        self.scheme_prefixes = dict(scheme_prefixes or {})
+        self.site_prefixes = dict(site_prefixes or {})
+        self.keep_originals = keep_originals
+
+    @classmethod
+    def from_prefix(cls, prefix: str, keep_originals: bool = False) -> "PathRewriter":
+        """
+        Build a rewriter that routes every URI through a single prefix, like the `--prefix`
+        option of the legacy RabbitMQ DID finders.
+        :param prefix: The caching proxy prefix to put in front of every URI
+        :param keep_originals: Keep the original URIs as fallbacks
+        """
+        return cls(scheme_prefixes={'*': prefix} if prefix else {},
+                   keep_originals=keep_originals)
+
+    def _prefix_for(self, path: str) -> Optional[str]:
+        url = urllib.parse.urlsplit(path)
+        if self.site_prefixes and url.netloc:
+            prefix = self.site_prefixes.get(url.netloc)
+            if prefix is None and url.hostname:
+                prefix = self.site_prefixes.get(url.hostname)
+            if prefix is not None:
+                return prefix
+        prefix = self.scheme_prefixes.get(url.scheme)
+        if prefix is None:
+            prefix = self.scheme_prefixes.get('*')
+        return prefix
+
+    def rewrite_paths(self, paths: List[str]) -> List[str]:
+        """
+        Rewrite an ordered list of replica URIs
+        :param paths: The replica URIs for one file
+        :return: The new list of URIs
+        """
+        rewritten = []
+        for p in paths:
+            prefix = self._prefix_for(p)
+            rewritten.append(p if prefix is None or p.startswith(prefix) else prefix + p)
+
+        if not self.keep_originals:
+            return rewritten
+
+        cached = [r for r, p in zip(rewritten, paths) if r != p]
+        return cached + list(paths)
+
+    def __call__(self, file_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Rewrite the paths of a batch of files. The records are copied, the originals the
+        DID finder yielded are not modified.
+        :param file_list: The batch of file records
+        :return: The batch with the paths rewritten
+        """
+        return [dict(f, paths=self.rewrite_paths(f['paths'])) for f in file_list]
@@ -0,0 +1,151 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# A record that could not be normalized, and why
+RejectedRecord = Tuple[Any, str]
+
+
+class InvalidRecord(ValueError):
+    "Raised by a field converter when a value can not be used"
+
+
+def _to_paths(value: Any) -> List[str]:
+    if isinstance(value, str):
+        value = [value]
+    elif isinstance(value, tuple):
+        value = list(value)
+    if not isinstance(value, list) or len(value) == 0:
+        raise InvalidRecord("paths must be a non-empty list of URIs")
+    if not all(isinstance(p, str) and p for p in value):
+        raise InvalidRecord("every entry in paths must be a non-empty string")
+    return value
+
+
+def _to_count(value: Any) -> int:
+    if value is None or value == "":
+        return 0
+    if isinstance(value, bool):
+        raise InvalidRecord(f"expected a number, not {value}")
+    try:
+        count = int(value)
+    except (TypeError, ValueError, OverflowError):
+        try:
+            count = int(float(value))
+        except (TypeError, ValueError, OverflowError):
+            # OverflowError for inf (or "1e999"), ValueError for nan
+            raise InvalidRecord(f"expected a finite number, not {value!r}")
+    if count < 0:
+        raise InvalidRecord(f"must not be negative ({count})")
+    return count
+
+
+def _to_checksum(value: Any) -> Any:
+    return 0 if value is None else value
+
+
+class _Field:
+    def __init__(self, name: str, aliases: Tuple[str, ...], required: bool, default: Any,
+                 convert: Callable[[Any], Any]):
+        self.name = name
+        self.keys = (name,) + aliases
+        self.required = required
+        self.default = default
+        self.convert = convert
+
+
+# The fields ServiceX needs for each file, the older names we also accept for them, and
+# how to clean up their values
+FILE_FIELDS = (
+    _Field('paths', (), True, None, _to_paths),
+    _Field('adler32', (), False, 0, _to_checksum),
+    _Field('file_size', ('bytes',), False, 0, _to_count),
+    _Field('file_events', ('events',), False, 0, _to_count),
+)
+
+
+class RecordNormalizer:
+    """
+    Clean up the file records a DID finder yields before they go any further. Each record
+    gets all of the fields ServiceX needs: `paths` is made a list, `file_size` and
+    `file_events` are made non-negative integers, older field names (`bytes`, `events`)
+    are renamed, and missing optional fields are set to their defaults. Records that can
+    not be fixed are set aside with the reason, rather than failing the whole lookup.
+
+    The list of checks is built once, when the normalizer is created.
+    """
+
+    def __init__(self, fields: Tuple[_Field, ...] = FILE_FIELDS):
+        self._fields = tuple((f.name, f.keys, f.required, f.default, f.convert)
+                             for f in fields)
+
+    def normalize(self, record: Any) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Normalize a single record
+        :param record: The record as yielded by the DID finder
+        :return: The cleaned up copy of the record and None, or None and the reason it
+                 was rejected
+        """
+        if not isinstance(record, dict):
+            return None, f"expected a dictionary, not {type(record).__name__}"
+
+        result = dict(record)
+        for name, keys, required, default, convert in self._fields:
+            for k in keys:
+                if k in record:
+                    value = record[k]
+                    break
+            else:
+                if required:
+                    return None, f"missing {name}"
+                result[name] = default
+                continue
+
+            try:
+                result[name] = convert(value)
+            except InvalidRecord as e:
+                return None, f"bad {name}: {e}"
+        return result, None
+
+    def __call__(self, file_list: List[Any]) -> Tuple[List[Dict[str, Any]],
+                                                      List[RejectedRecord]]:
+        """
+        Normalize a batch of records
+        :param file_list: The records as yielded by the DID finder
+        :return: The cleaned up records, in order, and the rejected records with reasons
+        """
+        good = []
+        rejected = []
+        normalize = self.normalize
+        for record in file_list:
+            result, reason = normalize(record)
+            if result is not None:
+                good.append(result)
+            else:
+                rejected.append((record, reason))
+        return good, rejected
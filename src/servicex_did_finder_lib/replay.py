@@ -0,0 +1,301 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""Record what a DID finder yields for a DID, and replay it through the library into a
+ServiceX App (or a local stand-in), without Celery.
+
+    servicex-did-finder-replay record --finder my_finder.lookup:find_files \\
+        --did "scope:dataset?files=100" --output lookup.jsonl --arg num_files=10
+    servicex-did-finder-replay replay --input lookup.jsonl --rate 500 --profile replay.prof
+
+Recordings are JSON lines, or msgpack if the file name ends in `.msgpack` (and the
+`msgpack` package is installed).
+"""
+import argparse
+import cProfile
+import importlib
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from servicex_did_finder_lib.did_finder_app import DIDFinderApp, UserDIDHandler
+from servicex_did_finder_lib.file_filter import FileFilter
+from servicex_did_finder_lib.local_sink import LocalServiceX
+from servicex_did_finder_lib.util_uri import parse_did_uri
+
+RECORDING_FORMAT = "servicex-did-recording"
+RECORDING_VERSION = 1
+
+__log = logging.getLogger(__name__)
+
+
+def _is_msgpack(path: str) -> bool:
+    return path.endswith(".msgpack")
+
+
+def _import_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise RuntimeError("Install the msgpack package to use .msgpack recordings")
+    return msgpack
+
+
+class _RecordingWriter:
+    def __init__(self, path: str):
+        self._msgpack = _import_msgpack() if _is_msgpack(path) else None
+        self._file = open(path, "wb")
+
+    def write(self, entry: Dict[str, Any]):
+        if self._msgpack is not None:
+            self._file.write(self._msgpack.packb(entry))
+        else:
+            self._file.write(json.dumps(entry).encode() + b"\n")
+
+    def close(self):
+        self._file.close()
+
+
+def read_recording(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read the entries of a recording: a header, one entry for each item the finder
+    yielded, and a trailer
+    :param path: The recording file
+    """
+    with open(path, "rb") as f:
+        if _is_msgpack(path):
+            yield from _import_msgpack().Unpacker(f, raw=False)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def load_finder(spec: str) -> UserDIDHandler:
+    """
+    Import a DID finder function
+    :param spec: `module.path:function_name`
+    """
+    module_name, _, function_name = spec.partition(":")
+    if not module_name or not function_name:
+        raise ValueError(f'DID finder must be given as "module:function", not "{spec}"')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def record(user_did_finder: UserDIDHandler, did: str, output: str,
+           did_finder_args: Optional[Dict[str, Any]] = None,
+           dataset_id: int = 0, finder_name: str = "") -> int:
+    """
+    Run a DID finder for a DID, writing everything it yields, and when, to a recording
+    :param user_did_finder: The DID finder
+    :param did: The DID, as ServiceX would send it
+    :param output: The file to write
+    :param did_finder_args: Arguments to pass the finder
+    :param dataset_id: The dataset id to pass the finder
+    :param finder_name: Name of the finder, kept in the recording
+    :return: The number of files recorded
+    """
+    did_info = parse_did_uri(did)
+    info = {
+        "dataset-id": dataset_id,
+        "file-filter": FileFilter.from_did_info(did_info),
+    }
+
+    writer = _RecordingWriter(output)
+    files = 0
+    error = None
+    start = time.monotonic()
+    try:
+        writer.write({"format": RECORDING_FORMAT, "version": RECORDING_VERSION,
+                      "did": did, "finder": finder_name, "recorded": time.time()})
+        try:
+            for item in user_did_finder(did_info.did, info, did_finder_args or {}):
+                writer.write({"t": time.monotonic() - start, "files": item})
+                files += len(item) if isinstance(item, list) else 1
+        except Exception as e:
+            __log.exception(f"DID finder failed after {files} files")
+            error = f"{type(e).__name__}: {e}"
+        writer.write({"end": time.monotonic() - start, "files_total": files, "error": error})
+    finally:
+        writer.close()
+    return files
+
+
+def replay_finder(path: str, rate: Optional[float] = None,
+                  speed: Optional[float] = None) -> Tuple[Dict[str, Any], UserDIDHandler]:
+    """
+    Build a DID finder that yields what was recorded
+    :param path: The recording file
+    :param rate: Yield at most this many files per second
+    :param speed: Keep the recorded timing, sped up by this factor (e.g. 2 is twice as fast)
+    :return: The recording's header, and the finder
+    """
+    entries = read_recording(path)
+    header = next(entries, None)
+    if header is None or header.get("format") != RECORDING_FORMAT:
+        raise ValueError(f"{path} is not a DID finder recording")
+
+    def finder(did: str, info: Dict[str, Any], did_finder_args: Dict[str, Any]):
+        start = time.monotonic()
+        sent = 0
+        for entry in entries:
+            if "end" in entry:
+                if entry.get("error"):
+                    raise RuntimeError(f"Recorded lookup failed: {entry['error']}")
+                return
+
+            if speed:
+                _sleep_until(start + entry["t"] / speed)
+            if rate:
+                _sleep_until(start + sent / rate)
+            item = entry["files"]
+            sent += len(item) if isinstance(item, list) else 1
+            yield item
+
+    return header, finder
+
+
+def _sleep_until(when: float):
+    delay = when - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def replay(path: str, endpoint: str, dataset_id: int = 1, did: Optional[str] = None,
+           rate: Optional[float] = None, speed: Optional[float] = None,
+           app: Optional[DIDFinderApp] = None):
+    """
+    Send a recording through the library's lookup (filters, batching, uploads) to a
+    ServiceX App endpoint
+    :param path: The recording file
+    :param endpoint: The ServiceX App endpoint, e.g. `LocalServiceX().endpoint`
+    :param dataset_id: The dataset id to use
+    :param did: The DID to use instead of the recorded one, e.g. to try other parameters
+    :param rate: Yield at most this many files per second
+    :param speed: Keep the recorded timing, sped up by this factor
+    :param app: The app to run the lookup in. By default a bare one is created.
+    """
+    header, finder = replay_finder(path, rate=rate, speed=speed)
+    app = app or DIDFinderApp("replay", did_finder_args={})
+
+    @app.did_lookup_task(name="replay.lookup_dataset")
+    def lookup_dataset(self, did: str, dataset_id: int, endpoint: str) -> None:
+        self.do_lookup(did=did, dataset_id=dataset_id,
+                       endpoint=endpoint, user_did_finder=finder)
+
+    lookup_dataset(did or header["did"], dataset_id, endpoint)
+
+
+def _parse_finder_args(args: List[str]) -> Dict[str, str]:
+    result = {}
+    for a in args:
+        key, sep, value = a.partition("=")
+        if not sep:
+            raise ValueError(f'Finder arguments must be given as key=value, not "{a}"')
+        result[key] = value
+    return result
+
+
+def _profiled(profile: Optional[str], func: Callable[[], Any]) -> Any:
+    if not profile:
+        return func()
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(profile)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Record a DID finder's output, or replay a recording into ServiceX")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rec = commands.add_parser("record", help="Run a DID finder and record its output")
+    rec.add_argument("--finder", required=True, help="The DID finder, as module:function")
+    rec.add_argument("--did", required=True, help="The DID to look up")
+    rec.add_argument("--output", required=True,
+                     help="File to write (.jsonl, or .msgpack for msgpack)")
+    rec.add_argument("--arg", action="append", default=[], metavar="KEY=VALUE",
+                     help="Argument to pass the finder in did_finder_args")
+    rec.add_argument("--dataset-id", type=int, default=0)
+
+    rep = commands.add_parser("replay", help="Replay a recording through the library")
+    rep.add_argument("--input", required=True, help="The recording to replay")
+    rep.add_argument("--endpoint", default=None,
+                     help="ServiceX App endpoint. By default a local stand-in is started.")
+    rep.add_argument("--dataset-id", type=int, default=1)
+    rep.add_argument("--did", default=None, help="Use this DID instead of the recorded one")
+    rep.add_argument("--rate", type=float, default=None,
+                     help="Most files per second to yield")
+    rep.add_argument("--speed", type=float, default=None,
+                     help="Keep the recorded timing, sped up by this factor")
+    rep.add_argument("--delay", type=float, default=0.0,
+                     help="Seconds the local stand-in waits before answering each request")
+
+    for p in (rec, rep):
+        p.add_argument("--profile", default=None, help="Write cProfile stats to this file")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        finder = load_finder(args.finder)
+        start = time.monotonic()
+        files = _profiled(args.profile, lambda: record(
+            finder, args.did, args.output, did_finder_args=_parse_finder_args(args.arg),
+            dataset_id=args.dataset_id, finder_name=args.finder))
+        print(f"Recorded {files} files in {time.monotonic() - start:.1f} seconds "
+              f"to {args.output}")
+        return
+
+    sink = None
+    endpoint = args.endpoint
+    if endpoint is None:
+        sink = LocalServiceX(response_delay=args.delay).start()
+        endpoint = sink.endpoint
+    try:
+        start = time.monotonic()
+        _profiled(args.profile, lambda: replay(
+            args.input, endpoint, dataset_id=args.dataset_id, did=args.did,
+            rate=args.rate, speed=args.speed))
+        elapsed = time.monotonic() - start
+        if sink is not None:
+            files = sink.file_count(args.dataset_id)
+            requests = sum(1 for r in sink.requests if r["action"] == "files")
+            print(f"Replayed {files} files in {requests} requests in {elapsed:.2f} seconds "
+                  f"({files / elapsed if elapsed else 0:.0f} files/s)")
+            print(json.dumps(sink.complete.get(str(args.dataset_id)), indent=2))
+        else:
+            print(f"Replayed {args.input} in {elapsed:.2f} seconds")
+    finally:
+        if sink is not None:
+            sink.stop()
+
+
+if __name__ == "__main__":
+    main()
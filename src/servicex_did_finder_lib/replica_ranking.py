@@ -0,0 +1,230 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import math
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+import urllib.parse
+
+# Measure the latency to a site. It is called with the host and port of the
+# site and returns the latency in seconds, or None if the site can't be reached.
+Prober = Callable[[str, int], Optional[float]]
+
+# Port to probe when a URI does not give one
+DEFAULT_PORTS = {
+    'root': 1094,
+    'xroot': 1094,
+    'http': 80,
+    'https': 443,
+    'dav': 80,
+    'davs': 443,
+}
+
+
+def tcp_connect_prober(timeout: float = 2.0) -> Prober:
+    """
+    Build a prober that times how long it takes to open a TCP connection to the site.
+    :param timeout: Seconds to wait before treating the site as unreachable
+    """
+    def probe(host: str, port: int) -> Optional[float]:
+        start = time.monotonic()
+        try:
+            with socket.create_connection((host, port), timeout=timeout):
+                return time.monotonic() - start
+        except OSError:
+            return None
+    return probe
+
+
+class ReplicaRanker:
+    """
+    Reorder the replicas in each file's `paths` so transformers try the best site first.
+
+    Replicas are sorted on the site score, highest first, and then on the measured latency
+    to the site, lowest first. Scores come from the static `site_scores` table, keyed by
+    host (`site.domain`) or host and port (`site.domain:1094`); sites not listed score zero.
+    If a `prober` is given, sites are probed on a background thread, so ranking a batch never
+    waits for the network: each site is probed soon after it is first seen, and again once its
+    measurement is older than `probe_ttl` seconds. Due probes are run together, on up to
+    `max_probe_workers` threads. Sites that have not been measured yet, or can not be reached,
+    sort after those that have.
+
+    Sorting is stable: replicas that rank equally keep the order the DID finder gave.
+    A ranker can be shared by all lookups in a process.
+    """
+
+    def __init__(self, site_scores: Optional[Dict[str, float]] = None,
+                 prober: Optional[Prober] = None,
+                 probe_ttl: float = 600.0,
+                 max_probe_workers: int = 8,
+                 clock: Callable[[], float] = time.monotonic):
+        self.site_scores = dict(site_scores or {})
+        self.prober = prober
+        self.probe_ttl = probe_ttl
+        self.max_probe_workers = max_probe_workers
+        self._clock = clock
+        self._latency: Dict[Tuple[str, int], Tuple[float, float]] = {}
+        self._sites: Set[Tuple[str, int]] = set()
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    @staticmethod
+    def _site(path: str) -> Optional[Tuple[str, int]]:
+        url = urllib.parse.urlsplit(path)
+        if not url.hostname:
+            return None
+        try:
+            port = url.port
+        except ValueError:
+            port = None
+        return url.hostname, port or DEFAULT_PORTS.get(url.scheme, 0)
+
+    def _score(self, site: Optional[Tuple[str, int]]) -> float:
+        if site is None:
+            return 0.0
+        host, port = site
+        score = self.site_scores.get(f"{host}:{port}")
+        if score is None:
+            score = self.site_scores.get(host, 0.0)
+        return score
+
+    def latency(self, host: str, port: int) -> Optional[float]:
+        """
+        The last measured latency to a site, or None if it is unknown or unreachable
+        """
+        entry = self._latency.get((host, port))
+        if entry is None or math.isinf(entry[1]):
+            return None
+        return entry[1]
+
+    def _stale(self, sites) -> List[Tuple[str, int]]:
+        "The sites that have never been measured or whose measurement has expired"
+        now = self._clock()
+        return [s for s in sites
+                if s not in self._latency or now - self._latency[s][0] > self.probe_ttl]
+
+    def _next_expiry(self) -> Optional[float]:
+        "Seconds until the oldest measurement expires, or None if nothing has been measured"
+        with self._lock:
+            if not self._latency:
+                return None
+            oldest = min(measured for measured, _ in self._latency.values())
+        return max(0.0, oldest + self.probe_ttl - self._clock())
+
+    def _probe_loop(self):
+        while True:
+            self._wake.wait(self._next_expiry())
+            self._wake.clear()
+            self.refresh()
+
+    def _schedule(self, sites: Set[Tuple[str, int]]):
+        "Remember the sites, and wake the background thread if any of them need probing"
+        with self._lock:
+            self._sites.update(sites)
+            due = bool(self._stale(sites))
+            # A thread started before a fork does not run in the child
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._probe_loop, daemon=True,
+                                                name="replica_probes")
+                self._thread.start()
+        if due:
+            self._wake.set()
+
+    def refresh(self):
+        """
+        Probe, now, every known site that has never been measured or whose measurement has
+        expired. The background thread calls this, but it can be called directly to wait
+        for fresh measurements.
+        """
+        # One refresh at a time, so a site is not probed twice for the same expiry
+        with self._probe_lock:
+            with self._lock:
+                stale = self._stale(self._sites)
+            if stale:
+                self._probe(stale)
+
+    def _probe(self, stale: List[Tuple[str, int]]):
+        "Probe the sites together, and record their latencies"
+        def probe(site: Tuple[str, int]) -> float:
+            try:
+                result = self.prober(*site)  # type: ignore
+            except Exception:
+                self.logger.exception(f"Probe of site {site[0]}:{site[1]} failed")
+                result = None
+            return math.inf if result is None else result
+
+        if len(stale) == 1:
+            measured = [probe(stale[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_probe_workers,
+                                                    len(stale))) as pool:
+                measured = list(pool.map(probe, stale))
+
+        now = self._clock()
+        with self._lock:
+            for site, latency in zip(stale, measured):
+                self._latency[site] = (now, latency)
+
+    def rank_paths(self, paths: List[str]) -> List[str]:
+        """
+        Order the replica URIs for one file, best first
+        :param paths: The replica URIs
+        :return: A new, reordered, list
+        """
+        def key(path: str):
+            site = self._site(path)
+            entry = self._latency.get(site) if site is not None else None
+            return -self._score(site), entry[1] if entry is not None else math.inf
+
+        return sorted(paths, key=key)
+
+    def __call__(self, file_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Rank the replicas for a batch of files, with the measurements already made. Sites in
+        the batch that need probing are handed to the background thread, so later batches
+        benefit. Records are copied, not modified.
+        :param file_list: The batch of file records
+        :return: The batch with reordered paths
+        """
+        if self.prober is not None:
+            sites = {self._site(p) for f in file_list if len(f['paths']) > 1
+                     for p in f['paths']}
+            sites.discard(None)
+            if sites:
+                self._schedule(sites)  # type: ignore
+
+        return [f if len(f['paths']) < 2 else dict(f, paths=self.rank_paths(f['paths']))
+                for f in file_list]
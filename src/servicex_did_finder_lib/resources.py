@@ -0,0 +1,122 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class ResourceFactory:
+    """
+    An entry of `did_finder_args` that is built in each worker process rather than
+    in the parent. Use it for clients that hold connections or sessions (e.g. a Rucio
+    client), so they are not shared between forked worker processes.
+    """
+
+    def __init__(self, create: Callable[[], Any],
+                 teardown: Optional[Callable[[Any], None]] = None):
+        """
+        :param create: Called with no arguments to build the object
+        :param teardown: Called with the object when the worker process shuts down
+        """
+        self.create = create
+        self.teardown = teardown
+
+
+class ProcessResources:
+    """
+    The finder arguments, with every `ResourceFactory` entry replaced by the object it
+    builds. The objects are built once per process, the first time they are needed, and
+    built again if the process has forked since.
+    """
+
+    def __init__(self, args: Optional[Dict[str, Any]]):
+        """
+        :param args: The finder arguments, some of which may be `ResourceFactory`s
+        """
+        self.args = args
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._resolved: Optional[Dict[str, Any]] = None
+
+    @property
+    def has_factories(self) -> bool:
+        return self.args is not None and \
+            any(isinstance(v, ResourceFactory) for v in self.args.values())
+
+    def resolve(self) -> Optional[Dict[str, Any]]:
+        """
+        :return: The finder arguments for this process
+        """
+        if not self.has_factories:
+            return self.args
+
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                self._resolved = self._build()
+                self._pid = pid
+            return self._resolved
+
+    def _build(self) -> Dict[str, Any]:
+        start = time.monotonic()
+        resolved: Dict[str, Any] = {}
+        try:
+            for name, value in self.args.items():  # type: ignore
+                resolved[name] = value.create() if isinstance(value, ResourceFactory) \
+                    else value
+        except Exception:
+            self._teardown(resolved)
+            raise
+        self.logger.info(f"Built finder resources in process {os.getpid()} in "
+                         f"{time.monotonic() - start:.2f} seconds")
+        return resolved
+
+    def close(self):
+        """
+        Tear down the objects built in this process. They are built again if needed.
+        """
+        with self._lock:
+            if self._pid != os.getpid() or self._resolved is None:
+                return
+            resolved, self._resolved, self._pid = self._resolved, None, None
+        self._teardown(resolved)
+
+    def _teardown(self, resolved: Dict[str, Any]):
+        for name, value in self.args.items():  # type: ignore
+            if not isinstance(value, ResourceFactory) or value.teardown is None \
+                    or name not in resolved:
+                continue
+            try:
+                value.teardown(resolved[name])
+            except Exception:
+                self.logger.exception(f"Error tearing down finder resource {name}")
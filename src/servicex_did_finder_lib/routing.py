@@ -0,0 +1,182 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, Iterator, Optional
+
+from servicex_did_finder_lib.util_uri import parse_did_uri
+
+# Lanes a lookup can be routed to
+FAST_LANE = "fast"
+BULK_LANE = "bulk"
+
+_digits = re.compile(r'\d+')
+
+
+def did_pattern(did: str) -> str:
+    """
+    Key used to group the history of similar lookups. Runs of digits (run numbers, tags,
+    ...) in the DID are replaced by `#`, and lookups limited by `files` are kept apart
+    from full ones.
+    :param did: The DID as sent by ServiceX
+    """
+    did_info = parse_did_uri(did)
+    base = did_info.did.split('?', 1)[0]
+    pattern = _digits.sub('#', base)
+    return pattern + ('?files' if did_info.file_count > 0 else '')
+
+
+class LookupRouter:
+    """
+    Decide whether a lookup goes to the fast lane or the bulk lane, so quick interactive
+    lookups do not wait behind lookups that scan whole containers.
+
+    The estimated cost of a lookup is the smoothed duration of earlier lookups with the
+    same `did_pattern`. With no history, a lookup goes to the fast lane if it asks for at
+    most `fast_file_limit` files, or sets a `timeout` of at most `fast_threshold` seconds.
+    With history, it goes to the fast lane if the estimate is at most `fast_threshold`.
+
+    Durations are recorded by the worker that runs the lookup. Set `history_path` to a
+    file all the workers on a node can read and write so the history is shared between
+    processes; otherwise each process only learns from its own lookups.
+    """
+
+    def __init__(self, fast_threshold: float = 60.0,
+                 fast_file_limit: int = 100,
+                 smoothing: float = 0.3,
+                 history_path: Optional[str] = None):
+        self.fast_threshold = fast_threshold
+        self.fast_file_limit = fast_file_limit
+        self.smoothing = smoothing
+        self.history_path = history_path
+
+        self._history: Dict[str, float] = {}
+        self._history_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def _load(self, force: bool = False):
+        """
+        Pick up durations other processes have written since we last looked
+        :param force: Read the file even if its modification time hasn't changed
+        """
+        if self.history_path is None:
+            return
+        try:
+            mtime = os.path.getmtime(self.history_path)
+            if mtime == self._history_mtime and not force:
+                return
+            with open(self.history_path) as f:
+                self._history.update(json.load(f))
+            self._history_mtime = mtime
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            self.logger.exception(f"Unable to read lookup history from {self.history_path}")
+
+    def _save(self):
+        if self.history_path is None:
+            return
+        try:
+            tmp_path = f"{self.history_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._history, f)
+            os.replace(tmp_path, self.history_path)
+            self._history_mtime = os.path.getmtime(self.history_path)
+        except OSError:
+            self.logger.exception(f"Unable to write lookup history to {self.history_path}")
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        "Keep other processes from updating the history file until the block is done"
+        if self.history_path is None:
+            yield
+            return
+        # The history file itself is replaced on every save, so lock a file beside it
+        try:
+            fd = os.open(f"{self.history_path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            self.logger.exception(f"Unable to lock lookup history {self.history_path}")
+            yield
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # Releases the lock
+
+    def estimate(self, did: str) -> Optional[float]:
+        """
+        Estimated duration of a lookup, in seconds, or None if there is no history
+        :param did: The DID as sent by ServiceX
+        """
+        with self._lock:
+            self._load()
+            return self._history.get(did_pattern(did))
+
+    def record(self, did: str, seconds: float):
+        """
+        Remember how long a lookup took
+        :param did: The DID as sent by ServiceX
+        :param seconds: The duration of the lookup
+        """
+        key = did_pattern(did)
+        with self._lock, self._file_lock():
+            # Another process may have saved within the same mtime tick, so always re-read
+            self._load(force=True)
+            previous = self._history.get(key)
+            self._history[key] = seconds if previous is None \
+                else previous + self.smoothing * (seconds - previous)
+            self._save()
+
+    def lane(self, did: str) -> str:
+        """
+        Pick the lane for a lookup
+        :param did: The DID as sent by ServiceX
+        :return: FAST_LANE or BULK_LANE
+        """
+        try:
+            estimate = self.estimate(did)
+            did_info = parse_did_uri(did)
+        except ValueError:
+            return FAST_LANE  # The lookup reports the bad DID to ServiceX as soon as it starts
+
+        if estimate is not None:
+            return FAST_LANE if estimate <= self.fast_threshold else BULK_LANE
+        if 0 < did_info.file_count <= self.fast_file_limit:
+            return FAST_LANE
+        if did_info.timeout is not None and did_info.timeout <= self.fast_threshold:
+            return FAST_LANE
+        return BULK_LANE
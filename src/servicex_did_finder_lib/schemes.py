@@ -0,0 +1,111 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import fcntl
+import os
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+import uuid
+
+from servicex_did_finder_lib.resources import ProcessResources
+
+# Seconds to wait before trying again a lookup turned away because its scheme was busy
+SCHEME_BUSY_RETRY = 5.0
+
+
+class DIDScheme:
+    """
+    A DID scheme (e.g. `rucio`) served by a `DIDFinderApp`. An app can serve several,
+    each with its own queue, finder arguments and limit on lookups running at once,
+    while sharing the worker processes and the connections to ServiceX.
+    """
+
+    def __init__(self, name: str, did_finder_args: Optional[Dict[str, Any]] = None,
+                 max_concurrent: Optional[int] = None):
+        """
+        :param name: The scheme, as used in DIDs sent to ServiceX
+        :param did_finder_args: Arguments passed to this scheme's finder. Entries can
+                                be `resources.ResourceFactory`s.
+        :param max_concurrent: Most lookups of this scheme to run at once, across all
+                               worker processes
+        """
+        self.name = name
+        self.resources = ProcessResources(did_finder_args)
+        self.max_concurrent = max_concurrent
+        # The worker's processes are forked from this one, so they all use the same slots
+        self._slot_id = uuid.uuid4().hex
+        self._held = threading.local()
+
+    @property
+    def queue(self) -> str:
+        "The Celery queue for this scheme's lookups"
+        return f"did_finder_{self.name}"
+
+    @property
+    def did_finder_args(self) -> Optional[Dict[str, Any]]:
+        return self.resources.resolve()
+
+    @property
+    def slot_dir(self) -> str:
+        "Where the slot files of the worker's processes are"
+        return os.path.join(tempfile.gettempdir(),
+                            f"did_finder_{self.name}_slots_{self._slot_id}")
+
+    def _held_slots(self) -> List[int]:
+        if not hasattr(self._held, "fds"):
+            self._held.fds = []
+        return self._held.fds
+
+    def try_acquire(self) -> bool:
+        """
+        Claim a slot for a lookup. A slot is an exclusive lock on a file, so if the
+        process holding it dies (e.g. it is killed for using too much memory) the system
+        gives it back.
+        :return: False if `max_concurrent` lookups are already running
+        """
+        if self.max_concurrent is None:
+            return True
+        os.makedirs(self.slot_dir, exist_ok=True)
+        for slot in range(self.max_concurrent):
+            fd = os.open(os.path.join(self.slot_dir, f"slot{slot}"), os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            self._held_slots().append(fd)
+            return True
+        return False
+
+    def release(self):
+        "Give back a slot claimed with `try_acquire`"
+        held = self._held_slots()
+        if held:
+            fd = held.pop()
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
@@ -25,66 +25,384 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+import hashlib
 import json
-from datetime import datetime
+import os
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+import uuid
+
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 
+from servicex_did_finder_lib.chunk_controller import ChunkController, get_chunk_controller
+from servicex_did_finder_lib.circuit_breaker import get_circuit_breaker
+from servicex_did_finder_lib.health import get_metrics
+from servicex_did_finder_lib.path_prefixes import PrefixTable
+from servicex_did_finder_lib.tracing import get_tracer, inject_headers
+from servicex_did_finder_lib.transport import FileTransport, file_record
+
 
 MAX_RETRIES = 3
 
+# Seconds to wait for the connection to the App, and then for its response
+DEFAULT_TIMEOUT = (10.0, 60.0)
+
+# Errors after which a request to the App is worth retrying
+RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+# Seconds to wait before retrying when the App is busy and does not say how long to wait
+RETRY_BACKOFF = 1.0
+
+# Most seconds to hold a request while the circuit to the App is open, before giving up
+MAX_PARK = 600.0
+
+# Most chunks of a lookup that are uploaded at the same time
+MAX_IN_FLIGHT = 4
+
+# Results of sending a single chunk
+_SENT = "sent"
+_TOO_LARGE = "too_large"
+_FAILED = "failed"
+
+
+def _retry_after(response, attempts: int) -> float:
+    "How long to wait before retrying a request the App turned away"
+    try:
+        return max(0.0, min(float(response.headers.get("Retry-After", "")), 60.0))
+    except ValueError:
+        return RETRY_BACKOFF * 2 ** (attempts - 1)
+
+
+# One pooled session per App endpoint, shared by every lookup in the process
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(endpoint: str) -> requests.Session:
+    """
+    The HTTP session for an App endpoint, which keeps connections open between requests
+    :param endpoint: The ServiceX App endpoint
+    """
+    with _sessions_lock:
+        session = _sessions.get(endpoint)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=4 * MAX_IN_FLIGHT)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[endpoint] = session
+        return session
+
+
+def _forget_sessions():
+    "Connections must not be shared with a forked child"
+    global _sessions_lock
+    _sessions.clear()
+    _sessions_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_sessions)
+
+
+def _body_size(records: List[str]) -> int:
+    "The length of the JSON list of the records"
+    return sum(len(r) for r in records) + len(records) + 1
+
+
+def _record_content(record: str) -> str:
+    "The serialized record without its timestamp, which `file_record` always puts first"
+    _, paths, rest = record.partition('"paths"')
+    return paths + rest if paths else record
+
+
+def _chunk_key(lookup_id: str, records: List[str], prefixes: Optional[List[str]]) -> str:
+    """
+    The `Idempotency-Key` of a chunk: the lookup and a hash of the files in the chunk. Chunk
+    sizes adapt to the App, so a retried lookup can split its files differently - only a
+    chunk with exactly the same files gets the same key.
+    """
+    digest = hashlib.sha256()
+    if prefixes is not None:
+        digest.update(json.dumps(prefixes).encode())
+    for r in records:
+        digest.update(_record_content(r).encode())
+        digest.update(b"\n")
+    return f"{lookup_id}-{digest.hexdigest()[:32]}"
+
+
+def _chunk_body(records: List[str], prefixes: Optional[List[str]]) -> str:
+    """
+    The JSON list of the records or, if their paths were split against a prefix table,
+    `{"prefixes": [...], "files": [...]}`, where each path is a `[prefix index, rest]` pair
+    """
+    files = "[" + ",".join(records) + "]"
+    if prefixes is None:
+        return files
+    return '{"prefixes": ' + json.dumps(prefixes) + ', "files": ' + files + '}'
+
+
+# Length of a compact chunk body with no prefixes and no files
+_EMPTY_COMPACT_BODY = len(_chunk_body([], []))
 
-class ServiceXAdapter:
-    def __init__(self, endpoint, dataset_id):
+
+class ServiceXAdapter(FileTransport):
+    def __init__(self, endpoint, dataset_id, timeout=DEFAULT_TIMEOUT,
+                 max_in_flight: int = MAX_IN_FLIGHT, lookup_id: Optional[str] = None,
+                 compact_paths: bool = False):
+        """
+        :param endpoint: The ServiceX App endpoint
+        :param dataset_id: The dataset the files belong to
+        :param timeout: Seconds to wait for each request - either a single number, or a
+                        (connect, read) tuple
+        :param max_in_flight: Most chunks to upload at the same time
+        :param lookup_id: Identifies the lookup in the `Idempotency-Key` of each chunk.
+                          Defaults to a random id.
+        :param compact_paths: Send each chunk with a table of the prefixes of its paths,
+                              rather than repeating them for every file (see
+                              `_chunk_body`). The App must support this.
+        """
         self.endpoint = endpoint
         self.dataset_id = dataset_id
+        self.timeout = timeout
+        self.max_in_flight = max(1, max_in_flight)
+        self.lookup_id = lookup_id or uuid.uuid4().hex
+        self.compact_paths = compact_paths
 
         self.logger = logging.getLogger(__name__)
         self.logger.addHandler(logging.NullHandler())
 
+        self._in_flight: Deque[Tuple[List[str], Optional[List[str]], ChunkController, bool,
+                                     Future]] = deque()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
     def _create_json(self, file_info):
-        return {
-            "timestamp": datetime.now().isoformat(),
-            "paths": file_info['paths'],
-            'adler32': file_info['adler32'],
-            'file_size': file_info['file_size'],
-            'file_events': file_info['file_events']
-        }
-
-    def put_file_add_bulk(self, file_list, chunk_length=300):
-        # we first chunk up file_list as it can be very large in
-        # case there are a lot of replicas and a lot of files.
-        chunks = [file_list[i:i + chunk_length] for i in range(0, len(file_list), chunk_length)]
-        for chunk in chunks:
-            success = False
-            attempts = 0
-            mesg = []
-            for fi in chunk:
-                mesg.append(self._create_json(fi))
-            while not success and attempts < MAX_RETRIES:
+        return file_record(file_info)
+
+    def put_file_add_bulk(self, file_list, chunk_length=None):
+        """
+        Send files to ServiceX. The list can be very large if there are a lot of files
+        and a lot of replicas, so it is split into chunks. A chunk holds at most as many
+        files, and as many bytes, as the endpoint's `ChunkController` currently allows.
+
+        Up to `max_in_flight` chunks are uploaded at the same time, and this returns once
+        the last chunk has been started. Call `close` to wait for them all to finish.
+        :param file_list: The files to send
+        :param chunk_length: If given, a fixed limit on the number of files in a chunk
+        """
+        controller = get_chunk_controller(self.endpoint)
+        files = [self._create_json(fi) for fi in file_list]
+
+        start = 0
+        while start < len(files):
+            end, records, prefixes = self._take_chunk(
+                files, start, chunk_length or controller.max_records, controller.max_bytes)
+            self._submit(records, prefixes, controller, full=end < len(files))
+            start = end
+
+    def _take_chunk(self, files: List[Dict], start: int, max_records: int,
+                    max_bytes: int) -> Tuple[int, List[str], Optional[List[str]]]:
+        """
+        Serialize the files from `start` on, until the chunk holds `max_records` of them or
+        the next one would take its body over `max_bytes`. Always takes at least one file,
+        even if it is over the byte budget.
+        :return: Where the next chunk starts, the chunk's records, and the prefixes their
+                 paths were split against (None unless `compact_paths` is set)
+        """
+        table = PrefixTable() if self.compact_paths else None
+        records: List[str] = []
+        size = 2 if table is None else _EMPTY_COMPACT_BODY
+        n_prefixes = 0
+        end = start
+        while end < len(files) and len(records) < max_records:
+            record = files[end]
+            grow = 1 if records else 0
+            if table is not None:
+                record = dict(record, paths=[table.split(p) for p in record["paths"]])
+                # The prefixes this file added to the table, and their separators
+                grow += sum(len(json.dumps(p)) + (2 if i else 0)
+                            for i, p in enumerate(table.prefixes[n_prefixes:], n_prefixes))
+            line = json.dumps(record)
+            grow += len(line)
+            if records and size + grow > max_bytes:
+                break
+            records.append(line)
+            size += grow
+            n_prefixes = len(table) if table is not None else 0
+            end += 1
+
+        # A file that didn't fit may have added prefixes, always at the end of the table
+        return end, records, table.prefixes[:n_prefixes] if table is not None else None
+
+    def _submit(self, records: List[str], prefixes: Optional[List[str]],
+                controller: ChunkController, full: bool):
+        "Start uploading a chunk, once there is room in the window"
+        while len(self._in_flight) >= self.max_in_flight:
+            self._finish_oldest()
+
+        key = _chunk_key(self.lookup_id, records, prefixes)
+        get_metrics().upload_queued(_body_size(records))
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_in_flight,
+                                                thread_name_prefix=f"upload_{self.dataset_id}")
+        # Copy the context so the upload's span is a child of the current one
+        future = self._executor.submit(contextvars.copy_context().run, self._put_chunk,
+                                       records, prefixes, controller, full, key)
+        self._in_flight.append((records, prefixes, controller, full, future))
+
+    def _finish_oldest(self):
+        "Wait for the oldest chunk, and send it again in halves if it was too large"
+        records, prefixes, controller, full, future = self._in_flight.popleft()
+        if future.result() == _TOO_LARGE:
+            # Both halves can keep the whole prefix table
+            half = len(records) // 2
+            self._submit(records[:half], prefixes, controller, full)
+            self._submit(records[half:], prefixes, controller, full)
+
+    def _put_chunk(self, records, prefixes: Optional[List[str]], controller: ChunkController,
+                   full: bool, key: str) -> str:
+        body = _chunk_body(records, prefixes)
+        result = _FAILED
+        try:
+            with get_tracer().span("servicex.put_files", {
+                "dataset_id": self.dataset_id,
+                "files": len(records),
+                "bytes": len(body),
+            }) as span:
                 try:
-                    requests.put(f"{self.endpoint}{self.dataset_id}/files", json=mesg)
-                    self.logger.info(f"Metric: {json.dumps(mesg)}")
-                    success = True
-                except requests.exceptions.ConnectionError:
-                    self.logger.exception(f'Connection error to ServiceX App. Will retry '
-                                          f'(try {attempts} out of {MAX_RETRIES}')
-                    attempts += 1
-            if not success:
-                self.logger.error(f'After {attempts} tries, failed to send ServiceX App '
-                                  f'a put_file_bulk message: {mesg} - Ignoring error.')
+                    result = self._put_chunk_body(body, len(records), controller, full, key)
+                except requests.exceptions.RequestException:
+                    self.logger.exception(f'Error sending ServiceX App a put_file_bulk '
+                                          f'message: {body} - Ignoring error.')
+                span.set_attribute("result", result)
+                return result
+        finally:
+            get_metrics().upload_finished(_body_size(records),
+                                          len(records) if result == _SENT else 0)
+
+    def _put_chunk_body(self, body: str, n_records: int, controller: ChunkController,
+                        full: bool, key: str) -> str:
+        # The App can use the key to ignore a chunk it already has, if a retry repeats it
+        headers = {"Content-Type": "application/json", "Idempotency-Key": key}
+        if self.compact_paths:
+            headers["X-Path-Encoding"] = "prefix-table"
+        attempts = 0
+        while attempts < MAX_RETRIES:
+            if not self._wait_for_app():
+                break
+            try:
+                start_time = time.monotonic()
+                r = get_session(self.endpoint).put(
+                    f"{self.endpoint}{self.dataset_id}/files", data=body,
+                    headers=inject_headers(dict(headers)), timeout=self.timeout)
+                elapsed = time.monotonic() - start_time
+            except RETRY_ERRORS:
+                self._record_request(ok=False)
+                self.logger.exception(f'Connection error to ServiceX App. Will retry '
+                                      f'(try {attempts} out of {MAX_RETRIES}')
+                attempts += 1
+                continue
+            except BaseException:
+                # Always give the circuit breaker an answer, or a probe is never released
+                self._record_request(ok=False)
+                raise
+            self._record_request(ok=r.status_code not in (429, 503) and r.status_code < 500)
+
+            if r.status_code == 413:
+                controller.on_too_large()
+                if n_records > 1:
+                    return _TOO_LARGE
+                self.logger.error(f'ServiceX App rejected a single file as too large: '
+                                  f'{body} - Ignoring error.')
+                return _FAILED
+
+            if r.status_code == 429 or r.status_code >= 500:
+                # An App that is failing is as good a reason to send less as a busy one
+                controller.on_overload()
+                attempts += 1
+                self.logger.warning(f'ServiceX App is busy or failing ({r.status_code}). '
+                                    f'Will retry (try {attempts} out of {MAX_RETRIES}')
+                if attempts < MAX_RETRIES:
+                    time.sleep(_retry_after(r, attempts))
+                continue
+
+            if r.status_code >= 300:
+                # Sending the chunk again won't help, and it says nothing about its size
+                self.logger.error(f'ServiceX App rejected a put_file_bulk message '
+                                  f'({r.status_code}): {body} - Ignoring error.')
+                return _FAILED
+
+            controller.on_success(elapsed, full)
+            self.logger.info(f"Metric: {body}")
+            return _SENT
+
+        self.logger.error(f'After {attempts} tries, failed to send ServiceX App '
+                          f'a put_file_bulk message: {body} - Ignoring error.')
+        return _FAILED
+
+    def _wait_for_app(self) -> bool:
+        """
+        Hold the request while the circuit to the App is open
+        :return: False if it stayed open too long
+        """
+        if get_circuit_breaker(self.endpoint).allow(MAX_PARK):
+            return True
+        self.logger.error(f"ServiceX App at {self.endpoint} has been unreachable too long - "
+                          f"giving up on the request")
+        return False
+
+    def _record_request(self, ok: bool):
+        "Count a request to the App, towards the health metrics and the circuit breaker"
+        get_metrics().app_request(ok=ok)
+        breaker = get_circuit_breaker(self.endpoint)
+        if ok:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    def close(self):
+        "Wait for every chunk that is being uploaded to finish"
+        while self._in_flight:
+            self._finish_oldest()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
     def put_fileset_complete(self, summary):
+        try:
+            self.close()
+        except Exception:
+            # ServiceX must still be told the fileset is complete, or it waits forever
+            self.logger.exception("Error finishing the upload of files to ServiceX App")
+        with get_tracer().span("servicex.put_complete", {"dataset_id": self.dataset_id}):
+            self._put_fileset_complete(summary)
+
+    def _put_fileset_complete(self, summary):
         success = False
         attempts = 0
         while not success and attempts < MAX_RETRIES:
+            if not self._wait_for_app():
+                break
             try:
-                requests.put(f"{self.endpoint}{self.dataset_id}/complete", json=summary)
+                get_session(self.endpoint).put(
+                    f"{self.endpoint}{self.dataset_id}/complete", json=summary,
+                    headers=inject_headers({}), timeout=self.timeout)
                 success = True
-            except requests.exceptions.ConnectionError:
+                self._record_request(ok=True)
+            except RETRY_ERRORS:
+                self._record_request(ok=False)
                 self.logger.exception(f'Connection error to ServiceX App. Will retry '
                                       f'(try {attempts} out of {MAX_RETRIES}')
                 attempts += 1
+            except BaseException:
+                self._record_request(ok=False)
+                raise
         if not success:
             self.logger.error(f'After {attempts} tries, failed to send ServiceX App a put_file '
                               f'message: {str(summary)} - Ignoring error.')
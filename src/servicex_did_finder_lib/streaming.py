@@ -0,0 +1,222 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from collections import deque
+import json
+import queue
+import threading
+import time
+from typing import Deque, Optional, Tuple
+
+import requests
+
+from servicex_did_finder_lib.servicex_adaptor import (DEFAULT_TIMEOUT, MAX_RETRIES,
+                                                      RETRY_BACKOFF, ServiceXAdapter,
+                                                      get_session)
+from servicex_did_finder_lib.health import get_metrics
+from servicex_did_finder_lib.tracing import inject_headers
+
+# Put on the queue to tell the sender the lookup is over
+_CLOSE = None
+
+
+class StreamingServiceXAdapter(ServiceXAdapter):
+    """
+    Send files to the ServiceX App as newline-delimited JSON over a long-lived chunked
+    request (`PUT <endpoint><dataset_id>/files/stream`), so each file reaches the App as
+    soon as the DID finder yields it rather than when a batch fills up.
+
+    Every file gets a sequence number, and the request carries an `X-Lookup-Id` header,
+    so the App can drop duplicates. A request is finished, and the App answers with
+    `{"acknowledged": <last sequence number>}`, after `ack_every` files, or when no file
+    has arrived for `max_idle` seconds. If a request fails, a new one is opened and every
+    file that has not been acknowledged is sent again. If streaming keeps failing, or the
+    App rejects the stream (a 4xx answer, e.g. an App without the streaming endpoint),
+    streaming is turned off: the unacknowledged files, and every file after them, are
+    sent with the normal bulk request instead.
+
+    Sending happens on a background thread. `put_fileset_complete` waits for every file
+    to be acknowledged before telling the App the fileset is complete.
+    """
+
+    def __init__(self, endpoint, dataset_id, timeout=DEFAULT_TIMEOUT,
+                 ack_every: int = 1000, max_idle: float = 10.0,
+                 lookup_id: Optional[str] = None):
+        super().__init__(endpoint, dataset_id, timeout=timeout, lookup_id=lookup_id)
+        self.ack_every = ack_every
+        self.max_idle = max_idle
+
+        self._queue: queue.Queue = queue.Queue()
+        self._unacked: Deque[Tuple[int, bytes]] = deque()
+        self._next_seq = 0
+        self._closing = False
+        self._streaming = True
+        self._thread: Optional[threading.Thread] = None
+
+    def put_file_add_bulk(self, file_list, chunk_length=None):
+        """
+        Queue files to be streamed to the App. Does not wait for them to be sent.
+        :param file_list: The files to send
+        :param chunk_length: Ignored - streamed files are not chunked
+        """
+        for fi in file_list:
+            record = self._create_json(fi)
+            record["seq"] = self._next_seq
+            line = json.dumps(record).encode() + b"\n"
+            get_metrics().upload_queued(len(line))
+            self._queue.put((self._next_seq, line))
+            self._next_seq += 1
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._send_loop, daemon=True,
+                                            name=f"stream_{self.dataset_id}")
+            self._thread.start()
+
+    def close(self):
+        "Send everything that is queued, and wait for it to be acknowledged"
+        if self._thread is not None:
+            self._queue.put(_CLOSE)
+            self._thread.join()
+            self._thread = None
+        super().close()
+
+    def _body(self, sent: list):
+        "Lines for one request: the unacknowledged files first, then new ones as they arrive"
+        for seq, line in list(self._unacked):
+            sent.append(seq)
+            yield line
+
+        while len(sent) < self.ack_every and not self._closing:
+            try:
+                item = self._queue.get(timeout=self.max_idle)
+            except queue.Empty:
+                return
+            if item is _CLOSE:
+                self._closing = True
+                return
+            self._unacked.append(item)
+            sent.append(item[0])
+            yield item[1]
+
+    def _stream_once(self) -> bool:
+        "Run one streaming request. Returns False if it failed."
+        sent: list = []
+        headers = inject_headers({
+            "Content-Type": "application/x-ndjson",
+            "X-Lookup-Id": self.lookup_id,
+        })
+        if not self._wait_for_app():
+            return False
+        try:
+            r = get_session(self.endpoint).put(
+                f"{self.endpoint}{self.dataset_id}/files/stream",
+                data=self._body(sent), headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            self._record_request(ok=False)
+            self.logger.exception("Error streaming files to ServiceX App")
+            return False
+        except BaseException:
+            # Always give the circuit breaker an answer, or a probe is never released
+            self._record_request(ok=False)
+            raise
+
+        # Only count the App being down or busy against the circuit - a 4xx (e.g. an App
+        # without the streaming endpoint) is not a reason to hold back batch uploads
+        self._record_request(ok=r.status_code not in (429, 503) and r.status_code < 500)
+        if 400 <= r.status_code < 500 and r.status_code != 429:
+            # Asking again will get the same answer
+            self.logger.error(f"ServiceX App rejected the file stream ({r.status_code}). "
+                              f"Sending files with bulk requests instead")
+            self._streaming = False
+            return False
+        if r.status_code >= 300:
+            self.logger.error(f"ServiceX App rejected the file stream ({r.status_code})")
+            return False
+
+        try:
+            acknowledged = int(r.json()["acknowledged"])
+        except (ValueError, KeyError, TypeError):
+            acknowledged = sent[-1] if sent else -1
+        while self._unacked and self._unacked[0][0] <= acknowledged:
+            _, line = self._unacked.popleft()
+            get_metrics().upload_finished(len(line), 1)
+        if sent:
+            self.logger.info(f"Streamed {len(sent)} files to ServiceX App, "
+                             f"acknowledged up to {acknowledged}")
+        return True
+
+    def _send_loop(self):
+        failures = 0
+        while True:
+            if not self._closing and not self._unacked:
+                # Wait for a file before opening a request, so idle lookups hold none open
+                item = self._queue.get()
+                if item is _CLOSE:
+                    self._closing = True
+                else:
+                    self._unacked.append(item)
+
+            if self._closing and not self._unacked and self._queue.empty():
+                return
+
+            if not self._streaming:
+                self._take_queued()
+                self._fall_back()
+                continue
+
+            if self._stream_once():
+                failures = 0
+                continue
+
+            failures += 1
+            if failures >= MAX_RETRIES:
+                self.logger.warning(f"Streaming to ServiceX App failed {MAX_RETRIES} times. "
+                                    f"Sending files with bulk requests instead")
+                self._streaming = False
+            elif self._streaming:
+                time.sleep(RETRY_BACKOFF * 2 ** (failures - 1))
+
+    def _take_queued(self):
+        "Move the files that are already queued to the unacknowledged ones, without waiting"
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is _CLOSE:
+                self._closing = True
+                return
+            self._unacked.append(item)
+
+    def _fall_back(self):
+        "Streaming isn't working - send the unacknowledged files as a bulk request"
+        records = [json.loads(line) for _, line in self._unacked]
+        get_metrics().upload_finished(sum(len(line) for _, line in self._unacked), 0)
+        self._unacked.clear()
+        for r in records:
+            r.pop("seq", None)
+        super().put_file_add_bulk(records)
@@ -0,0 +1,226 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import contextvars
+import json
+import logging
+import secrets
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class Span:
+    """
+    A timed operation within a trace. Spans nest: a span started while another is
+    current becomes its child. Use `Tracer.span` to create them.
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str,
+                 parent_id: Optional[str], attributes: Optional[Dict[str, Any]] = None):
+        self._tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = "ok"
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self._token: Optional[contextvars.Token] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def record_exception(self, exc: BaseException):
+        self.status = "error"
+        self.attributes["error.type"] = type(exc).__name__
+        self.attributes["error.message"] = str(exc)
+
+    @property
+    def traceparent(self) -> str:
+        "The W3C trace context header value that makes this span the parent"
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.record_exception(exc)
+        if self._token is not None:
+            _current_span.reset(self._token)
+        self.end_ns = time.time_ns()
+        self._tracer._export(self)
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    "Stands in for a span when tracing is off, so instrumented code costs next to nothing"
+
+    traceparent = None
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def record_exception(self, exc: BaseException):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_noop_span = _NoopSpan()
+_current_span: contextvars.ContextVar = contextvars.ContextVar("did_finder_span", default=None)
+
+
+class FileSpanExporter:
+    """
+    Append each finished span to a file as a line of JSON. Works with no collector or
+    network; the file can be loaded into a trace viewer afterwards.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+class Tracer:
+    """
+    Create spans and hand them to an exporter (anything with an `export(span)` method)
+    as they finish.
+    """
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> Span:
+        """
+        Start a span, as a child of the current span if there is one. Use it as a context
+        manager: the span is current, and timed, inside the `with` block.
+        :param name: The name of the operation
+        :param attributes: Tags to attach to the span
+        """
+        parent = _current_span.get()
+        trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        parent_id = parent.span_id if parent is not None else None
+        return Span(self, name, trace_id, parent_id, attributes)
+
+    def record_span(self, name: str, start_ns: int, end_ns: int,
+                    attributes: Optional[Dict[str, Any]] = None) -> Span:
+        """
+        Export a span for an operation that has already finished, as a child of the
+        current span. Use it where a `with` block does not fit, e.g. time spent inside a
+        generator between the values it yields.
+        :param name: The name of the operation
+        :param start_ns: When it started, in nanoseconds since the epoch
+        :param end_ns: When it finished, in nanoseconds since the epoch
+        :param attributes: Tags to attach to the span
+        """
+        span = self.span(name, attributes)
+        span.start_ns = start_ns
+        span.end_ns = end_ns
+        self._export(span)
+        return span
+
+    def _export(self, span: Span):
+        try:
+            self.exporter.export(span)
+        except Exception:
+            self.logger.exception(f"Unable to export span {span.name}")
+
+
+class _NoopTracer:
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> _NoopSpan:
+        return _noop_span
+
+    def record_span(self, name: str, start_ns: int, end_ns: int,
+                    attributes: Optional[Dict[str, Any]] = None) -> _NoopSpan:
+        return _noop_span
+
+
+_tracer: Any = _NoopTracer()
+
+
+def configure_tracing(exporter=None):
+    """
+    Turn tracing on for this process, sending finished spans to `exporter`. Pass None
+    to turn it off again.
+    """
+    global _tracer
+    _tracer = Tracer(exporter) if exporter is not None else _NoopTracer()
+
+
+def get_tracer():
+    "The process' tracer. When tracing is off its spans do nothing."
+    return _tracer
+
+
+def tracing_enabled() -> bool:
+    return isinstance(_tracer, Tracer)
+
+
+def current_span() -> Optional[Span]:
+    "The span that is current in this context, if any"
+    return _current_span.get()
+
+
+def inject_headers(headers: Dict[str, str]) -> Dict[str, str]:
+    """
+    Add the W3C `traceparent` header for the current span, so the ServiceX App can join
+    the trace
+    :param headers: The HTTP headers for a request. Updated in place.
+    :return: The headers
+    """
+    span = _current_span.get()
+    if span is not None:
+        headers["traceparent"] = span.traceparent
+    return headers
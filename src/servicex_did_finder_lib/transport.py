@@ -0,0 +1,165 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from abc import ABC, abstractmethod
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import uuid
+
+from kombu import Queue
+
+from servicex_did_finder_lib.health import get_metrics
+from servicex_did_finder_lib.tracing import get_tracer, inject_headers
+
+# The broker queue the ServiceX App reads file batches from
+FILE_QUEUE = "servicex_did_files"
+
+# Most files published in a single message
+BROKER_BATCH_SIZE = 1000
+
+# Times to retry publishing a message if the broker connection fails
+PUBLISH_RETRIES = 3
+
+
+def file_record(file_info: Dict[str, Any]) -> Dict[str, Any]:
+    "The fields of a file that are sent to ServiceX"
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "paths": file_info['paths'],
+        'adler32': file_info['adler32'],
+        'file_size': file_info['file_size'],
+        'file_events': file_info['file_events']
+    }
+
+
+class FileTransport(ABC):
+    """
+    Carries the files of a lookup to ServiceX. `servicex_adaptor.ServiceXAdapter`
+    sends them to the App's REST endpoint, `BrokerTransport` publishes them to a queue
+    on the broker.
+    """
+
+    @abstractmethod
+    def put_file_add_bulk(self, file_list: List[Dict[str, Any]], chunk_length=None):
+        """
+        Send files to ServiceX. This may return before they have been delivered.
+        :param file_list: The files to send
+        :param chunk_length: If given, the most files to send in a single message
+        """
+
+    @abstractmethod
+    def put_fileset_complete(self, summary: Dict[str, Any]):
+        """
+        Tell ServiceX every file has been sent, once they have all been delivered
+        :param summary: The totals for the fileset
+        """
+
+    def close(self):
+        "Wait for every file that has been sent to be delivered"
+
+
+class BrokerTransport(FileTransport):
+    """
+    Publishes the files of a lookup to a durable queue, using the Celery app's broker
+    connection, so the App can take them at its own pace. Each message is a JSON object:
+
+    * `{"type": "file-add", "dataset-id", "lookup-id", "batch", "files": [...]}`
+    * `{"type": "complete", "dataset-id", "lookup-id", "summary": {...}}`
+
+    File messages carry an `idempotency-key` header (`<lookup id>-<batch>`), so a
+    message that is redelivered can be ignored. Messages are persistent.
+    """
+
+    def __init__(self, app, dataset_id, queue: str = FILE_QUEUE,
+                 lookup_id: Optional[str] = None,
+                 batch_size: int = BROKER_BATCH_SIZE):
+        """
+        :param app: The Celery app whose broker connection is used
+        :param dataset_id: The dataset the files belong to
+        :param queue: The queue to publish to
+        :param lookup_id: Identifies the lookup in each message. Defaults to a random id.
+        :param batch_size: Most files in each message
+        """
+        self.app = app
+        self.dataset_id = dataset_id
+        self.queue = Queue(queue, durable=True)
+        self.lookup_id = lookup_id or uuid.uuid4().hex
+        self.batch_size = max(1, batch_size)
+        self._next_batch = 0
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def put_file_add_bulk(self, file_list, chunk_length=None):
+        batch_size = chunk_length or self.batch_size
+        for start in range(0, len(file_list), batch_size):
+            batch = [file_record(f) for f in file_list[start:start + batch_size]]
+            key = f"{self.lookup_id}-{self._next_batch}"
+            message = {
+                "type": "file-add",
+                "dataset-id": self.dataset_id,
+                "lookup-id": self.lookup_id,
+                "batch": self._next_batch,
+                "files": batch,
+            }
+            self._next_batch += 1
+
+            body = json.dumps(message)
+            metrics = get_metrics()
+            metrics.upload_queued(len(body))
+            sent = False
+            try:
+                with get_tracer().span("broker.publish",
+                                       {"dataset_id": self.dataset_id, "files": len(batch)}):
+                    sent = self._publish(message, {"idempotency-key": key})
+            finally:
+                metrics.upload_finished(len(body), len(batch) if sent else 0)
+
+    def put_fileset_complete(self, summary):
+        with get_tracer().span("broker.put_complete", {"dataset_id": self.dataset_id}):
+            self._publish({
+                "type": "complete",
+                "dataset-id": self.dataset_id,
+                "lookup-id": self.lookup_id,
+                "summary": summary,
+            }, {})
+
+    def _publish(self, message: Dict[str, Any], headers: Dict[str, str]) -> bool:
+        try:
+            with self.app.producer_or_acquire() as producer:
+                producer.publish(message, exchange="", routing_key=self.queue.name,
+                                 declare=[self.queue], serializer="json",
+                                 delivery_mode="persistent", headers=inject_headers(headers),
+                                 retry=True, retry_policy={"max_retries": PUBLISH_RETRIES})
+            return True
+        except Exception:
+            self.logger.exception(f"Failed to publish a {message['type']} message for "
+                                  f"dataset {self.dataset_id} to {self.queue.name} - "
+                                  f"Ignoring error.")
+            return False
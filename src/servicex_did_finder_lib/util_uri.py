@@ -1,12 +1,29 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
+import re
 import urllib
 
 
 class ParsedDIDInfo:
-    def __init__(self, did: str, get_mode: str, file_count: int):
+    def __init__(self, did: str, get_mode: str, file_count: int,
+                 path_glob: Optional[str] = None,
+                 path_regex: Optional[str] = None,
+                 min_size: Optional[int] = None,
+                 max_size: Optional[int] = None,
+                 min_events: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 sample: Optional[float] = None,
+                 event_count: Optional[int] = None):
         self.did = did
         self.get_mode = get_mode
         self.file_count = file_count
+        self.path_glob = path_glob
+        self.path_regex = path_regex
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_events = min_events
+        self.timeout = timeout
+        self.sample = sample
+        self.event_count = event_count
 
     # The did to pass into the library
     did: str
@@ -17,6 +34,72 @@ class ParsedDIDInfo:
     # Number of files to fetch (default '-1')
     file_count: int
 
+    # Glob that at least one of the file's paths must match (default None)
+    path_glob: Optional[str]
+
+    # Regular expression that at least one of the file's paths must match (default None)
+    path_regex: Optional[str]
+
+    # Smallest file size, in bytes, to keep (default None)
+    min_size: Optional[int]
+
+    # Largest file size, in bytes, to keep (default None)
+    max_size: Optional[int]
+
+    # Smallest number of events in a file to keep (default None)
+    min_events: Optional[int]
+
+    # Seconds the lookup may run before it is cut short (default None)
+    timeout: Optional[float]
+
+    # Fraction of the files to keep, picked by a hash of their path (default None)
+    sample: Optional[float]
+
+    # Stop adding files, in path order, once they hold this many events (default None)
+    event_count: Optional[int]
+
+
+_size_units = {'': 1, 'k': 10**3, 'm': 10**6, 'g': 10**9, 't': 10**12}
+_size_re = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*([kmgt]?)b?\s*$', re.IGNORECASE)
+
+
+def _parse_size(name: str, value: str) -> int:
+    '''Parse a byte count, allowing a decimal unit suffix (e.g. `1GB`, `500M`)'''
+    m = _size_re.match(value)
+    if m is None:
+        raise ValueError(f'Bad value for "{name}" in DID - must be a byte count like 1000, '
+                         f'500MB or 1GB, not "{value}"')
+    return int(float(m.group(1)) * _size_units[m.group(2).lower()])
+
+
+def _parse_int(name: str, value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'Bad value for "{name}" in DID - must be an integer, not "{value}"')
+
+
+def _parse_seconds(name: str, value: str) -> float:
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = -1.0
+    if not seconds > 0:
+        raise ValueError(f'Bad value for "{name}" in DID - must be a positive number of '
+                         f'seconds, not "{value}"')
+    return seconds
+
+
+def _parse_fraction(name: str, value: str) -> float:
+    try:
+        fraction = float(value)
+    except ValueError:
+        fraction = -1.0
+    if not 0 < fraction <= 1:
+        raise ValueError(f'Bad value for "{name}" in DID - must be a fraction greater than 0 '
+                         f'and at most 1, not "{value}"')
+    return fraction
+
 
 def parse_did_uri(uri: str) -> ParsedDIDInfo:
     '''Parse the uri that is given to us from ServiceX, pulling out
@@ -27,6 +110,14 @@ def parse_did_uri(uri: str) -> ParsedDIDInfo:
 
     * `files` - Number of files to fetch (default is all)
     * `get` - Mode to get the files (default is 'all'). Only "available" is also supported.
+    * `path` - Glob that one of the file's paths must match (e.g. `*DAOD_PHYS*`)
+    * `path_regex` - Regular expression that one of the file's paths must match
+    * `min_size`, `max_size` - Bounds on the file size in bytes (`1GB`, `500MB` are allowed)
+    * `min_events` - Smallest number of events in a file
+    * `timeout` - Seconds the lookup may run before it is cut short
+    * `sample` - Fraction of the files to keep (e.g. `0.1`). The same files, by file name,
+      are picked on every run.
+    * `events` - Keep the first files, in path order, until they hold this many events
 
     Args:
         uri (str): DID from ServiceX
@@ -44,7 +135,34 @@ def parse_did_uri(uri: str) -> ParsedDIDInfo:
         raise ValueError('Bad value for "get" string in DID - must be "all" or "available", not '
                          f'"{get_string}"')
 
-    for k in ['get', 'files']:
+    path_glob = None if 'path' not in params else params['path'][-1]
+    path_regex = None if 'path_regex' not in params else params['path_regex'][-1]
+    if path_regex is not None:
+        try:
+            re.compile(path_regex)
+        except re.error as e:
+            raise ValueError(f'Bad value for "path_regex" in DID - "{path_regex}": {e}')
+
+    min_size = None if 'min_size' not in params \
+        else _parse_size('min_size', params['min_size'][-1])
+    max_size = None if 'max_size' not in params \
+        else _parse_size('max_size', params['max_size'][-1])
+    min_events = None if 'min_events' not in params \
+        else _parse_int('min_events', params['min_events'][-1])
+
+    timeout = None if 'timeout' not in params \
+        else _parse_seconds('timeout', params['timeout'][-1])
+
+    sample = None if 'sample' not in params \
+        else _parse_fraction('sample', params['sample'][-1])
+    event_count = None if 'events' not in params \
+        else _parse_int('events', params['events'][-1])
+    if event_count is not None and event_count <= 0:
+        raise ValueError(f'Bad value for "events" in DID - must be a positive integer, not '
+                         f'"{event_count}"')
+
+    for k in ['get', 'files', 'path', 'path_regex', 'min_size', 'max_size', 'min_events',
+              'timeout', 'sample', 'events']:
         if k in params:
             del params[k]
 
@@ -57,4 +175,7 @@ def parse_did_uri(uri: str) -> ParsedDIDInfo:
     if len(new_query) > 0:
         new_query = "?" + new_query
 
-    return ParsedDIDInfo(info._replace(query="").geturl() + new_query, get_string, file_count)
+    return ParsedDIDInfo(info._replace(query="").geturl() + new_query, get_string, file_count,
+                         path_glob=path_glob, path_regex=path_regex,
+                         min_size=min_size, max_size=max_size, min_events=min_events,
+                         timeout=timeout, sample=sample, event_count=event_count)
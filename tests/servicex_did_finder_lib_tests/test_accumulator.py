@@ -29,6 +29,8 @@ import pytest
 
 from servicex_did_finder_lib.accumulator import Accumulator
 from servicex_did_finder_lib.did_summary import DIDSummary
+from servicex_did_finder_lib.memory import MemoryLimitExceeded, MemoryLimits, record_bytes
+from servicex_did_finder_lib.path_rewrite import PathRewriter
 from servicex_did_finder_lib.servicex_adaptor import ServiceXAdapter
 
 
@@ -80,3 +82,134 @@ def test_invalid_constructor_arg(servicex, did_summary_obj):
     with pytest.raises(ValueError):
         acc = Accumulator(sx=servicex, sum=did_summary_obj)
         acc.add("not a dict!")
+
+
+def test_send_on_transforms(servicex, did_summary_obj, single_file_info):
+    def drop_first(files):
+        return files[1:]
+
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, transforms=[drop_first])
+    acc.add([single_file_info, single_file_info])
+    acc.send_on(-1)
+    servicex.put_file_add_bulk.assert_called_with([single_file_info])
+    # The summary describes the files as found, before the transforms
+    assert acc.summary.file_count == 2
+
+
+def test_summary_ignores_path_rewrites(servicex, did_summary_obj):
+    files = [_file(i) for i in range(3)]
+    expected = DIDSummary("did")
+    expected.add_files(files)
+
+    rewriter = PathRewriter.from_prefix("root://cache:1094//", keep_originals=True)
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, transforms=[rewriter])
+    acc.add([dict(f) for f in files])
+    acc.send_on(-1)
+
+    assert len(servicex.put_file_add_bulk.call_args[0][0][0]["paths"]) == 2
+    assert acc.summary.digest == expected.digest
+    assert acc.summary.distribution()["replicas"] == {"min": 1, "max": 1, "mean": 1.0}
+
+
+def _file(i):
+    return {"paths": [f"root://site//file{i:03}.root"], "adler32": 0, "file_size": 1,
+            "file_events": 1}
+
+
+def _sent_paths(servicex):
+    return [f["paths"][0] for f in servicex.put_file_add_bulk.call_args[0][0]]
+
+
+def test_soft_limit_spills(servicex, did_summary_obj, tmp_path):
+    memory = MemoryLimits(soft_limit=5 * record_bytes(_file(0)), spill_dir=str(tmp_path))
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, memory=memory)
+    for i in reversed(range(20)):
+        acc.add(_file(i))
+
+    assert acc.cache_len == 20
+    assert acc.cache_bytes <= memory.soft_limit
+    acc.send_on(7)
+    assert _sent_paths(servicex) == [_file(i)["paths"][0] for i in range(7)]
+    assert acc.cache_len == 0
+
+
+def test_soft_limit_keeps_first_files(servicex, did_summary_obj, mocker):
+    spill = mocker.patch("servicex_did_finder_lib.accumulator.SpillFile")
+    memory = MemoryLimits(soft_limit=5 * record_bytes(_file(0)))
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, memory=memory, max_files=3)
+    for i in reversed(range(20)):
+        acc.add(_file(i))
+
+    spill.assert_not_called()
+    assert acc.cache_len <= 5
+    acc.send_on(3)
+    assert _sent_paths(servicex) == [_file(i)["paths"][0] for i in range(3)]
+
+
+def test_soft_limit_merges_spills(servicex, did_summary_obj, tmp_path):
+    memory = MemoryLimits(soft_limit=2 * record_bytes(_file(0)), spill_dir=str(tmp_path))
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, memory=memory, max_files=4)
+    for i in reversed(range(20)):
+        acc.add(_file(i))
+
+    assert len(acc._spills) == 1
+    assert acc.cache_len <= 4 + 2
+    acc.send_on(4)
+    assert _sent_paths(servicex) == [_file(i)["paths"][0] for i in range(4)]
+
+
+def test_hard_limit(servicex, did_summary_obj):
+    memory = MemoryLimits(hard_limit=3 * record_bytes(_file(0)))
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, memory=memory)
+    acc.add([_file(0), _file(1), _file(2)])
+    with pytest.raises(MemoryLimitExceeded):
+        acc.add(_file(3))
+    assert acc.cache_len == 0
+    assert acc.peak_bytes == 4 * record_bytes(_file(0))
+
+
+def test_send_on_event_budget(servicex, did_summary_obj):
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, max_events=25)
+    acc.add([dict(_file(i), file_events=10) for i in reversed(range(6))])
+
+    acc.send_on(-1)
+    assert _sent_paths(servicex) == [_file(i)["paths"][0] for i in range(3)]
+
+
+def test_soft_limit_keeps_event_budget(servicex, did_summary_obj, mocker):
+    spill = mocker.patch("servicex_did_finder_lib.accumulator.SpillFile")
+    memory = MemoryLimits(soft_limit=5 * record_bytes(_file(0)))
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, memory=memory, max_events=2)
+    for i in reversed(range(20)):
+        acc.add(_file(i))
+
+    spill.assert_not_called()
+    acc.send_on(-1)
+    assert _sent_paths(servicex) == [_file(i)["paths"][0] for i in range(2)]
+
+
+def test_intern_paths(servicex, did_summary_obj, tmp_path):
+    prefix = "root://site.domain:1094//pnfs/site.domain/atlas/rucio/mc16_13TeV/"
+    files = [{"paths": [f"{prefix}file{i:03}.root", f"root://b//file{i:03}.root"],
+              "adler32": 0, "file_size": 1, "file_events": 1} for i in range(20)]
+    memory = MemoryLimits(soft_limit=5 * record_bytes(files[0]), spill_dir=str(tmp_path))
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, memory=memory, intern_paths=True)
+    for f in reversed(files):
+        acc.add(dict(f))
+
+    assert record_bytes(next(iter(acc._spills[0]))) < record_bytes(files[0])
+    acc.send_on(7)
+    assert servicex.put_file_add_bulk.call_args[0][0] == files[:7]
+
+
+@pytest.mark.parametrize("intern_paths", [False, True])
+def test_intern_paths_keeps_path_order(servicex, did_summary_obj, intern_paths):
+    prefix = "root://site.domain:1094//pnfs/site.domain/atlas/rucio/mc16_13TeV/"
+    files = [{"paths": [prefix + name], "adler32": 0, "file_size": 1, "file_events": 1}
+             for name in ("zz.root", "a/f.root")]
+    acc = Accumulator(sx=servicex, sum=did_summary_obj, max_files=1,
+                      intern_paths=intern_paths)
+    acc.add([dict(f) for f in files])
+
+    acc.send_on(1)
+    assert _sent_paths(servicex) == [prefix + "a/f.root"]
@@ -0,0 +1,76 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from servicex_did_finder_lib.chunk_controller import ChunkController, get_chunk_controller
+
+
+def test_grows_when_full_and_fast():
+    c = ChunkController(initial_records=100, increase=50)
+    c.on_success(0.1, full=True)
+    assert c.max_records == 150
+
+
+def test_no_growth_when_not_full():
+    c = ChunkController(initial_records=100)
+    c.on_success(0.1, full=False)
+    assert c.max_records == 100
+
+
+def test_growth_capped():
+    c = ChunkController(initial_records=100, max_records=120, increase=50)
+    c.on_success(0.1, full=True)
+    assert c.max_records == 120
+
+
+def test_slow_response_shrinks():
+    c = ChunkController(initial_records=100, slow_response=2.0)
+    c.on_success(3.0, full=True)
+    assert c.max_records == 50
+    assert c.max_bytes == c.max_bytes_limit
+
+
+def test_overload_shrinks_to_floor():
+    c = ChunkController(initial_records=100, min_records=30)
+    c.on_overload()
+    c.on_overload()
+    assert c.max_records == 30
+
+
+def test_too_large_shrinks_bytes():
+    c = ChunkController(initial_records=100, max_bytes=1000, min_bytes=100)
+    c.on_too_large()
+    assert c.max_records == 50
+    assert c.max_bytes == 500
+
+    c.on_success(0.1, full=True)
+    assert c.max_bytes == 600
+
+
+def test_per_endpoint_registry():
+    a = get_chunk_controller('http://test-registry-a/')
+    assert get_chunk_controller('http://test-registry-a/') is a
+    assert get_chunk_controller('http://test-registry-b/') is not a
@@ -0,0 +1,149 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+import pytest
+import requests
+import responses
+
+from servicex_did_finder_lib import chunk_controller, circuit_breaker, servicex_adaptor
+from servicex_did_finder_lib.circuit_breaker import (CLOSED, HALF_OPEN, OPEN, CircuitBreaker,
+                                                     circuit_states, get_circuit_breaker)
+from servicex_did_finder_lib.servicex_adaptor import ServiceXAdapter
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+    monkeypatch.setattr(chunk_controller, "_controllers", {})
+
+
+def _fail(breaker, times):
+    for _ in range(times):
+        assert breaker.allow(0)
+        breaker.record_failure()
+
+
+def test_opens_after_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    _fail(breaker, 2)
+    breaker.record_success()
+    _fail(breaker, 2)
+    assert breaker.state == CLOSED
+    _fail(breaker, 1)
+    assert breaker.state == OPEN
+    assert not breaker.allow(0)
+
+
+def test_half_open_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.02)
+    _fail(breaker, 1)
+    time.sleep(0.03)
+    assert breaker.allow(0)
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow(0)  # Only one probe at a time
+
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow(0)
+
+
+def test_failed_probe_backs_off():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.02, max_reset_timeout=0.03)
+    _fail(breaker, 1)
+    time.sleep(0.03)
+    assert breaker.allow(0)
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker._open_for == 0.03
+    assert not breaker.allow(0.01)
+
+
+def test_parked_requests_resume():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.02)
+    _fail(breaker, 1)
+    results = []
+    parked = [threading.Thread(target=lambda: results.append(breaker.allow(5)))
+              for _ in range(3)]
+    for t in parked:
+        t.start()
+
+    # One of the parked requests is the probe - the others wait for its result
+    for _ in range(100):
+        if results:
+            break
+        time.sleep(0.01)
+    assert results == [True]
+    breaker.record_success()
+    for t in parked:
+        t.join()
+    assert results == [True, True, True]
+
+
+@responses.activate
+def test_adapter_shares_breaker(monkeypatch):
+    monkeypatch.setattr(servicex_adaptor, "MAX_PARK", 0.05)
+    responses.add(responses.PUT, 'http://servicex.org/1/files',
+                  body=requests.exceptions.ConnectionError("App is down"))
+    files = [{"paths": ["root://site//file.root"], "adler32": 0, "file_size": 1,
+              "file_events": 1}]
+
+    sx = ServiceXAdapter("http://servicex.org/", '1', max_in_flight=1)
+    sx.put_file_add_bulk(files)
+    sx.put_file_add_bulk(files)
+    sx.close()
+    assert len(responses.calls) == 5  # Opens after 5 failures, holding the 6th try
+
+    other = ServiceXAdapter("http://servicex.org/", '2')
+    other.put_fileset_complete({"files": 0})
+    assert len(responses.calls) == 5
+    assert circuit_states() == {"http://servicex.org/": OPEN}
+    assert get_circuit_breaker("http://servicex.org/") is \
+        get_circuit_breaker("http://servicex.org/")
+
+
+@responses.activate
+def test_unexpected_error_releases_probe(monkeypatch):
+    monkeypatch.setattr(servicex_adaptor, "MAX_PARK", 0.05)
+    responses.add(responses.PUT, 'http://servicex.org/1/complete',
+                  body=requests.exceptions.InvalidHeader("Bad header"))
+    breaker = get_circuit_breaker("http://servicex.org/")
+    breaker.reset_timeout = breaker._open_for = 0.02
+    _fail(breaker, breaker.failure_threshold)
+    time.sleep(0.03)
+
+    sx = ServiceXAdapter("http://servicex.org/", '1')
+    with pytest.raises(requests.exceptions.InvalidHeader):
+        sx._put_fileset_complete({"files": 0})
+
+    # The failed probe reopened the circuit, rather than leaving it half-open forever
+    assert breaker.state == OPEN
+    assert not breaker._probing
+    time.sleep(0.05)
+    assert breaker.allow(0)
@@ -0,0 +1,163 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+import pika
+from make_it_sync import make_sync
+
+from servicex_did_finder_lib import communication
+from servicex_did_finder_lib.communication import _ConcurrentConsumer, rabbit_mq_callback
+
+
+class FakeConnection:
+    "Stands in for a pika BlockingConnection"
+    def __init__(self):
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_callback_threadsafe(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def process_data_events(self, time_limit=0):
+        time.sleep(0.01)
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for c in callbacks:
+            c()
+
+
+class FakeMethod:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+def test_callback_acks_bad_message(mocker):
+    channel = mocker.Mock()
+    rabbit_mq_callback(None, channel, FakeMethod(7), None, b"not json")
+    channel.basic_ack.assert_called_once_with(delivery_tag=7)
+
+
+def test_concurrent_lookups(mocker, monkeypatch):
+    barrier = threading.Barrier(3, timeout=5)
+    processed = []
+
+    def process(user_callback, body):
+        barrier.wait()  # Only passes if all three requests run at the same time
+        processed.append(body)
+
+    monkeypatch.setattr(communication, "_process_did_request", process)
+
+    ack_threads = []
+    channel = mocker.Mock()
+    channel.basic_ack.side_effect = lambda delivery_tag: \
+        ack_threads.append(threading.current_thread())
+    consumer = _ConcurrentConsumer(FakeConnection(), channel, None, max_workers=3)
+
+    for tag in range(3):
+        consumer.on_message(channel, FakeMethod(tag), None, f"request {tag}")
+    assert consumer.in_flight == 3
+
+    consumer.drain(poll_interval=0.01)
+
+    assert sorted(processed) == ["request 0", "request 1", "request 2"]
+    assert consumer.in_flight == 0
+    assert sorted(c.kwargs["delivery_tag"] for c in channel.basic_ack.call_args_list) == \
+        [0, 1, 2]
+    assert all(t is threading.current_thread() for t in ack_threads)
+
+
+def test_ack_after_failure(mocker, monkeypatch):
+    def process(user_callback, body):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(communication, "_process_did_request", process)
+    channel = mocker.Mock()
+    consumer = _ConcurrentConsumer(FakeConnection(), channel, None, max_workers=1)
+    consumer.on_message(channel, FakeMethod(3), None, "request")
+    consumer.drain(poll_interval=0.01)
+    channel.basic_ack.assert_called_once_with(delivery_tag=3)
+
+
+def test_stop(mocker):
+    connection = FakeConnection()
+    channel = mocker.Mock()
+    consumer = _ConcurrentConsumer(connection, channel, None, max_workers=1)
+    consumer.stop()
+    channel.stop_consuming.assert_not_called()
+    connection.process_data_events()
+    channel.stop_consuming.assert_called_once()
+
+
+def test_abandon_lost_connection(mocker, monkeypatch):
+    release = threading.Event()
+
+    def process(user_callback, body):
+        release.wait(timeout=5)
+
+    monkeypatch.setattr(communication, "_process_did_request", process)
+    connection = mocker.Mock()
+    connection.add_callback_threadsafe.side_effect = \
+        pika.exceptions.ConnectionWrongStateError("closed")
+    consumer = _ConcurrentConsumer(connection, mocker.Mock(), None, max_workers=1)
+    consumer.on_message(None, FakeMethod(3), None, "request")
+
+    consumer.abandon()  # Doesn't wait for the running request
+    assert consumer.in_flight == 1
+    release.set()
+    consumer._executor.shutdown(wait=True)
+    connection.add_callback_threadsafe.assert_called_once()
+
+
+def test_init_rabbit_mq_reconnects(mocker):
+    lost = mocker.Mock()
+    lost.channel.return_value.start_consuming.side_effect = \
+        pika.exceptions.StreamLostError("lost")
+    ok = mocker.Mock()
+    mocker.patch.object(communication.pika, "BlockingConnection", side_effect=[lost, ok])
+    abandon = mocker.spy(_ConcurrentConsumer, "abandon")
+    mocker.patch.object(communication.time, "sleep")
+
+    communication.init_rabbit_mq(None, "amqp://", "queue", retries=1, retry_interval=0,
+                                 concurrency=4, prefetch_count=0)
+
+    abandon.assert_called_once()
+    ok.channel.return_value.basic_qos.assert_called_once_with(prefetch_count=0)
+    ok.close.assert_called_once()
+
+
+def test_invalid_did_completes_fileset(mocker):
+    servicex = mocker.Mock()
+    callback = mocker.Mock()
+    make_sync(communication.run_file_fetch_loop)('did?min_size=lots', servicex,
+                                                 {"dataset-id": 1}, callback)
+
+    callback.assert_not_called()
+    servicex.put_fileset_complete.assert_called_once()
+    assert servicex.put_fileset_complete.call_args[0][0]["files"] == 0
@@ -25,12 +25,21 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-from unittest.mock import patch
+import time
+from unittest.mock import Mock, patch
 import pytest
 from celery import Celery
+from celery.contrib.testing.worker import start_worker
+from celery.exceptions import SoftTimeLimitExceeded
 
 from servicex_did_finder_lib.accumulator import Accumulator
-from servicex_did_finder_lib.did_finder_app import DIDFinderTask, DIDFinderApp
+from servicex_did_finder_lib.did_finder_app import (LOOKUP_TIMEOUT_GRACE, DIDFinderTask,
+                                                    DIDFinderApp)
+from servicex_did_finder_lib.did_summary import DIDSummary
+from servicex_did_finder_lib.enrichment import MetadataEnricher
+from servicex_did_finder_lib.local_sink import LocalServiceX
+from servicex_did_finder_lib.path_rewrite import PathRewriter
+from servicex_did_finder_lib.routing import LookupRouter
 
 
 @pytest.fixture()
@@ -45,6 +54,12 @@ def servicex(mocker):
         yield sx_ctor
 
 
+def _digest(files):
+    summary = DIDSummary('did')
+    summary.add_files(files)
+    return summary.digest
+
+
 def test_did_finder_task(mocker, servicex, single_file_info):
     did_finder_task = DIDFinderTask()
     # did_finder_task.app = mocker.Mock()
@@ -57,7 +72,8 @@ def test_did_finder_task(mocker, servicex, single_file_info):
     ) as acc:
         acc.return_value = mock_accumulator
         did_finder_task.do_lookup('did', 1, 'https://my-servicex', mock_generator)
-        servicex.assert_called_with(dataset_id=1, endpoint="https://my-servicex")
+        servicex.assert_called_with(dataset_id=1, endpoint="https://my-servicex",
+                                    lookup_id=None)
         acc.assert_called_once()
 
         mock_accumulator.add.assert_called_with(single_file_info)
@@ -70,6 +86,8 @@ def test_did_finder_task(mocker, servicex, single_file_info):
                 "total-events": 0,
                 "total-bytes": 0,
                 "elapsed-time": 0,
+                "file-stats": DIDSummary('did').distribution(),
+                "fileset-digest": DIDSummary('did').digest,
             }
         )
 
@@ -86,7 +104,8 @@ def test_did_finder_task_exception(mocker, servicex, single_file_info):
     ) as acc:
         acc.return_value = mock_accumulator
         did_finder_task.do_lookup('did', 1, 'https://my-servicex', mock_generator)
-        servicex.assert_called_with(dataset_id=1, endpoint="https://my-servicex")
+        servicex.assert_called_with(dataset_id=1, endpoint="https://my-servicex",
+                                    lookup_id=None)
         acc.assert_called_once()
 
         mock_accumulator.add.assert_not_called()
@@ -99,10 +118,263 @@ def test_did_finder_task_exception(mocker, servicex, single_file_info):
                 "total-events": 0,
                 "total-bytes": 0,
                 "elapsed-time": 0,
+                "file-stats": DIDSummary('did').distribution(),
             }
         )
 
 
+def test_did_finder_task_filter(mocker, servicex, single_file_info):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    big_file = dict(single_file_info, file_size=2000000000)
+    mock_generator = mocker.Mock(return_value=iter([single_file_info,
+                                                    [single_file_info, big_file]]))
+
+    did_finder_task.do_lookup('did?min_size=1GB', 1, 'https://my-servicex', mock_generator)
+
+    info = mock_generator.call_args[0][1]
+    assert info['file-filter'].min_size == 1000000000
+
+    servicex.return_value.put_file_add_bulk.assert_called_once_with([big_file])
+    stats = servicex.return_value.put_fileset_complete.call_args[0][0]["file-stats"]
+    assert stats["file-size"]["count"] == 1
+    assert stats["replicas"]["max"] == 1
+    servicex.return_value.put_fileset_complete.assert_called_with(
+        {
+            "files": 1,
+            "files-skipped": 2,
+            "total-events": 0,
+            "total-bytes": 2000000000,
+            "elapsed-time": 0,
+            "file-stats": mocker.ANY,
+            "fileset-digest": _digest([big_file]),
+        }
+    )
+
+
+def test_did_finder_task_invalid_records(mocker, servicex, single_file_info):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    no_events = {"paths": ["a/file"], "adler32": 0, "file_size": 10}
+    mock_generator = mocker.Mock(return_value=iter([
+        [single_file_info, {"adler32": 0}, no_events],
+        "not a record",
+    ]))
+
+    did_finder_task.do_lookup('did', 1, 'https://my-servicex', mock_generator)
+
+    servicex.return_value.put_file_add_bulk.assert_called_once_with(
+        [dict(no_events, file_events=0), single_file_info]
+    )
+    complete = servicex.return_value.put_fileset_complete.call_args[0][0]
+    assert complete["files"] == 2
+    assert complete["files-skipped"] == 2
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _slow_finder(clock, single_file_info, closed):
+    "Each file takes 10 seconds to find"
+    def finder(did, info, args):
+        try:
+            for i in range(10):
+                clock.now += 10
+                yield dict(single_file_info, paths=[f"file{i}"])
+        finally:
+            closed.append(True)
+    return finder
+
+
+@pytest.mark.parametrize("did, files_sent", [
+    ("did?timeout=25&get=available", 3),
+    ("did?timeout=25&get=available&files=2", 2),
+    ("did?timeout=25", 3),  # Sent as they were found, before the timeout
+    ("did?timeout=25&files=2", 0),
+    ("did?timeout=500", 10),
+])
+def test_did_finder_task_timeout(monkeypatch, servicex, single_file_info, did, files_sent):
+    clock = FakeClock()
+    monkeypatch.setattr("servicex_did_finder_lib.did_finder_app.time.monotonic", clock)
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    closed = []
+
+    did_finder_task.do_lookup(did, 1, 'https://my-servicex',
+                              _slow_finder(clock, single_file_info, closed))
+
+    sent = [f for c in servicex.return_value.put_file_add_bulk.call_args_list for f in c[0][0]]
+    assert len(sent) == files_sent
+    assert closed == [True]
+    servicex.return_value.put_fileset_complete.assert_called_once()
+
+
+def test_did_finder_task_app_timeout(monkeypatch, servicex, single_file_info):
+    clock = FakeClock()
+    monkeypatch.setattr("servicex_did_finder_lib.did_finder_app.time.monotonic", clock)
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    monkeypatch.setattr(did_finder_task.app, "lookup_timeout", 15, raising=False)
+
+    did_finder_task.do_lookup("did?timeout=500&get=available", 1, 'https://my-servicex',
+                              _slow_finder(clock, single_file_info, []))
+
+    assert servicex.return_value.put_file_add_bulk.call_count == 2
+
+
+def test_did_finder_task_time_limit(servicex, single_file_info):
+    app = DIDFinderApp('foo', did_finder_args={}, lookup_timeout=15)
+
+    def blocked_finder(did, info, args):
+        yield single_file_info
+        raise SoftTimeLimitExceeded()
+
+    @app.did_lookup_task(name="did_finder_foo.lookup_dataset")
+    def lookup_dataset(self, did: str, dataset_id: int, endpoint: str) -> None:
+        self.do_lookup(did=did, dataset_id=dataset_id, endpoint=endpoint,
+                       user_did_finder=blocked_finder)
+
+    assert lookup_dataset.soft_time_limit == 15 + LOOKUP_TIMEOUT_GRACE
+    lookup_dataset.run(did='did', dataset_id=1, endpoint='https://my-servicex')
+
+    servicex.return_value.put_file_add_bulk.assert_called_once()
+    complete = servicex.return_value.put_fileset_complete.call_args.args[0]
+    assert complete["files"] == 1
+    assert "fileset-digest" not in complete
+
+
+@pytest.mark.parametrize("finder_error, recorded", [(None, 1), (RuntimeError("Boom"), 0)])
+def test_did_finder_task_records_finished_lookups(mocker, monkeypatch, servicex,
+                                                  single_file_info, finder_error, recorded):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    router = mocker.Mock(LookupRouter)
+    monkeypatch.setattr(did_finder_task.app, "lookup_router", router, raising=False)
+
+    def finder(did, info, args):
+        yield single_file_info
+        if finder_error is not None:
+            raise finder_error
+
+    did_finder_task.do_lookup('did', 1, 'https://my-servicex', finder)
+
+    assert router.record.call_count == recorded
+
+
+def test_did_finder_task_invalid_did(mocker, servicex):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    finder = mocker.Mock()
+
+    did_finder_task.do_lookup('did?min_size=lots', 1, 'https://my-servicex', finder)
+
+    finder.assert_not_called()
+    servicex.return_value.put_fileset_complete.assert_called_once()
+    complete = servicex.return_value.put_fileset_complete.call_args[0][0]
+    assert complete["files"] == 0
+    assert "fileset-digest" not in complete
+
+
+def test_did_finder_task_path_rewrite(mocker, monkeypatch, servicex, single_file_info):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    monkeypatch.setattr(did_finder_task.app, "path_rewriter",
+                        PathRewriter.from_prefix("root://xcache//", keep_originals=True),
+                        raising=False)
+    mock_generator = mocker.Mock(return_value=iter([single_file_info]))
+
+    did_finder_task.do_lookup('did', 1, 'https://my-servicex', mock_generator)
+
+    servicex.return_value.put_file_add_bulk.assert_called_once_with(
+        [dict(single_file_info, paths=["root://xcache//fork/it/over", "fork/it/over"])]
+    )
+
+
+def test_did_finder_task_event_budget(servicex, single_file_info):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    finder_files = [dict(single_file_info, paths=[f"root://site//file{i}"], file_events=400)
+                    for i in reversed(range(10))]
+
+    did_finder_task.do_lookup('did?events=1000', 1, 'https://my-servicex',
+                              lambda did, info, args: iter(finder_files))
+
+    servicex.return_value.put_file_add_bulk.assert_called_once()
+    sent = servicex.return_value.put_file_add_bulk.call_args[0][0]
+    assert [f["paths"][0] for f in sent] == [f"root://site//file{i}" for i in range(3)]
+    assert servicex.return_value.put_fileset_complete.call_args[0][0]["total-events"] == 1200
+
+
+def test_did_finder_task_metadata_enricher(monkeypatch, servicex, single_file_info):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    sizes = {f"root://site//file{i}": i * 100 for i in range(5)}
+    monkeypatch.setattr(did_finder_task.app, "metadata_enricher",
+                        MetadataEnricher(lambda f: {"file_size": sizes[f["paths"][0]]}),
+                        raising=False)
+    finder_files = [dict(single_file_info, paths=[p], file_size=0) for p in sizes] + [{}]
+
+    did_finder_task.do_lookup('did?min_size=250', 1, 'https://my-servicex',
+                              lambda did, info, args: iter(finder_files))
+
+    sent = [f for c in servicex.return_value.put_file_add_bulk.call_args_list for f in c[0][0]]
+    assert sorted(f["file_size"] for f in sent) == [300, 400]
+    complete = servicex.return_value.put_fileset_complete.call_args[0][0]
+    assert complete["files-skipped"] == 4
+
+
+def test_did_finder_task_metadata_enricher_keeps_batches(monkeypatch, servicex,
+                                                         single_file_info):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    monkeypatch.setattr(did_finder_task.app, "metadata_enricher",
+                        MetadataEnricher(lambda f: {}), raising=False)
+    batch = [dict(single_file_info, paths=[f"root://site//file{i}"], file_events=10)
+             for i in range(50)]
+
+    did_finder_task.do_lookup('did', 1, 'https://my-servicex',
+                              lambda did, info, args: iter([batch]))
+
+    servicex.return_value.put_file_add_bulk.assert_called_once()
+    assert len(servicex.return_value.put_file_add_bulk.call_args[0][0]) == 50
+
+
+def test_did_finder_task_previous_digest(servicex, single_file_info):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    finder_files = [dict(single_file_info, paths=[f"root://site//file{i}"]) for i in range(3)]
+
+    def finder(did, info, args):
+        info["previous-fileset-digest"] = "abc123"
+        yield from finder_files
+
+    did_finder_task.do_lookup('did', 1, 'https://my-servicex', finder)
+
+    complete = servicex.return_value.put_fileset_complete.call_args[0][0]
+    assert complete["previous-fileset-digest"] == "abc123"
+    assert complete["fileset-digest"] == _digest(list(reversed(finder_files)))
+
+
+def test_did_finder_task_memory_limit(monkeypatch, servicex, single_file_info):
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+    monkeypatch.setattr(did_finder_task.app, "memory_hard_limit", 2000, raising=False)
+    finder_files = [dict(single_file_info, paths=[f"root://site//file{i}"])
+                    for i in range(10)]
+
+    did_finder_task.do_lookup('did?files=5', 1, 'https://my-servicex',
+                              lambda did, info, args: iter(finder_files))
+
+    servicex.return_value.put_file_add_bulk.assert_not_called()
+    servicex.return_value.put_fileset_complete.assert_called_once()
+    assert servicex.return_value.put_fileset_complete.call_args[0][0]["files"] == 0
+
+
 def test_celery_app():
     app = DIDFinderApp('foo')
     assert isinstance(app, Celery)
@@ -114,3 +386,145 @@ def test_celery_app():
                        endpoint=endpoint, user_did_finder=lambda x, y, z: None)
 
     assert lookup_dataset.__name__ == 'wrapper'
+
+
+def test_celery_app_routing(mocker):
+    app = DIDFinderApp('foo', lookup_router=LookupRouter(fast_file_limit=10))
+    assert app.lane_queue('fast') == 'did_finder_foo_fast'
+    calls = []
+
+    @app.did_lookup_task(name="did_finder_foo.lookup_dataset")
+    def lookup_dataset(self, did: str, dataset_id: int, endpoint: str) -> None:
+        calls.append((did, dataset_id, endpoint))
+
+    apply_async = mocker.patch.object(lookup_dataset, 'apply_async')
+
+    lookup_dataset(did='scope:dataset?files=5', dataset_id=1, endpoint='http://sx')
+    assert calls == []
+    apply_async.assert_called_once_with(
+        args=(),
+        kwargs={'did': 'scope:dataset?files=5', 'dataset_id': 1, 'endpoint': 'http://sx',
+                'did_lane': 'fast'},
+        queue='did_finder_foo_fast'
+    )
+
+    lookup_dataset('scope:dataset', 2, 'http://sx')
+    assert apply_async.call_args.kwargs['args'] == ('scope:dataset', 2, 'http://sx')
+    assert apply_async.call_args.kwargs['queue'] == 'did_finder_foo_bulk'
+
+    lookup_dataset(did='scope:dataset?files=5', dataset_id=1, endpoint='http://sx',
+                   did_lane='fast')
+    assert calls == [('scope:dataset?files=5', 1, 'http://sx')]
+    assert apply_async.call_count == 2
+
+
+def _split_app():
+    app = DIDFinderApp('split', did_finder_args={}, backend='cache+memory://')
+    app.conf.task_always_eager = True
+    return app
+
+
+def _part_files(did, info, did_finder_args):
+    for i in range(2):
+        yield {"paths": [f"root://site//{did}/file{i}.root"], "adler32": 0,
+               "file_size": 100, "file_events": 10}
+
+
+def _partitioner(did, info, did_finder_args):
+    return [f"{did}.part{i}" for i in range(3)]
+
+
+def test_celery_app_split_lookup():
+    app = _split_app()
+
+    @app.did_lookup_task(name="did_finder_split.lookup_dataset")
+    def lookup_dataset(self, did: str, dataset_id: int, endpoint: str) -> None:
+        self.do_lookup(did=did, dataset_id=dataset_id, endpoint=endpoint,
+                       user_did_finder=_part_files, partitioner=_partitioner)
+
+    with LocalServiceX() as sink:
+        lookup_dataset.delay(did='scope:container', dataset_id=3, endpoint=sink.endpoint)
+
+    assert sink.file_count(3) == 6
+    assert {f["paths"][0] for f in sink.files["3"]} == {
+        f"root://site//scope:container.part{p}/file{i}.root"
+        for p in range(3) for i in range(2)
+    }
+    assert [r["action"] for r in sink.requests].count("complete") == 1
+    complete = sink.complete["3"]
+    assert complete["files"] == 6
+    assert complete["total-bytes"] == 600
+    assert complete["total-events"] == 60
+    assert complete["file-stats"]["file-size"]["count"] == 6
+    assert complete["fileset-digest"] == _digest(sink.files["3"])
+
+
+def test_celery_app_split_lookup_first_files():
+    app = _split_app()
+    partitioner = Mock(side_effect=_partitioner)
+
+    @app.did_lookup_task(name="did_finder_split.lookup_dataset")
+    def lookup_dataset(self, did: str, dataset_id: int, endpoint: str) -> None:
+        self.do_lookup(did=did, dataset_id=dataset_id, endpoint=endpoint,
+                       user_did_finder=_part_files, partitioner=partitioner)
+
+    with LocalServiceX() as sink:
+        lookup_dataset.delay(did='scope:container?files=1', dataset_id=3,
+                             endpoint=sink.endpoint)
+
+    partitioner.assert_not_called()
+    assert sink.file_count(3) == 1
+    assert sink.complete["3"]["files"] == 1
+
+
+def test_celery_app_split_lookup_part_failed():
+    app = _split_app()
+    app.conf.task_store_eager_result = True
+
+    @app.did_lookup_task(name="did_finder_split.lookup_dataset")
+    def lookup_dataset(self, did: str, dataset_id: int, endpoint: str) -> None:
+        if self.request.did_partition == "scope:container.part1":
+            raise RuntimeError("worker lost")
+        self.do_lookup(did=did, dataset_id=dataset_id, endpoint=endpoint,
+                       user_did_finder=_part_files)
+    lookup_dataset.store_eager_result = True
+
+    with LocalServiceX() as sink:
+        kwargs = {"did": "scope:container", "dataset_id": 3, "endpoint": sink.endpoint}
+        part_ids = [f"part{i}" for i in range(3)]
+        for part_id, partition in zip(part_ids, _partitioner("scope:container", {}, {})):
+            lookup_dataset.apply(kwargs=dict(kwargs, did_partition=partition),
+                                 task_id=part_id)
+        # What the chord calls when a part has failed
+        app.fail_partitions.s(part_ids=part_ids, started=0.0, **kwargs)(
+            Mock(), RuntimeError("worker lost"), None)
+
+    assert sink.file_count(3) == 4
+    assert [r["action"] for r in sink.requests].count("complete") == 1
+    complete = sink.complete["3"]
+    assert complete["files"] == 4
+    assert "fileset-digest" not in complete
+
+
+def test_celery_app_split_lookup_queues():
+    # Not eager: a worker that only consumes the scheme's queue runs the parts and the
+    # chord callback, as a worker started with `-Q did_finder_routed` would. The scheme
+    # has its own name because Celery shares tasks between apps, and a worker could pick
+    # up another test's `did_finder_split.lookup_dataset`.
+    app = DIDFinderApp('routed', did_finder_args={}, broker='memory://',
+                       backend='cache+memory://')
+
+    @app.did_lookup_task(name="did_finder_routed.lookup_dataset")
+    def lookup_dataset(self, did: str, dataset_id: int, endpoint: str) -> None:
+        self.do_lookup(did=did, dataset_id=dataset_id, endpoint=endpoint,
+                       user_did_finder=_part_files, partitioner=_partitioner)
+
+    with LocalServiceX() as sink:
+        with start_worker(app, perform_ping_check=False, queues=["did_finder_routed"]):
+            lookup_dataset.delay(did='scope:container', dataset_id=3, endpoint=sink.endpoint)
+            for _ in range(500):
+                if "3" in sink.complete:
+                    break
+                time.sleep(0.01)
+
+    assert sink.complete["3"]["files"] == 6
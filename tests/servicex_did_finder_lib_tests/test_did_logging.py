@@ -0,0 +1,160 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import logging
+import logging.handlers
+
+import pytest
+
+from servicex_did_finder_lib import did_logging
+from servicex_did_finder_lib.did_logging import (LogRateLimiter, initialize_root_logger,
+                                                 log_scheme)
+
+
+@pytest.fixture
+def fresh_logging(monkeypatch):
+    "Logging is set up once per process - undo it around each test"
+    root = logging.getLogger()
+
+    def reset():
+        if did_logging._handler is not None:
+            root.removeHandler(did_logging._handler)
+        did_logging.shutdown_logging()
+
+    reset()
+    monkeypatch.setattr(did_logging, "_handler", None)
+    monkeypatch.delenv("LOG_FORMAT", raising=False)
+    monkeypatch.setenv("INSTANCE_NAME", "test-instance")
+    yield root
+    reset()
+
+
+def _queue_handlers(root):
+    return [h for h in root.handlers if isinstance(h, logging.handlers.QueueHandler)]
+
+
+def test_text_format(fresh_logging, capsys):
+    initialize_root_logger("rucio")
+    logging.getLogger("finder").info("hello", extra={"dataset_id": 42})
+    did_logging.shutdown_logging()
+
+    assert capsys.readouterr().err == "INFO test-instance rucio_did_finder 42 hello\n"
+
+
+def test_log_scheme(fresh_logging, capsys):
+    initialize_root_logger("rucio")
+    with log_scheme("xrootd"):
+        logging.getLogger("finder").info("inside", extra={"dataset_id": 1})
+    logging.getLogger("finder").info("outside", extra={"dataset_id": 1})
+    did_logging.shutdown_logging()
+
+    assert capsys.readouterr().err.splitlines() == [
+        "INFO test-instance xrootd_did_finder 1 inside",
+        "INFO test-instance rucio_did_finder 1 outside",
+    ]
+
+
+def test_json_format(fresh_logging, capsys, monkeypatch):
+    monkeypatch.setenv("LOG_FORMAT", "json")
+    initialize_root_logger("rucio")
+    logging.getLogger("finder").warning("careful", extra={"dataset_id": 7})
+    did_logging.shutdown_logging()
+
+    entry = json.loads(capsys.readouterr().err)
+    assert entry["level"] == "WARNING"
+    assert entry["component"] == "rucio_did_finder"
+    assert entry["instance"] == "test-instance"
+    assert entry["datasetId"] == 7
+    assert entry["message"] == "careful"
+
+
+def test_json_format_exception(fresh_logging, capsys, monkeypatch):
+    monkeypatch.setenv("LOG_FORMAT", "json")
+    initialize_root_logger("rucio")
+    try:
+        raise ValueError("bad file")
+    except ValueError:
+        logging.getLogger("finder").exception("lookup %s failed", "scope:ds")
+    did_logging.shutdown_logging()
+
+    entry = json.loads(capsys.readouterr().err)
+    assert entry["message"] == "lookup scope:ds failed"
+    assert entry["exception"].startswith("Traceback")
+    assert "ValueError: bad file" in entry["exception"]
+
+
+def test_idempotent(fresh_logging):
+    initialize_root_logger("rucio")
+    initialize_root_logger("rucio")
+    assert len(_queue_handlers(fresh_logging)) == 1
+
+
+def test_reinitialize_different_settings(fresh_logging, caplog):
+    initialize_root_logger("rucio")
+    with caplog.at_level(logging.WARNING, logger="servicex_did_finder_lib.did_logging"):
+        initialize_root_logger("rucio", json_format=True)
+    assert len(_queue_handlers(fresh_logging)) == 1
+    assert "ignoring ('rucio', True, None)" in caplog.text
+
+
+def test_full_queue_drops(fresh_logging, monkeypatch):
+    monkeypatch.setattr(did_logging, "LOG_QUEUE_SIZE", 1)
+    initialize_root_logger("rucio")
+    did_logging._listener.stop()  # Nothing is writing, so the queue fills up
+    did_logging._listener = None
+    dropped = did_logging._DroppingQueueHandler.dropped
+
+    logging.getLogger("finder").info("one")
+    logging.getLogger("finder").info("two")
+    assert did_logging._DroppingQueueHandler.dropped == dropped + 1
+
+
+def _record(name, level=logging.INFO, msg="message"):
+    return logging.LogRecord(name, level, __file__, 1, msg, None, None)
+
+
+def test_rate_limiter():
+    limiter = LogRateLimiter({"hot": 2})
+    passed = [limiter.filter(_record("hot.child")) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert limiter.filter(_record("hot", level=logging.ERROR))
+    assert all(limiter.filter(_record("cold")) for _ in range(5))
+
+
+def test_rate_limiter_reports_dropped(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(did_logging.time, "monotonic", lambda: now[0])
+    limiter = LogRateLimiter({"hot": 1})
+    assert limiter.filter(_record("hot"))
+    assert not limiter.filter(_record("hot"))
+    assert not limiter.filter(_record("hot"))
+
+    now[0] += 1
+    record = _record("hot")
+    assert limiter.filter(record)
+    assert record.getMessage() == "message (2 similar messages dropped)"
@@ -25,7 +25,11 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-from servicex_did_finder_lib.did_summary import DIDSummary
+import json
+
+import pytest
+
+from servicex_did_finder_lib.did_summary import DIDSummary, QuantileSketch
 
 
 def test_did_summary():
@@ -48,3 +52,135 @@ def test_did_summary():
     assert summary.file_count == 2
     assert summary.total_bytes == 22423
     assert summary.total_events == 400
+
+
+def test_did_summary_skip():
+    summary = DIDSummary('did')
+    summary.skip_file({
+        "file_size": 22323,
+        "file_events": 100
+    })
+
+    assert summary.file_count == 0
+    assert summary.files_skipped == 1
+    assert summary.total_bytes == 0
+
+
+def _files(sizes, events=None, replicas=1):
+    events = events or [0] * len(sizes)
+    return [{"paths": ["root://f"] * replicas, "file_size": s, "file_events": e}
+            for s, e in zip(sizes, events)]
+
+
+def test_sketch_quantiles():
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    sketch.add_many(range(1, 10001))
+    assert sketch.count == 10000
+    for q in [0.1, 0.5, 0.9, 0.99]:
+        assert abs(sketch.quantile(q) - q * 10000) <= 0.02 * q * 10000
+    assert sketch.quantile(0) == 1
+    assert sketch.quantile(1) == 10000
+
+
+def test_sketch_zeros_and_empty():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+    sketch.add_many([0, 0, 5])
+    assert sketch.zeros == 2
+    assert sketch.count == 1
+    assert sketch.stats()["p50"] == 5
+
+
+def test_sketch_merge_is_exact():
+    whole = QuantileSketch()
+    whole.add_many(range(1, 1000))
+    a, b = QuantileSketch(), QuantileSketch()
+    a.add_many(range(1, 500))
+    b.add_many(range(500, 1000))
+    assert a.merge(b).to_dict() == whole.to_dict()
+
+
+def test_sketch_merge_mismatch():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.05))
+
+
+def test_sketch_round_trip():
+    sketch = QuantileSketch()
+    sketch.add_many([3, 300, 30000])
+    restored = QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert restored.stats() == sketch.stats()
+
+
+def test_did_summary_add_files():
+    summary = DIDSummary('did')
+    summary.add_files(_files([100, 200, 0], [10, 20, 30], replicas=2))
+    summary.add_file({"paths": ["a"], "bytes": 300, "events": 40})
+
+    assert summary.file_count == 4
+    assert summary.total_bytes == 600
+    assert summary.total_events == 100
+
+    dist = summary.distribution()
+    assert dist["file-size"]["count"] == 3
+    assert dist["file-size"]["unknown"] == 1
+    assert dist["file-size"]["max"] == 300
+    assert dist["file-events"]["min"] == 10
+    assert dist["replicas"] == {"min": 1, "max": 2, "mean": 7 / 4}
+
+
+def test_did_summary_single_path_string():
+    summary = DIDSummary('did')
+    summary.add_file({"paths": "root://site//file.root", "file_size": 1, "file_events": 1})
+
+    assert summary.distribution()["replicas"] == {"min": 1, "max": 1, "mean": 1}
+
+
+def test_did_summary_merge():
+    parts = [_files([1, 2]), _files([30, 40, 50], replicas=3), _files([600])]
+    whole = DIDSummary('did')
+    for p in parts:
+        whole.add_files(p)
+
+    summaries = []
+    for p in parts:
+        s = DIDSummary('did')
+        s.add_files(p)
+        summaries.append(s)
+    summaries[0].skip_file({})
+
+    left = DIDSummary('did').merge(summaries[0]).merge(summaries[1]).merge(summaries[2])
+    right = DIDSummary('did').merge(summaries[2]).merge(summaries[1].merge(summaries[0]))
+
+    assert left.to_dict() == right.to_dict()
+    assert left.file_count == whole.file_count
+    assert left.files_skipped == 1
+    assert left.distribution() == whole.distribution()
+    assert left.digest == whole.digest
+
+
+def test_did_summary_round_trip():
+    summary = DIDSummary('did')
+    summary.add_files(_files([100, 200], [1, 2]))
+    restored = DIDSummary.from_dict(json.loads(json.dumps(summary.to_dict())))
+    assert restored.to_dict() == summary.to_dict()
+    assert str(restored) == str(summary)
+
+
+def test_did_summary_digest():
+    files = [{"paths": [f"root://a//f{i}", f"root://b//f{i}"], "adler32": f"{i:08x}",
+              "file_size": 1, "file_events": 1}
+             for i in range(5)]
+    forward = DIDSummary('did')
+    forward.add_files(files)
+    backward = DIDSummary('did')
+    for f in reversed(files):
+        backward.add_file(dict(f, paths=list(reversed(f["paths"]))))
+
+    assert forward.digest == backward.digest
+    assert len(forward.digest) == 64
+    assert DIDSummary('did').digest == "0" * 64
+
+    changed = DIDSummary('did')
+    changed.add_files(files[:4] + [dict(files[4], adler32="ffffffff")])
+    assert changed.digest != forward.digest
@@ -0,0 +1,162 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+from servicex_did_finder_lib.enrichment import MetadataEnricher
+
+
+def _file(i, size=0, events=0):
+    return {"paths": [f"root://site//file{i}.root"], "adler32": 0, "file_size": size,
+            "file_events": events}
+
+
+def test_fills_missing_fields():
+    calls = []
+
+    def resolver(record):
+        calls.append(record["paths"][0])
+        return {"file_size": 1000, "file_events": "50"}
+
+    enricher = MetadataEnricher(resolver)
+    out = list(enricher([_file(0), _file(1, size=7, events=3), _file(2, size=9)]))
+
+    by_path = {f["paths"][0]: f for f in out}
+    assert by_path["root://site//file0.root"]["file_size"] == 1000
+    assert by_path["root://site//file0.root"]["file_events"] == 50
+    assert by_path["root://site//file1.root"]["file_size"] == 7
+    assert by_path["root://site//file2.root"]["file_size"] == 9  # Only zeros are filled
+    assert by_path["root://site//file2.root"]["file_events"] == 50
+    assert sorted(calls) == ["root://site//file0.root", "root://site//file2.root"]
+
+
+def test_cache_across_lookups():
+    calls = []
+
+    def resolver(record):
+        calls.append(record["paths"][0])
+        return {"file_size": 10, "file_events": 1}
+
+    enricher = MetadataEnricher(resolver, max_workers=1, cache_size=2)
+    list(enricher([_file(0), _file(1)]))
+    assert list(enricher([_file(0)]))[0]["file_size"] == 10
+    assert len(calls) == 2
+
+    list(enricher([_file(2)]))  # Pushes out file1, the least recently used
+    list(enricher([_file(0), _file(1)]))
+    assert calls == ["root://site//file0.root", "root://site//file1.root",
+                     "root://site//file2.root", "root://site//file1.root"]
+
+
+def test_cache_survives_replica_changes():
+    calls = []
+
+    def resolver(record):
+        calls.append(record["paths"])
+        return {"file_size": 10, "file_events": 1}
+
+    enricher = MetadataEnricher(resolver, max_workers=1)
+    list(enricher([{"paths": ["root://a//f.root", "root://b//f.root"]}]))
+    assert list(enricher([{"paths": ["root://b//f.root"]}]))[0]["file_size"] == 10
+    assert list(enricher([{"paths": ["root://0//f.root", "root://a//f.root"]}]))[0][
+        "file_size"] == 10
+    assert len(calls) == 1
+
+
+def test_resolver_failure_passes_file_on():
+    def resolver(record):
+        raise IOError("can't open")
+
+    out = list(MetadataEnricher(resolver)([_file(0)]))
+    assert out == [_file(0)]
+
+
+def test_bounded_concurrency_and_streaming():
+    lock = threading.Lock()
+    running = [0]
+    most = [0]
+    release = threading.Event()
+
+    def resolver(record):
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        release.wait(5)
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return {"file_size": 1, "file_events": 1}
+
+    def finder():
+        yield _file(0)
+        yield _file(1)
+        yield _file(99, size=5, events=5)
+        for i in range(2, 10):
+            yield _file(i)
+
+    out = MetadataEnricher(resolver, max_workers=2)(finder())
+    first = next(out)  # Files that need nothing aren't held up by slow lookups
+    assert first["paths"] == ["root://site//file99.root"]
+    release.set()
+    rest = list(out)
+    assert len(rest) == 10
+    assert most[0] <= 2
+
+
+def test_batches():
+    release = threading.Event()
+
+    def resolver(record):
+        release.wait(5)
+        return {"file_size": 1, "file_events": 1}
+
+    out = MetadataEnricher(resolver).batches(iter([
+        [_file(0), _file(98, size=5, events=5), _file(99, size=5, events=5)],
+    ]))
+    first = next(out)  # The files that need nothing go on together
+    assert [f["paths"] for f in first] == [["root://site//file98.root"],
+                                           ["root://site//file99.root"]]
+    release.set()
+    assert [[f["file_size"] for f in batch] for batch in out] == [[1]]
+
+
+def test_async_resolver():
+    async def resolver(record):
+        return {"file_events": 42}
+
+    out = list(MetadataEnricher(resolver)([_file(0)]))
+    assert out[0]["file_events"] == 42
+    assert out[0]["file_size"] == 0
+
+
+def test_bad_values_are_dropped():
+    def resolver(record):
+        return {"file_size": float("inf"), "file_events": -5}
+
+    out = list(MetadataEnricher(resolver)([_file(0), _file(1)]))
+    assert sorted(out, key=lambda f: f["paths"]) == [_file(0), _file(1)]
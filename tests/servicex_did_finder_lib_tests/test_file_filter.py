@@ -0,0 +1,101 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from servicex_did_finder_lib.file_filter import FileFilter
+from servicex_did_finder_lib.util_uri import parse_did_uri
+
+
+def _file(path, size=0, events=0):
+    return {'paths': [path], 'adler32': 0, 'file_size': size, 'file_events': events}
+
+
+def test_no_filter():
+    assert FileFilter.from_did_info(parse_did_uri('forkit?files=10')) is None
+
+
+def test_path_glob():
+    f = FileFilter.from_did_info(parse_did_uri('forkit?path=*DAOD_PHYS.*'))
+    assert f(_file('root://site//rucio/mc16/DAOD_PHYS.123._000001.pool.root.1'))
+    assert not f(_file('root://site//rucio/mc16/DAOD_PHYSLITE.123._000001.pool.root.1'))
+
+
+def test_path_glob_any_replica():
+    f = FileFilter(path_glob='https://*')
+    assert f({'paths': ['root://site//f.root', 'https://site//f.root']})
+    assert not f({'paths': ['root://site//f.root']})
+
+
+def test_path_regex():
+    f = FileFilter(path_regex=r'_0000[12]\.root$')
+    assert f(_file('root://site//f_00001.root'))
+    assert not f(_file('root://site//f_00003.root'))
+
+
+def test_size_bounds():
+    f = FileFilter.from_did_info(parse_did_uri('forkit?min_size=1GB&max_size=2GB'))
+    assert f(_file('a', size=1500000000))
+    assert not f(_file('a', size=500))
+    assert not f(_file('a', size=3000000000))
+    assert not f(_file('a', size=0))
+
+
+def test_min_events():
+    f = FileFilter(min_events=10)
+    assert f(_file('a', events=10))
+    assert not f(_file('a', events=9))
+
+
+def test_filter_batch():
+    f = FileFilter(min_size=10)
+    kept = f.filter_batch([_file('a', size=5), _file('b', size=50), _file('c', size=10)])
+    assert [k['paths'][0] for k in kept] == ['b', 'c']
+
+
+def test_sample():
+    f = FileFilter.from_did_info(parse_did_uri('forkit?sample=0.25'))
+    files = [_file(f'root://site//f_{i:05}.root') for i in range(2000)]
+
+    kept = f.filter_batch(files)
+    assert 400 < len(kept) < 600
+    assert f.filter_batch(files) == kept
+    assert f.filter_batch(list(reversed(files))) == list(reversed(kept))
+    assert FileFilter.from_did_info(parse_did_uri('forkit?sample=1')) is None
+
+
+def test_sample_ignores_replica_order():
+    f = FileFilter(sample=0.5)
+    picks = {f({'paths': ['root://a//f%d' % i, 'root://b//f%d' % i]}) ==
+             f({'paths': ['root://b//f%d' % i, 'root://a//f%d' % i]}) for i in range(50)}
+    assert picks == {True}
+
+
+def test_sample_ignores_replicas():
+    f = FileFilter(sample=0.5)
+    picks = {f({'paths': ['root://b//data/f%d' % i]}) ==
+             f({'paths': ['root://a//other/f%d' % i, 'root://b//data/f%d' % i]})
+             for i in range(50)}
+    assert picks == {True}
@@ -0,0 +1,193 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import shutil
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from servicex_did_finder_lib import health
+from servicex_did_finder_lib.did_finder_app import DIDFinderApp, _pool_forks
+from servicex_did_finder_lib.health import (HealthServer, LoadMetrics, SnapshotWriter,
+                                            read_snapshots, summarize)
+from servicex_did_finder_lib.local_sink import LocalServiceX
+from servicex_did_finder_lib.servicex_adaptor import ServiceXAdapter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def metrics(monkeypatch):
+    "A fresh set of metrics for the process"
+    fresh = LoadMetrics()
+    monkeypatch.setattr(health, "metrics", fresh)
+    return fresh
+
+
+def test_load_metrics():
+    clock = FakeClock()
+    m = LoadMetrics(window=60, clock=clock)
+    m.lookup_started()
+    m.upload_queued(500)
+    m.upload_finished(200, files_sent=30)
+    m.app_request(ok=True)
+    m.app_request(ok=False)
+
+    snapshot = m.snapshot()
+    assert snapshot["active_lookups"] == 1
+    assert snapshot["queued_upload_bytes"] == 300
+    assert snapshot["files_per_second"] == 0.5
+    assert (snapshot["app_requests"], snapshot["app_errors"]) == (2, 1)
+
+    clock.now += 30
+    m.upload_finished(300, files_sent=30)
+    m.lookup_finished()
+    assert m.snapshot()["files_per_second"] == 1.0
+
+    clock.now += 45
+    snapshot = m.snapshot()
+    assert snapshot["files_per_second"] == 0.5
+    assert snapshot["app_requests"] == 0
+    assert snapshot["active_lookups"] == 0
+    assert snapshot["queued_upload_bytes"] == 0
+
+
+def test_snapshots(tmp_path, metrics):
+    metrics.lookup_started()
+    SnapshotWriter(str(tmp_path)).write()
+    stale = dict(metrics.snapshot(), pid=1, time=time.time() - 100, active_lookups=5)
+    (tmp_path / "1.json").write_text(json.dumps(stale))
+    other = dict(metrics.snapshot(), pid=2, app_requests=4, app_errors=1,
+                 resources_ready=False)
+    (tmp_path / "2.json").write_text(json.dumps(other))
+
+    snapshots = read_snapshots(str(tmp_path), max_age=15)
+    assert len(snapshots) == 2
+    load = summarize(snapshots)
+    assert load["active_lookups"] == 2
+    assert load["app_error_rate"] == 0.25
+    assert not load["resources_ready"]
+
+
+def test_health_server(tmp_path, metrics):
+    broker = {"ok": True, "checks": 0}
+
+    def broker_check():
+        broker["checks"] += 1
+        return broker["ok"]
+
+    with HealthServer(str(tmp_path), broker_check, host="127.0.0.1", port=0,
+                      broker_check_interval=0) as server:
+        assert requests.get(f"{server.url}healthz").status_code == 200
+        assert requests.get(f"{server.url}readyz").status_code == 503  # No workers yet
+
+        metrics.lookup_started()
+        SnapshotWriter(str(tmp_path)).write()
+        r = requests.get(f"{server.url}readyz")
+        assert r.status_code == 200
+        assert r.json()["active_lookups"] == 1
+
+        assert "did_finder_active_lookups 1.0" in \
+            requests.get(f"{server.url}metrics").text.splitlines()
+
+        broker["ok"] = False
+        assert requests.get(f"{server.url}readyz").status_code == 503
+        assert requests.get(f"{server.url}status").json()["broker_connected"] is False
+        assert requests.get(f"{server.url}other").status_code == 404
+
+
+def test_health_server_caches_broker_check(tmp_path):
+    checks = []
+    server = HealthServer(str(tmp_path), lambda: checks.append(1) or True,
+                          host="127.0.0.1", port=0, broker_check_interval=60)
+    server.status()
+    server.status()
+    server._server.server_close()
+    assert len(checks) == 1
+
+
+def test_app_health_server(tmp_path, metrics):
+    app = DIDFinderApp("health", broker="memory://", health_port=0,
+                       health_dir=str(tmp_path))
+    server = app.start_health_server(main_runs_tasks=True)
+    try:
+        r = requests.get(f"{server.url.replace('0.0.0.0', '127.0.0.1')}readyz")
+        assert r.status_code == 200
+        assert r.json()["processes"] == 1
+    finally:
+        app.stop_health()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_app_health_server_prefork(metrics):
+    app = DIDFinderApp("health", broker="memory://", health_port=0)
+    assert app.health_dir is None  # Made when the worker starts
+
+    server = app.start_health_server()
+    url = f"{server.url.replace('0.0.0.0', '127.0.0.1')}readyz"
+    try:
+        # The main process doesn't run lookups, so it isn't ready without a worker process
+        r = requests.get(url)
+        assert r.status_code == 503
+        assert r.json()["processes"] == 0
+
+        SnapshotWriter(app.health_dir).write()  # As a worker process would
+        r = requests.get(url)
+        assert r.status_code == 200
+        assert r.json()["processes"] == 1
+    finally:
+        app.stop_health()
+        shutil.rmtree(app.health_dir)
+
+
+def test_pool_forks():
+    assert _pool_forks(SimpleNamespace(pool_cls="prefork"))
+    assert _pool_forks(None)
+    assert not _pool_forks(SimpleNamespace(pool_cls="solo"))
+    assert not _pool_forks(SimpleNamespace(pool_cls="threads"))
+
+
+def test_adapter_metrics(metrics):
+    with LocalServiceX() as sink:
+        sx = ServiceXAdapter(sink.endpoint, 3)
+        sx.put_file_add_bulk([{"paths": [f"root://site//file{i}.root"], "adler32": 0,
+                               "file_size": 100, "file_events": 10} for i in range(6)])
+        sx.put_fileset_complete({"files": 6})
+
+    snapshot = metrics.snapshot()
+    assert snapshot["files_per_second"] == 6 / health.RATE_WINDOW
+    assert snapshot["queued_upload_bytes"] == 0
+    assert (snapshot["app_requests"], snapshot["app_errors"]) == (2, 0)
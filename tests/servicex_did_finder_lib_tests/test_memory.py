@@ -0,0 +1,73 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from datetime import datetime
+import tracemalloc
+
+from servicex_did_finder_lib.memory import (RECORD_OVERHEAD, MemoryLimits, SpillFile,
+                                            record_bytes)
+
+
+def test_record_bytes():
+    assert record_bytes({"paths": "abc"}) == RECORD_OVERHEAD + 3
+    assert record_bytes({"paths": ["abc", "de"]}) > record_bytes({"paths": ["abc"]})
+
+
+def test_spill_file(tmp_path):
+    records = [{"paths": [f"file{i}"], "file_size": i} for i in range(5)]
+    spill = SpillFile(iter(records), str(tmp_path))
+    assert spill.count == 5
+    assert list(spill) == records
+    assert list(spill) == records
+    spill.close()
+
+
+def test_spill_file_other_values(tmp_path):
+    spill = SpillFile([{"paths": ["file"], "created": datetime(2024, 5, 1)}], str(tmp_path))
+    assert list(spill) == [{"paths": ["file"], "created": "2024-05-01 00:00:00"}]
+    spill.close()
+
+
+def test_allocation_tracing():
+    was_tracing = tracemalloc.is_tracing()
+    memory = MemoryLimits(hard_limit=1, trace_allocations=True)
+    memory.start()
+    try:
+        held = [bytes(1000) for _ in range(1000)]
+        assert memory.allocated() >= 1000 * 1000
+        del held
+    finally:
+        memory.stop()
+    assert memory.allocated() == 0
+    assert tracemalloc.is_tracing() == was_tracing
+
+
+def test_no_tracing():
+    memory = MemoryLimits(soft_limit=10)
+    memory.start()
+    assert memory.allocated() == 0
+    memory.stop()
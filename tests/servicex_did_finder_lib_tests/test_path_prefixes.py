@@ -0,0 +1,56 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+
+from servicex_did_finder_lib.path_prefixes import PrefixTable
+
+PREFIX = "root://site.domain:1094//pnfs/site.domain/atlas/rucio/mc16_13TeV/ab/cd/"
+
+
+def test_split_and_join():
+    table = PrefixTable()
+    assert table.split(PREFIX + "f1.root") == (0, "f1.root")
+    assert table.split("https://other//f1.root") == (1, "f1.root")
+    assert table.split(PREFIX + "f2.root") == (0, "f2.root")
+    assert table.split("no_slash") == (2, "no_slash")
+    assert table.prefixes == [PREFIX, "https://other//", ""]
+    assert table.join((0, "f2.root")) == PREFIX + "f2.root"
+    assert table.join([1, "x"]) == "https://other//x"
+    assert table.join("whole") == "whole"
+
+
+def test_compact_and_expand():
+    table = PrefixTable()
+    record = {"paths": [PREFIX + "f1.root", "root://short//f1.root"], "file_size": 3}
+    compact = table.compact(record)
+
+    assert compact["paths"] == ((0, "f1.root"), "root://short//f1.root")
+    assert compact["file_size"] == 3
+    assert len(table) == 1
+    assert table.expand(compact) == record
+    assert table.expand(json.loads(json.dumps(compact))) == record
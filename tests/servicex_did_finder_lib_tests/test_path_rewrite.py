@@ -0,0 +1,90 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from servicex_did_finder_lib.path_rewrite import PathRewriter
+
+
+def test_no_rules():
+    r = PathRewriter()
+    assert r.rewrite_paths(['root://site:1094//f.root']) == ['root://site:1094//f.root']
+
+
+def test_scheme_prefix():
+    r = PathRewriter(scheme_prefixes={'root': 'root://xcache:1094//'})
+    assert r.rewrite_paths(['root://site:1094//f.root', 'https://site//f.root']) == [
+        'root://xcache:1094//root://site:1094//f.root',
+        'https://site//f.root'
+    ]
+
+
+def test_wildcard_prefix():
+    r = PathRewriter.from_prefix('root://xcache:1094//')
+    assert r.rewrite_paths(['https://site//f.root']) == [
+        'root://xcache:1094//https://site//f.root'
+    ]
+
+
+def test_empty_prefix():
+    r = PathRewriter.from_prefix('')
+    assert r.rewrite_paths(['https://site//f.root']) == ['https://site//f.root']
+
+
+def test_already_prefixed():
+    r = PathRewriter.from_prefix('root://xcache:1094//')
+    assert r.rewrite_paths(['root://xcache:1094//root://site//f.root']) == [
+        'root://xcache:1094//root://site//f.root'
+    ]
+
+
+def test_site_prefix_wins():
+    r = PathRewriter(scheme_prefixes={'*': 'root://xcache:1094//'},
+                     site_prefixes={'cern.ch': 'root://cern-cache//',
+                                    'bnl.gov:1094': 'root://bnl-cache//'})
+    assert r.rewrite_paths(['root://cern.ch:1094//f.root',
+                            'root://bnl.gov:1094//f.root',
+                            'root://bnl.gov:2000//f.root']) == [
+        'root://cern-cache//root://cern.ch:1094//f.root',
+        'root://bnl-cache//root://bnl.gov:1094//f.root',
+        'root://xcache:1094//root://bnl.gov:2000//f.root'
+    ]
+
+
+def test_keep_originals():
+    r = PathRewriter(scheme_prefixes={'root': 'root://xcache//'}, keep_originals=True)
+    assert r.rewrite_paths(['root://a//f.root', 'https://b//f.root']) == [
+        'root://xcache//root://a//f.root',
+        'root://a//f.root',
+        'https://b//f.root'
+    ]
+
+
+def test_batch_does_not_modify_input(single_file_info):
+    r = PathRewriter.from_prefix('root://xcache//')
+    result = r([single_file_info])
+    assert result[0]['paths'] == ['root://xcache//fork/it/over']
+    assert single_file_info['paths'] == ['fork/it/over']
+    assert result[0]['file_size'] == single_file_info['file_size']
@@ -0,0 +1,81 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from servicex_did_finder_lib.record_validation import RecordNormalizer
+
+
+def test_good_record(single_file_info):
+    record, reason = RecordNormalizer().normalize(single_file_info)
+    assert reason is None
+    assert record == single_file_info
+    assert record is not single_file_info
+
+
+def test_defaults():
+    record, _ = RecordNormalizer().normalize({'paths': ['root://f']})
+    assert record == {'paths': ['root://f'], 'adler32': 0, 'file_size': 0, 'file_events': 0}
+
+
+def test_coercion():
+    record, _ = RecordNormalizer().normalize({
+        'paths': 'root://f',
+        'adler32': None,
+        'bytes': '1024',
+        'events': 12.0,
+        'extra': 'kept'
+    })
+    assert record['paths'] == ['root://f']
+    assert record['adler32'] == 0
+    assert record['file_size'] == 1024
+    assert record['file_events'] == 12
+    assert record['extra'] == 'kept'
+
+
+def test_none_counts():
+    record, _ = RecordNormalizer().normalize({'paths': ['a'], 'file_size': None,
+                                              'file_events': ''})
+    assert record['file_size'] == 0
+    assert record['file_events'] == 0
+
+
+def test_rejections():
+    n = RecordNormalizer()
+    assert n.normalize({'file_size': 10}) == (None, 'missing paths')
+    assert n.normalize({'paths': []})[1].startswith('bad paths')
+    assert n.normalize({'paths': ['a', None]})[1].startswith('bad paths')
+    assert n.normalize({'paths': ['a'], 'file_size': 'big'})[1].startswith('bad file_size')
+    assert n.normalize({'paths': ['a'], 'file_events': -1})[1].startswith('bad file_events')
+    assert n.normalize({'paths': ['a'], 'file_events': True})[1].startswith('bad file_events')
+    assert n.normalize('root://f')[1] == 'expected a dictionary, not str'
+    for value in [float('inf'), 'inf', '1e999', float('nan'), '-inf']:
+        assert n.normalize({'paths': ['a'], 'file_size': value})[1].startswith('bad file_size')
+
+
+def test_batch():
+    good, rejected = RecordNormalizer()([{'paths': ['a']}, {'file_size': 1}, {'paths': ['b']}])
+    assert [g['paths'] for g in good] == [['a'], ['b']]
+    assert rejected == [({'file_size': 1}, 'missing paths')]
@@ -0,0 +1,143 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import sys
+
+import pytest
+import requests
+
+from servicex_did_finder_lib.local_sink import LocalServiceX
+from servicex_did_finder_lib.replay import (load_finder, main, read_recording, record,
+                                            replay, replay_finder)
+
+
+def find_files(did, info, did_finder_args):
+    "A DID finder for the tests"
+    for i in range(int(did_finder_args.get("num_files", 3))):
+        yield {
+            "paths": [f"root://site//{did}/file{i}.root"],
+            "adler32": 0,
+            "file_size": 100 * (i + 1),
+            "file_events": 10,
+        }
+    if did_finder_args.get("fail"):
+        raise RuntimeError("catalog went away")
+
+
+def test_local_sink():
+    with LocalServiceX() as sink:
+        requests.put(f"{sink.endpoint}5/files", json=[{"paths": ["a"]}, {"paths": ["b"]}])
+        requests.put(f"{sink.endpoint}5/complete", json={"files": 2})
+        r = requests.put(f"{sink.endpoint}5/other", json={})
+
+    assert sink.file_count(5) == 2
+    assert sink.complete["5"] == {"files": 2}
+    assert r.status_code == 404
+
+
+def test_load_finder():
+    assert load_finder(f"{__name__}:find_files") is find_files
+    with pytest.raises(ValueError):
+        load_finder("no_function_given")
+
+
+def test_record(tmp_path):
+    path = str(tmp_path / "lookup.jsonl")
+    assert record(find_files, "scope:ds?files=2", path, {"num_files": 4}) == 4
+
+    entries = list(read_recording(path))
+    assert entries[0]["did"] == "scope:ds?files=2"
+    assert [e["files"]["paths"] for e in entries[1:-1]] == \
+        [[f"root://site//scope:ds/file{i}.root"] for i in range(4)]
+    assert entries[-1]["files_total"] == 4
+    assert entries[-1]["error"] is None
+
+
+def test_record_failure_replays_failure(tmp_path):
+    path = str(tmp_path / "lookup.jsonl")
+    assert record(find_files, "scope:ds", path, {"fail": True}) == 3
+    assert "catalog went away" in list(read_recording(path))[-1]["error"]
+
+    _, finder = replay_finder(path)
+    files = []
+    with pytest.raises(RuntimeError):
+        for f in finder("scope:ds", {}, {}):
+            files.append(f)
+    assert len(files) == 3
+
+
+def test_replay_not_a_recording(tmp_path):
+    path = tmp_path / "junk.jsonl"
+    path.write_text('{"hello": 1}\n')
+    with pytest.raises(ValueError):
+        replay_finder(str(path))
+
+
+def test_replay_into_sink(tmp_path):
+    path = str(tmp_path / "lookup.jsonl")
+    record(find_files, "scope:ds", path, {"num_files": 5})
+
+    with LocalServiceX() as sink:
+        replay(path, sink.endpoint, dataset_id=3, did="scope:ds?files=2")
+
+    assert sink.file_count(3) == 2
+    assert sink.complete["3"]["files"] == 2
+    assert sink.complete["3"]["total-bytes"] == 300
+
+
+def test_replay_rate(tmp_path, monkeypatch):
+    path = str(tmp_path / "lookup.jsonl")
+    record(find_files, "scope:ds", path, {"num_files": 5})
+
+    sleeps = []
+    monkeypatch.setattr("servicex_did_finder_lib.replay.time.sleep", sleeps.append)
+    _, finder = replay_finder(path, rate=2)
+    assert len(list(finder("scope:ds", {}, {}))) == 5
+    assert len(sleeps) >= 3
+    assert all(s <= 2.0 for s in sleeps)
+
+
+def test_cli(tmp_path, capsys, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    sys.modules.pop("replay_test_finder", None)
+    (tmp_path / "replay_test_finder.py").write_text(
+        "def find(did, info, args):\n"
+        "    for i in range(int(args['n'])):\n"
+        "        yield {'paths': [f'root://s//{did}/{i}'], 'adler32': 0,\n"
+        "               'file_size': 1, 'file_events': 1}\n"
+    )
+    path = str(tmp_path / "lookup.jsonl")
+    profile = str(tmp_path / "replay.prof")
+
+    main(["record", "--finder", "replay_test_finder:find", "--did", "ds",
+          "--output", path, "--arg", "n=7"])
+    assert "Recorded 7 files" in capsys.readouterr().out
+
+    main(["replay", "--input", path, "--dataset-id", "9", "--profile", profile])
+    out = capsys.readouterr().out
+    assert "Replayed 7 files in 7 requests" in out
+    assert (tmp_path / "replay.prof").exists()
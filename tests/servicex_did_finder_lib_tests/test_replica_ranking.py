@@ -0,0 +1,166 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import socket
+import threading
+
+from servicex_did_finder_lib.replica_ranking import ReplicaRanker, tcp_connect_prober
+
+
+class FakeProber:
+    "Stand in for network probes"
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.calls = []
+
+    def __call__(self, host, port):
+        self.calls.append((host, port))
+        return self.latencies.get(host)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _file(*paths):
+    return {'paths': list(paths), 'adler32': 0, 'file_size': 0, 'file_events': 0}
+
+
+def test_no_config_keeps_order():
+    r = ReplicaRanker()
+    f = _file('root://b//f', 'root://a//f')
+    assert r([f]) == [f]
+
+
+def test_static_scores():
+    r = ReplicaRanker(site_scores={'a.org': 10, 'c.org:2000': 5})
+    result = r([_file('root://b.org//f', 'root://c.org:2000//f', 'root://a.org//f')])
+    assert result[0]['paths'] == ['root://a.org//f', 'root://c.org:2000//f', 'root://b.org//f']
+
+
+def test_probed_latency():
+    prober = FakeProber({'near.org': 0.001, 'far.org': 0.2})
+    r = ReplicaRanker(prober=prober)
+    batch = [_file('root://down.org//f', 'root://far.org//f', 'https://near.org//f')]
+    r(batch)
+    r.refresh()
+    result = r(batch)
+    assert result[0]['paths'] == ['https://near.org//f', 'root://far.org//f',
+                                  'root://down.org//f']
+    assert sorted(prober.calls) == [('down.org', 1094), ('far.org', 1094), ('near.org', 443)]
+    assert r.latency('near.org', 443) == 0.001
+    assert r.latency('down.org', 1094) is None
+
+
+def test_score_beats_latency():
+    prober = FakeProber({'near.org': 0.001, 'far.org': 0.2})
+    r = ReplicaRanker(site_scores={'far.org': 1}, prober=prober)
+    batch = [_file('root://near.org//f', 'root://far.org//f')]
+    r(batch)
+    r.refresh()
+    result = r(batch)
+    assert result[0]['paths'] == ['root://far.org//f', 'root://near.org//f']
+
+
+def test_probe_cached_until_expired():
+    prober = FakeProber({'a.org': 0.1, 'b.org': 0.2})
+    clock = FakeClock()
+    r = ReplicaRanker(prober=prober, probe_ttl=60, clock=clock)
+    batch = [_file('root://a.org//f1', 'root://b.org//f1'),
+             _file('root://b.org//f2', 'root://a.org//f2')]
+    r(batch)
+    r.refresh()
+    assert len(prober.calls) == 2
+
+    clock.now = 30
+    r(batch)
+    r.refresh()
+    assert len(prober.calls) == 2
+
+    clock.now = 61
+    prober.latencies['a.org'] = 0.5
+    r(batch)
+    r.refresh()
+    result = r(batch)
+    assert len(prober.calls) == 4
+    assert result[0]['paths'] == ['root://b.org//f1', 'root://a.org//f1']
+
+
+def test_single_replica_not_probed():
+    prober = FakeProber({})
+    r = ReplicaRanker(prober=prober)
+    r([_file('root://a.org//f')])
+    assert prober.calls == []
+
+
+def test_prober_exception():
+    def prober(host, port):
+        raise RuntimeError("boom")
+
+    r = ReplicaRanker(prober=prober)
+    batch = [_file('root://a.org//f', 'root://b.org//f')]
+    r(batch)
+    r.refresh()
+    result = r(batch)
+    assert result[0]['paths'] == ['root://a.org//f', 'root://b.org//f']
+
+
+def test_ranking_does_not_wait_for_probes():
+    release = threading.Event()
+    probed = []
+
+    def slow_prober(host, port):
+        release.wait(5)
+        probed.append(host)
+        return 0.1 if host == 'b.org' else 0.5
+
+    r = ReplicaRanker(prober=slow_prober)
+    batch = [_file('root://a.org//f', 'root://b.org//f')]
+    # Ranked from what is known - nothing yet - while the probes run in the background
+    assert r(batch)[0]['paths'] == ['root://a.org//f', 'root://b.org//f']
+    assert probed == []
+
+    release.set()
+    r.refresh()
+    assert r(batch)[0]['paths'] == ['root://b.org//f', 'root://a.org//f']
+    assert sorted(probed) == ['a.org', 'b.org']
+
+
+def test_tcp_connect_prober():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    try:
+        port = server.getsockname()[1]
+        assert tcp_connect_prober()('127.0.0.1', port) is not None
+    finally:
+        server.close()
+    assert tcp_connect_prober(timeout=0.5)('127.0.0.1', port) is None
@@ -0,0 +1,108 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from celery.signals import worker_process_init, worker_process_shutdown
+import pytest
+
+from servicex_did_finder_lib import resources
+from servicex_did_finder_lib.did_finder_app import DIDFinderApp
+from servicex_did_finder_lib.resources import ProcessResources, ResourceFactory
+
+
+class Client:
+    "Stands in for a catalog client with a connection to close"
+    built = 0
+
+    def __init__(self):
+        Client.built += 1
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def client_factory():
+    Client.built = 0
+    return ResourceFactory(Client, teardown=Client.close)
+
+
+def test_no_factories():
+    args = {"a": 1}
+    assert ProcessResources(args).resolve() is args
+    assert ProcessResources(None).resolve() is None
+
+
+def test_built_once_per_process(client_factory, monkeypatch):
+    res = ProcessResources({"client": client_factory, "site": "CERN"})
+    first = res.resolve()
+    assert isinstance(first["client"], Client)
+    assert first["site"] == "CERN"
+    assert res.resolve() is first
+    assert Client.built == 1
+
+    monkeypatch.setattr(resources.os, "getpid", lambda: -1)
+    second = res.resolve()
+    assert second["client"] is not first["client"]
+    assert Client.built == 2
+
+
+def test_close(client_factory):
+    res = ProcessResources({"client": client_factory})
+    client = res.resolve()["client"]
+    res.close()
+    assert client.closed
+    assert res.resolve()["client"] is not client
+
+
+def test_close_in_forked_child_leaves_parent_objects(client_factory, monkeypatch):
+    res = ProcessResources({"client": client_factory})
+    client = res.resolve()["client"]
+    monkeypatch.setattr(resources.os, "getpid", lambda: -1)
+    res.close()
+    assert not client.closed
+
+
+def test_failed_build_tears_down(client_factory):
+    def broken():
+        raise RuntimeError("no token")
+
+    res = ProcessResources({"client": client_factory, "other": ResourceFactory(broken)})
+    with pytest.raises(RuntimeError):
+        res.resolve()
+    assert Client.built == 1
+
+
+def test_app_worker_signals(client_factory):
+    app = DIDFinderApp("test_resources", did_finder_args={"client": client_factory})
+    worker_process_init.send(sender=None)
+    assert Client.built == 1
+    client = app.did_finder_args["client"]
+    assert Client.built == 1
+
+    worker_process_shutdown.send(sender=None)
+    assert client.closed
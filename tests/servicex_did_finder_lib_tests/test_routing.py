@@ -0,0 +1,96 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import threading
+
+from servicex_did_finder_lib.routing import BULK_LANE, FAST_LANE, LookupRouter, did_pattern
+
+
+def test_did_pattern():
+    assert did_pattern('mc16_13TeV:mc16_13TeV.361106.DAOD_PHYS.e3601_p4164') == \
+        'mc#_#TeV:mc#_#TeV.#.DAOD_PHYS.e#_p#'
+    assert did_pattern('mc16_13TeV:mc16_13TeV.361107.DAOD_PHYS.e3601_p4165?files=10') == \
+        'mc#_#TeV:mc#_#TeV.#.DAOD_PHYS.e#_p#?files'
+
+
+def test_lane_without_history():
+    r = LookupRouter(fast_threshold=60, fast_file_limit=100)
+    assert r.lane('scope:dataset?files=10') == FAST_LANE
+    assert r.lane('scope:dataset?files=1000') == BULK_LANE
+    assert r.lane('scope:dataset') == BULK_LANE
+    assert r.lane('scope:dataset?timeout=30') == FAST_LANE
+    assert r.lane('scope:dataset?get=bogus') == FAST_LANE
+
+
+def test_lane_from_history():
+    r = LookupRouter(fast_threshold=60, smoothing=0.5)
+    r.record('scope:dataset.1', 10)
+    assert r.estimate('scope:dataset.2') == 10
+    assert r.lane('scope:dataset.2') == FAST_LANE
+
+    r.record('scope:dataset.3?files=5', 1000)
+    assert r.lane('scope:dataset.4?files=5') == BULK_LANE
+
+    r.record('scope:dataset.1', 210)
+    assert r.estimate('scope:dataset.1') == 110
+    assert r.lane('scope:dataset.1') == BULK_LANE
+
+
+def test_shared_history(tmp_path):
+    path = str(tmp_path / "history.json")
+    writer = LookupRouter(history_path=path)
+    reader = LookupRouter(history_path=path)
+    assert reader.estimate('scope:dataset') is None
+
+    writer.record('scope:dataset', 42)
+    assert reader.estimate('scope:dataset') == 42
+
+
+def test_bad_history_file(tmp_path):
+    path = tmp_path / "history.json"
+    path.write_text("not json")
+    r = LookupRouter(history_path=str(path))
+    assert r.estimate('scope:dataset') is None
+
+
+def test_shared_history_concurrent_writers(tmp_path):
+    path = str(tmp_path / "history.json")
+    routers = [LookupRouter(history_path=path) for _ in range(4)]
+
+    def write(n, router):
+        for i in range(25):
+            router.record(f'scope:dataset_{"abcd"[n]}_{"x" * i}', 1)
+
+    threads = [threading.Thread(target=write, args=(n, r)) for n, r in enumerate(routers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with open(path) as f:
+        assert len(json.load(f)) == 100
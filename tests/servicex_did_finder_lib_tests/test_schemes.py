@@ -0,0 +1,120 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+
+from celery.exceptions import Retry
+import pytest
+
+from servicex_did_finder_lib.did_finder_app import DIDFinderApp
+from servicex_did_finder_lib.local_sink import LocalServiceX
+from servicex_did_finder_lib.schemes import DIDScheme
+
+
+def test_scheme_slots():
+    scheme = DIDScheme("xrootd", max_concurrent=2)
+    assert scheme.queue == "did_finder_xrootd"
+    assert scheme.try_acquire()
+    assert scheme.try_acquire()
+    assert not scheme.try_acquire()
+    scheme.release()
+    assert scheme.try_acquire()
+
+
+def test_scheme_slot_freed_when_holder_dies():
+    scheme = DIDScheme("xrootd", max_concurrent=1)
+    pid = os.fork()
+    if pid == 0:
+        # Take the slot and die without giving it back, as if killed mid-lookup
+        os._exit(0 if scheme.try_acquire() else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+    assert scheme.try_acquire()
+    scheme.release()
+
+
+def test_scheme_unlimited():
+    scheme = DIDScheme("xrootd", {"a": 1})
+    assert all(scheme.try_acquire() for _ in range(100))
+    assert scheme.did_finder_args == {"a": 1}
+
+
+def _app_with_schemes(seen):
+    app = DIDFinderApp("rucio", did_finder_args={"catalog": "rucio"})
+    app.add_scheme("xrootd", {"catalog": "xrootd"}, max_concurrent=1)
+
+    def find_files(did, info, did_finder_args):
+        seen.append((did, did_finder_args["catalog"]))
+        yield {"paths": [f"root://site//{did}"], "adler32": 0, "file_size": 1,
+               "file_events": 1}
+
+    @app.did_lookup_task(name="did_finder_rucio.lookup_dataset")
+    def lookup_rucio(self, did: str, dataset_id: int, endpoint: str) -> None:
+        self.do_lookup(did=did, dataset_id=dataset_id, endpoint=endpoint,
+                       user_did_finder=find_files)
+
+    @app.did_lookup_task(name="did_finder_xrootd.lookup_dataset", did_scheme="xrootd")
+    def lookup_xrootd(self, did: str, dataset_id: int, endpoint: str) -> None:
+        self.do_lookup(did=did, dataset_id=dataset_id, endpoint=endpoint,
+                       user_did_finder=find_files)
+
+    return app, lookup_rucio, lookup_xrootd
+
+
+def test_app_schemes():
+    seen = []
+    app, lookup_rucio, lookup_xrootd = _app_with_schemes(seen)
+    assert lookup_xrootd.queue == "did_finder_xrootd"
+    assert lookup_rucio.queue == "did_finder_rucio"
+    assert app.lane_queue("fast", "xrootd") == "did_finder_xrootd_fast"
+
+    with LocalServiceX() as sink:
+        lookup_rucio(did="scope:ds", dataset_id=1, endpoint=sink.endpoint)
+        lookup_xrootd(did="/store/ds", dataset_id=2, endpoint=sink.endpoint)
+        lookup_xrootd(did="/store/ds2", dataset_id=3, endpoint=sink.endpoint)
+
+    assert seen == [("scope:ds", "rucio"), ("/store/ds", "xrootd"), ("/store/ds2", "xrootd")]
+    assert sink.complete["2"]["files"] == 1
+
+
+def test_app_scheme_busy():
+    seen = []
+    app, _, lookup_xrootd = _app_with_schemes(seen)
+    scheme = app.schemes["xrootd"]
+    assert scheme.try_acquire()
+
+    with pytest.raises(Retry):
+        lookup_xrootd(did="/store/ds", dataset_id=2, endpoint="http://localhost:1/")
+    assert seen == []
+    scheme.release()
+
+
+def test_app_unknown_scheme():
+    app = DIDFinderApp("rucio")
+    with pytest.raises(ValueError):
+        app.did_lookup_task(name="did_finder_xrootd.lookup_dataset", did_scheme="xrootd")
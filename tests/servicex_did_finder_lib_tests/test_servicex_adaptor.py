@@ -1,10 +1,32 @@
 import json
+import threading
+import time
 
+import pytest
 import requests
 import responses
+from servicex_did_finder_lib import chunk_controller, circuit_breaker
+from servicex_did_finder_lib.chunk_controller import ChunkController
+from servicex_did_finder_lib.local_sink import LocalServiceX
 from servicex_did_finder_lib.servicex_adaptor import ServiceXAdapter
 
 
+@pytest.fixture(autouse=True)
+def fresh_chunk_controllers(monkeypatch):
+    "Chunk controllers remember state for the life of the process - reset for each test"
+    monkeypatch.setattr(chunk_controller, "_controllers", {})
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+
+
+def _files(n):
+    return [{
+        'paths': [f'root://foo.bar{i}.ROOT'],
+        'adler32': '32',
+        'file_size': 1024,
+        'file_events': 3141
+    } for i in range(n)]
+
+
 @responses.activate
 def test_put_file_add_bulk():
     call_count = 0
@@ -34,6 +56,7 @@ def test_put_file_add_bulk():
         'file_size': 1025,
         'file_events': 3142
     }])
+    sx.close()
 
     assert len(responses.calls) == 1 + 1  # 1 retry
     submitted = json.loads(responses.calls[0].request.body)
@@ -60,9 +83,97 @@ def test_put_file_add_bulk_large():
         'file_size': 1024,
         'file_events': 3141
     }] * 320)
+    sx.close()
     assert len(responses.calls) == 2  # No retries
 
 
+@responses.activate
+def test_put_file_add_bulk_fixed_chunk():
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=206)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345', max_in_flight=1)
+    sx.put_file_add_bulk(_files(25), chunk_length=10)
+    sx.close()
+    assert [len(json.loads(c.request.body)) for c in responses.calls] == [10, 10, 5]
+
+
+@responses.activate
+def test_put_file_add_bulk_byte_budget(monkeypatch):
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=206)
+    monkeypatch.setattr(chunk_controller, "_controllers", {
+        "http://servicex.org/": ChunkController(max_bytes=1000, min_bytes=100)
+    })
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345')
+    sx.put_file_add_bulk(_files(20))
+    sx.close()
+    sizes = [len(c.request.body) for c in responses.calls]
+    assert len(sizes) > 1
+    assert all(s <= 1000 for s in sizes)
+    assert sum(len(json.loads(c.request.body)) for c in responses.calls) == 20
+
+
+@responses.activate
+def test_put_file_add_bulk_too_large():
+    def request_callback(request):
+        return (413, {}, "") if len(json.loads(request.body)) > 4 else (206, {}, "")
+
+    responses.add_callback(responses.PUT,
+                           'http://servicex.org/12345/files',
+                           callback=request_callback)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345', max_in_flight=1)
+    sx.put_file_add_bulk(_files(10), chunk_length=10)
+    sx.close()
+    accepted = [json.loads(c.request.body) for c in responses.calls
+                if c.response.status_code == 206]
+    assert [f['paths'][0] for chunk in accepted for f in chunk] == \
+        [f['paths'][0] for f in _files(10)]
+
+
+@responses.activate
+def test_put_file_add_bulk_busy(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("servicex_did_finder_lib.servicex_adaptor.time.sleep", sleeps.append)
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=503,
+                  headers={"Retry-After": "2"})
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=206)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345')
+    sx.put_file_add_bulk(_files(2))
+    sx.close()
+    assert len(responses.calls) == 2
+    assert sleeps == [2.0]
+    assert chunk_controller.get_chunk_controller("http://servicex.org/").max_records == 150
+
+
+@responses.activate
+def test_put_file_add_bulk_server_error(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("servicex_did_finder_lib.servicex_adaptor.time.sleep", sleeps.append)
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=500,
+                  headers={"Retry-After": "-5"})
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=206)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345')
+    sx.put_file_add_bulk(_files(2))
+    sx.close()
+    assert len(responses.calls) == 2
+    assert sleeps == [0.0]
+    assert chunk_controller.get_chunk_controller("http://servicex.org/").max_records == 150
+
+
+@responses.activate
+def test_put_file_add_bulk_rejected():
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=400)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345')
+    sx.put_file_add_bulk(_files(2))
+    sx.close()
+    assert len(responses.calls) == 1
+    assert chunk_controller.get_chunk_controller("http://servicex.org/").max_records == 300
+
+
 @responses.activate
 def test_put_file_add_bulk_failure():
 
@@ -85,6 +196,7 @@ def test_put_file_add_bulk_failure():
         'file_size': 1025,
         'file_events': 3142
     }])
+    sx.close()
 
     assert len(responses.calls) == 3  # Max retries
 
@@ -142,3 +254,177 @@ def test_put_file_complete_failure():
         "elapsed-time": 10
     })
     assert len(responses.calls) == 3  # Max retries
+
+
+@responses.activate
+def test_put_file_add_bulk_timeout():
+    call_count = 0
+
+    def request_callback(request):
+        nonlocal call_count
+        call_count += 1
+        assert request.req_kwargs["timeout"] == (1, 2)
+        if call_count == 1:
+            raise requests.exceptions.ReadTimeout("App hung")
+        return (206, {}, "")
+
+    responses.add_callback(responses.PUT,
+                           'http://servicex.org/12345/files',
+                           callback=request_callback)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345', timeout=(1, 2))
+    sx.put_file_add_bulk(_files(2))
+    sx.close()
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_put_file_add_bulk_window():
+    lock = threading.Lock()
+    active = 0
+    most_active = 0
+
+    def request_callback(request):
+        nonlocal active, most_active
+        with lock:
+            active += 1
+            most_active = max(most_active, active)
+        time.sleep(0.02)
+        with lock:
+            active -= 1
+        return (206, {}, "")
+
+    responses.add_callback(responses.PUT, 'http://servicex.org/12345/files',
+                           callback=request_callback)
+    responses.add(responses.PUT, 'http://servicex.org/12345/complete', status=200)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345', max_in_flight=3)
+    sx.put_file_add_bulk(_files(50), chunk_length=5)
+    sx.put_fileset_complete({"files": 50})
+
+    assert 1 < most_active <= 3
+    assert len(responses.calls) == 11
+    assert responses.calls[-1].request.url.endswith('/complete')
+    sent = sorted(f['paths'][0] for c in responses.calls[:-1]
+                  for f in json.loads(c.request.body))
+    assert sent == sorted(f['paths'][0] for f in _files(50))
+
+
+@responses.activate
+def test_put_file_add_bulk_idempotency_key():
+    call_count = 0
+
+    def request_callback(request):
+        nonlocal call_count
+        call_count += 1
+        if call_count == 1:
+            raise requests.exceptions.ConnectionError("Connection failed")
+        return (206, {}, "")
+
+    responses.add_callback(responses.PUT, 'http://servicex.org/12345/files',
+                           callback=request_callback)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345', max_in_flight=1, lookup_id='abc')
+    sx.put_file_add_bulk(_files(4), chunk_length=2)
+    sx.close()
+
+    keys = [c.request.headers['Idempotency-Key'] for c in responses.calls]
+    assert keys[0] == keys[1]
+    assert keys[1] != keys[2]
+    assert all(k.startswith('abc-') for k in keys)
+
+
+@responses.activate
+def test_idempotency_key_follows_chunk_content():
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=206)
+    files = _files(4)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345', max_in_flight=1, lookup_id='abc')
+    sx.put_file_add_bulk(files, chunk_length=2)
+    sx.put_file_add_bulk(files, chunk_length=1)
+    sx.put_file_add_bulk(files[2:], chunk_length=2)
+    sx.close()
+
+    keys = [c.request.headers['Idempotency-Key'] for c in responses.calls]
+    # Different chunks get different keys, and the same files the same key, whatever
+    # chunks came before them
+    assert len(set(keys[:6])) == 6
+    assert keys[6] == keys[1]
+
+
+@responses.activate
+def test_put_file_add_bulk_compact_paths():
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=206)
+    prefix = "root://site.domain:1094//pnfs/site.domain/atlas/rucio/mc16/"
+    files = [{'paths': [f'{prefix}f{i}.root', f'https://other//f{i}.root'], 'adler32': '32',
+              'file_size': 1024, 'file_events': i} for i in range(3)]
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345', compact_paths=True)
+    sx.put_file_add_bulk(files)
+    sx.close()
+
+    request = responses.calls[0].request
+    assert request.headers['X-Path-Encoding'] == 'prefix-table'
+    body = json.loads(request.body)
+    assert body['prefixes'] == [prefix, 'https://other//']
+    assert [f['paths'] for f in body['files']] == [[[0, f'f{i}.root'], [1, f'f{i}.root']]
+                                                   for i in range(3)]
+    assert [f['file_events'] for f in body['files']] == [0, 1, 2]
+
+
+def _site_files(n):
+    prefix = "root://site{}.domain:1094//pnfs/site.domain/atlas/rucio/mc16_13TeV/"
+    return [{'paths': [f'{prefix.format(i % 3)}f{i}.root'], 'adler32': '32',
+             'file_size': 1024, 'file_events': i} for i in range(n)]
+
+
+@responses.activate
+def test_put_file_add_bulk_compact_byte_budget(monkeypatch):
+    responses.add(responses.PUT, 'http://servicex.org/12345/files', status=206)
+    monkeypatch.setattr(chunk_controller, "_controllers", {
+        "http://servicex.org/": ChunkController(max_bytes=1000, min_bytes=100)
+    })
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345')
+    sx.put_file_add_bulk(_site_files(40))
+    sx.close()
+    full_chunks = len(responses.calls)
+    responses.calls.reset()
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345', compact_paths=True)
+    sx.put_file_add_bulk(_site_files(40))
+    sx.close()
+
+    bodies = [json.loads(c.request.body) for c in responses.calls]
+    sizes = [len(c.request.body) for c in responses.calls]
+    # Chunks are sized by their compact body, so they fill the budget with more files.
+    # Only the last one, which may not finish last, is short.
+    assert all(s <= 1000 for s in sizes)
+    assert len([s for s in sizes if s < 900]) <= 1
+    assert len(bodies) < full_chunks
+    assert all(len(b['prefixes']) == 3 for b in bodies)
+    assert sum(len(b['files']) for b in bodies) == 40
+
+
+def test_put_file_add_bulk_compact_local_sink():
+    files = _site_files(5)
+    with LocalServiceX() as sink:
+        sx = ServiceXAdapter(sink.endpoint, '12345', compact_paths=True)
+        sx.put_file_add_bulk(files)
+        sx.close()
+
+    assert [f['paths'] for f in sink.files['12345']] == [f['paths'] for f in files]
+
+
+@responses.activate
+def test_put_file_add_bulk_unexpected_error_still_completes():
+    responses.add(responses.PUT, 'http://servicex.org/12345/files',
+                  body=requests.exceptions.ChunkedEncodingError("Broken response"))
+    responses.add(responses.PUT, 'http://servicex.org/12345/complete', status=206)
+
+    sx = ServiceXAdapter("http://servicex.org/", '12345')
+    sx.put_file_add_bulk(_files(2))
+    sx.put_fileset_complete({"files": 2})
+
+    assert [c.request.url for c in responses.calls] == [
+        'http://servicex.org/12345/files', 'http://servicex.org/12345/complete']
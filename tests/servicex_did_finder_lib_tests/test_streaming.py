@@ -0,0 +1,183 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import time
+
+import pytest
+import requests
+import responses
+
+from servicex_did_finder_lib import circuit_breaker, streaming
+from servicex_did_finder_lib.circuit_breaker import CLOSED, get_circuit_breaker
+from servicex_did_finder_lib.did_finder_app import DIDFinderTask
+from servicex_did_finder_lib.local_sink import LocalServiceX
+from servicex_did_finder_lib.servicex_adaptor import MAX_RETRIES
+from servicex_did_finder_lib.streaming import StreamingServiceXAdapter
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(streaming, "RETRY_BACKOFF", 0)
+
+
+def _files(n, start=0):
+    return [{"paths": [f"root://site//file{i}.root"], "adler32": 0,
+             "file_size": 100, "file_events": 10}
+            for i in range(start, start + n)]
+
+
+def _paths(sink, dataset_id):
+    return [f["paths"][0] for f in sink.files.get(str(dataset_id), [])]
+
+
+def test_stream_files():
+    with LocalServiceX() as sink:
+        sx = StreamingServiceXAdapter(sink.endpoint, 7, ack_every=2)
+        sx.put_file_add_bulk(_files(3))
+        sx.put_file_add_bulk(_files(2, start=3))
+        sx.put_fileset_complete({"files": 5})
+
+    assert _paths(sink, 7) == [f"root://site//file{i}.root" for i in range(5)]
+    assert sink.complete["7"] == {"files": 5}
+    streams = [r for r in sink.requests if r["action"] == "stream"]
+    assert len(streams) == 3
+    assert all(r["headers"]["X-Lookup-Id"] == sx.lookup_id for r in streams)
+    assert [r["action"] for r in sink.requests].count("files") == 0
+
+
+def test_stream_sends_before_batch_fills():
+    with LocalServiceX() as sink:
+        sx = StreamingServiceXAdapter(sink.endpoint, 7, max_idle=0.05)
+        sx.put_file_add_bulk(_files(1))
+        for _ in range(100):
+            if sink.file_count(7) == 1:
+                break
+            time.sleep(0.02)
+        assert sink.file_count(7) == 1
+        assert "7" not in sink.complete
+        sx.put_fileset_complete({"files": 1})
+
+
+def test_stream_resumes_without_duplicates():
+    with LocalServiceX(fail_stream_after=2) as sink:
+        sx = StreamingServiceXAdapter(sink.endpoint, 7)
+        sx.put_file_add_bulk(_files(5))
+        sx.put_fileset_complete({"files": 5})
+
+    assert _paths(sink, 7) == [f"root://site//file{i}.root" for i in range(5)]
+    assert len([r for r in sink.requests if r["action"] == "stream"]) == 2
+
+
+def test_stream_falls_back_to_bulk(monkeypatch):
+    monkeypatch.setattr(StreamingServiceXAdapter, "_stream_once", lambda self: False)
+    with LocalServiceX() as sink:
+        sx = StreamingServiceXAdapter(sink.endpoint, 7)
+        sx.put_file_add_bulk(_files(3))
+        sx.put_fileset_complete({"files": 3})
+
+    assert sink.file_count(7) == 3
+    assert all("seq" not in f for f in sink.files["7"])
+    assert sink.complete["7"] == {"files": 3}
+
+
+@responses.activate
+def test_stream_not_supported_leaves_circuit_closed(monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+    responses.add(responses.PUT, 'http://servicex.org/7/files/stream', status=404)
+    responses.add(responses.PUT, 'http://servicex.org/7/files', status=206)
+    responses.add(responses.PUT, 'http://servicex.org/7/complete', status=206)
+
+    for _ in range(2):
+        sx = StreamingServiceXAdapter("http://servicex.org/", 7)
+        sx.put_file_add_bulk(_files(3))
+        sx.put_fileset_complete({"files": 3})
+
+    assert get_circuit_breaker("http://servicex.org/").state == CLOSED
+    bulk = [json.loads(c.request.body) for c in responses.calls
+            if c.request.url == 'http://servicex.org/7/files']
+    assert sum(len(b) for b in bulk) == 6  # Every file was sent with the batch fallback
+    # A 4xx won't change when asked again, so each lookup tries to stream only once
+    assert len([c for c in responses.calls
+                if c.request.url == 'http://servicex.org/7/files/stream']) == 2
+
+
+def test_stream_stays_off_after_fall_back(monkeypatch):
+    attempts = []
+
+    def failing_stream(self):
+        attempts.append(len(self._unacked))
+        return False
+
+    monkeypatch.setattr(StreamingServiceXAdapter, "_stream_once", failing_stream)
+    with LocalServiceX() as sink:
+        sx = StreamingServiceXAdapter(sink.endpoint, 7)
+        sx.put_file_add_bulk(_files(3))
+        for _ in range(100):
+            if sink.file_count(7) == 3:
+                break
+            time.sleep(0.02)
+        sx.put_file_add_bulk(_files(2, start=3))
+        sx.put_fileset_complete({"files": 5})
+
+    assert len(attempts) == MAX_RETRIES
+    assert _paths(sink, 7) == [f"root://site//file{i}.root" for i in range(5)]
+    assert sink.complete["7"] == {"files": 5}
+
+
+@responses.activate
+def test_stream_request_error_falls_back_to_bulk(monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+    responses.add(responses.PUT, 'http://servicex.org/7/files/stream',
+                  body=requests.exceptions.ChunkedEncodingError("broken stream"))
+    responses.add(responses.PUT, 'http://servicex.org/7/files', status=206)
+    responses.add(responses.PUT, 'http://servicex.org/7/complete', status=206)
+
+    sx = StreamingServiceXAdapter("http://servicex.org/", 7)
+    sx.put_file_add_bulk(_files(3))
+    sx.put_fileset_complete({"files": 3})
+
+    bulk = [json.loads(c.request.body) for c in responses.calls
+            if c.request.url == 'http://servicex.org/7/files']
+    assert sum(len(b) for b in bulk) == 3
+    assert responses.calls[-1].request.url == 'http://servicex.org/7/complete'
+
+
+def test_did_finder_task_streams(monkeypatch):
+    did_finder_task = DIDFinderTask()
+    monkeypatch.setattr(did_finder_task.app, "did_finder_args", {}, raising=False)
+    monkeypatch.setattr(did_finder_task.app, "streaming_upload", True, raising=False)
+
+    def finder(did, info, args):
+        yield from _files(3)
+
+    with LocalServiceX() as sink:
+        did_finder_task.do_lookup('did', 4, sink.endpoint, finder)
+
+    assert sink.file_count(4) == 3
+    assert sink.complete["4"]["files"] == 3
+    assert {r["action"] for r in sink.requests} == {"stream", "complete"}
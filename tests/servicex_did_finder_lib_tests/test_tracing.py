@@ -0,0 +1,136 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+
+import pytest
+import responses
+
+from servicex_did_finder_lib import tracing
+from servicex_did_finder_lib.did_finder_app import DIDFinderTask
+from servicex_did_finder_lib.tracing import (FileSpanExporter, configure_tracing,
+                                             current_span, get_tracer, inject_headers)
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+@pytest.fixture
+def exporter():
+    exporter = MemoryExporter()
+    configure_tracing(exporter)
+    yield exporter
+    configure_tracing(None)
+
+
+def test_tracing_off():
+    assert not tracing.tracing_enabled()
+    with get_tracer().span("nothing") as span:
+        span.set_attribute("a", 1)
+        assert current_span() is None
+    assert inject_headers({}) == {}
+
+
+def test_nested_spans(exporter):
+    with get_tracer().span("outer", {"a": 1}) as outer:
+        with get_tracer().span("inner") as inner:
+            assert current_span() is inner
+        assert current_span() is outer
+    assert current_span() is None
+
+    assert [s.name for s in exporter.spans] == ["inner", "outer"]
+    assert inner.trace_id == outer.trace_id
+    assert inner.parent_id == outer.span_id
+    assert outer.parent_id is None
+    assert outer.attributes == {"a": 1}
+    assert outer.end_ns >= inner.end_ns >= inner.start_ns >= outer.start_ns
+
+
+def test_span_exception(exporter):
+    with pytest.raises(RuntimeError):
+        with get_tracer().span("fails"):
+            raise RuntimeError("boom")
+    assert exporter.spans[0].status == "error"
+    assert exporter.spans[0].attributes["error.message"] == "boom"
+
+
+def test_inject_headers(exporter):
+    with get_tracer().span("outer") as span:
+        headers = inject_headers({"Content-Type": "application/json"})
+    assert headers["traceparent"] == f"00-{span.trace_id}-{span.span_id}-01"
+    assert len(span.trace_id) == 32
+    assert len(span.span_id) == 16
+
+
+def test_file_exporter(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    configure_tracing(FileSpanExporter(str(path)))
+    try:
+        with get_tracer().span("outer"):
+            with get_tracer().span("inner", {"files": 3}):
+                pass
+    finally:
+        configure_tracing(None)
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [s["name"] for s in lines] == ["inner", "outer"]
+    assert lines[0]["attributes"] == {"files": 3}
+    assert lines[0]["parent_id"] == lines[1]["span_id"]
+
+
+@responses.activate
+def test_lookup_spans(exporter, single_file_info):
+    responses.add(responses.PUT, 'http://servicex.org/1/files', status=206)
+    responses.add(responses.PUT, 'http://servicex.org/1/complete', status=206)
+
+    did_finder_task = DIDFinderTask()
+    did_finder_task.app.did_finder_args = {}
+
+    def finder(did, info, args):
+        yield single_file_info
+        yield [single_file_info, single_file_info]
+
+    did_finder_task.do_lookup('did', 1, 'http://servicex.org/', finder)
+
+    spans = {s.name: s for s in exporter.spans}
+    root = spans["did_lookup"]
+    assert root.attributes["dataset_id"] == 1
+    assert root.parent_id is None
+    assert spans["finder.chunk"].attributes["files"] == 3
+    assert spans["finder.chunk"].parent_id == root.span_id
+    assert spans["accumulator.flush"].parent_id == root.span_id
+    assert spans["servicex.put_files"].parent_id == spans["accumulator.flush"].span_id
+    assert spans["servicex.put_complete"].parent_id == root.span_id
+    assert all(s.trace_id == root.trace_id for s in exporter.spans)
+
+    put = responses.calls[0].request
+    assert put.headers["traceparent"].split("-")[1] == root.trace_id
@@ -0,0 +1,108 @@
+# Copyright (c) 2024, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import pytest
+from celery import Celery
+
+from servicex_did_finder_lib.did_finder_app import DIDFinderApp
+from servicex_did_finder_lib.transport import FILE_QUEUE, BrokerTransport, FileTransport
+
+
+def _file(i):
+    return {"paths": [f"root://site//file{i}.root"], "adler32": 0, "file_size": 100,
+            "file_events": 10}
+
+
+def _drain(app, queue=FILE_QUEUE):
+    messages = []
+    with app.connection_for_read() as conn:
+        with conn.SimpleQueue(queue) as q:
+            while True:
+                try:
+                    message = q.get(block=False)
+                except q.Empty:
+                    return messages
+                messages.append((message.headers, message.payload))
+                message.ack()
+
+
+@pytest.fixture
+def app():
+    return Celery("transport_test", broker="memory://")
+
+
+def test_publish_batches(app):
+    transport = BrokerTransport(app, 7, lookup_id="abc", batch_size=2)
+    transport.put_file_add_bulk([_file(i) for i in range(5)])
+    transport.put_fileset_complete({"files": 5})
+    transport.close()
+
+    messages = _drain(app)
+    assert [m["type"] for _, m in messages] == ["file-add"] * 3 + ["complete"]
+    assert [len(m["files"]) for _, m in messages[:3]] == [2, 2, 1]
+    assert [h["idempotency-key"] for h, _ in messages[:3]] == ["abc-0", "abc-1", "abc-2"]
+    assert messages[2][1]["files"][0]["paths"] == ["root://site//file4.root"]
+    assert messages[3][1] == {"type": "complete", "dataset-id": 7, "lookup-id": "abc",
+                              "summary": {"files": 5}}
+
+
+def test_publish_failure_is_logged(app, mocker, caplog):
+    mocker.patch.object(app, "producer_or_acquire", side_effect=ConnectionError("no broker"))
+    transport = BrokerTransport(app, 7)
+    transport.put_file_add_bulk([_file(0)])
+
+    assert "Failed to publish a file-add message" in caplog.text
+
+
+def test_lookup_uses_file_queue():
+    app = DIDFinderApp('queued', did_finder_args={}, broker="memory://",
+                       file_queue="files_for_app")
+    app.conf.task_always_eager = True
+
+    @app.did_lookup_task(name="did_finder_queued.lookup_dataset")
+    def lookup_dataset(self, did: str, dataset_id: int, endpoint: str) -> None:
+        self.do_lookup(did=did, dataset_id=dataset_id, endpoint=endpoint,
+                       user_did_finder=lambda did, info, args: iter([_file(0), _file(1)]))
+
+    lookup_dataset.delay(did='scope:dataset', dataset_id=3, endpoint='http://nowhere/')
+
+    messages = [m for _, m in _drain(app, "files_for_app")]
+    assert sum(len(m["files"]) for m in messages if m["type"] == "file-add") == 2
+    assert messages[-1]["type"] == "complete"
+    assert messages[-1]["summary"]["files"] == 2
+
+
+@pytest.mark.parametrize("option", ["streaming_upload", "compact_upload"])
+def test_file_queue_rejects_endpoint_options(option):
+    with pytest.raises(ValueError):
+        DIDFinderApp('queued', did_finder_args={}, broker="memory://",
+                     file_queue="files_for_app", **{option: True})
+
+
+def test_file_transport_is_abstract():
+    with pytest.raises(TypeError):
+        FileTransport()
@@ -84,3 +84,77 @@ def test_uri_rucio():
                      "s3136_r10724_r10726_p4164")
     assert r.get_mode == "all"
     assert r.file_count == 20
+
+
+def test_uri_no_filters():
+    r = parse_did_uri('forkit?files=10')
+
+    assert r.path_glob is None
+    assert r.path_regex is None
+    assert r.min_size is None
+    assert r.max_size is None
+    assert r.min_events is None
+
+
+def test_uri_with_filters():
+    r = parse_did_uri('forkit?path=*DAOD_PHYS*&min_size=1GB&max_size=2500MB'
+                      '&min_events=100&stuff=hi')
+
+    assert r.did == "forkit?stuff=hi"
+    assert r.path_glob == "*DAOD_PHYS*"
+    assert r.min_size == 1000000000
+    assert r.max_size == 2500000000
+    assert r.min_events == 100
+
+
+def test_uri_with_path_regex():
+    r = parse_did_uri('forkit?path_regex=.*%5C.root%2B$')
+
+    assert r.did == "forkit"
+    assert r.path_regex == r".*\.root+$"
+
+
+def test_uri_with_bad_size():
+    with pytest.raises(ValueError) as e:
+        parse_did_uri('forkit?min_size=lots')
+
+    assert "lots" in str(e.value)
+
+
+def test_uri_with_bad_regex():
+    with pytest.raises(ValueError) as e:
+        parse_did_uri('forkit?path_regex=(unclosed')
+
+    assert "path_regex" in str(e.value)
+
+
+def test_uri_with_timeout():
+    r = parse_did_uri('forkit?timeout=90.5&files=2')
+
+    assert r.did == "forkit"
+    assert r.timeout == 90.5
+    assert parse_did_uri('forkit').timeout is None
+
+
+def test_uri_with_bad_timeout():
+    with pytest.raises(ValueError) as e:
+        parse_did_uri('forkit?timeout=-4')
+
+    assert "-4" in str(e.value)
+
+
+def test_uri_with_sample_and_events():
+    r = parse_did_uri('forkit?sample=0.1&events=1000000&files=3')
+
+    assert r.did == "forkit"
+    assert r.sample == 0.1
+    assert r.event_count == 1000000
+    assert r.file_count == 3
+    assert parse_did_uri('forkit').sample is None
+    assert parse_did_uri('forkit').event_count is None
+
+
+@pytest.mark.parametrize("query", ["sample=0", "sample=1.5", "sample=some", "events=0"])
+def test_uri_with_bad_sample_or_events(query):
+    with pytest.raises(ValueError):
+        parse_did_uri(f'forkit?{query}')